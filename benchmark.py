@@ -0,0 +1,659 @@
+import os
+import sys
+import time
+import random
+import threading
+import asyncio
+import argparse
+import tempfile
+import logging
+
+import faiss
+import nltk
+import numpy as np
+from watchdog.observers import Observer
+
+import generate
+from processors import VectorIndexer, VectorSearch, QueryBatcher, ShardedIndexer, ShardedSearch, SearchFilter
+from processors import FileChangeHandler
+from processors.encoders import make_encoder
+from processors.crawler import make_index
+from processors.text_processing import Normalizer, VALID_TAGS
+
+
+def collect_files(paths: list) -> list:
+    file_paths = []
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for file in files:
+                file_paths.append(os.path.join(root, file))
+    return file_paths
+
+
+# Кодировщик всех индексов запуска (--encoder); загружается один раз
+ENCODER_NAME = 'all-mpnet-base-v2'
+encoders = {}
+
+
+def shared_encoder(name=None):
+    name = name or ENCODER_NAME
+    if name not in encoders:
+        encoders[name] = make_encoder(name)
+    return encoders[name]
+
+
+def fresh_indexer(work_dir: str, name: str, **kwargs) -> VectorIndexer:
+    return VectorIndexer(watch_paths=[],
+                         index_path=os.path.join(work_dir, f"{name}.faiss"),
+                         map_path=os.path.join(work_dir, f"{name}.pkl"),
+                         encoder=shared_encoder(), **kwargs)
+
+
+def bench_crawl(args):
+    file_paths = collect_files(args.paths)
+    if args.limit:
+        file_paths = file_paths[:args.limit]
+    print(f"Файлов для индексации: {len(file_paths)}")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        indexer = fresh_indexer(work_dir, "per_file")
+        started = time.perf_counter()
+        for file_path in file_paths:
+            indexer.add_file(file_path)
+        per_file = time.perf_counter() - started
+
+        indexer = fresh_indexer(work_dir, "bulk", batch_size=args.batch_size, workers=args.workers)
+        started = time.perf_counter()
+        indexer.add_files(file_paths)
+        bulk = time.perf_counter() - started
+
+    print(f"{'add_file по одному':<24}: {len(file_paths) / per_file:10.1f} docs/sec ({per_file:.2f} s)")
+    print(f"{'add_files пакетами':<24}: {len(file_paths) / bulk:10.1f} docs/sec ({bulk:.2f} s)")
+    print(f"{'Ускорение':<24}: {per_file / bulk:10.2f}x")
+
+
+def load_queries(args, file_paths: list) -> list:
+    if args.queries:
+        with open(args.queries, 'r', encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+    return [os.path.splitext(os.path.basename(path))[0] for path in file_paths]
+
+
+async def run_clients(search, queries: list, clients: int, requests: int) -> list:
+    latencies = []
+
+    async def client(offset):
+        for i in range(requests):
+            started = time.perf_counter()
+            await search(queries[(offset + i) % len(queries)])
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(client(n * requests) for n in range(clients)))
+    return latencies
+
+
+def report(name: str, latencies: list, elapsed: float):
+    ms = np.array(latencies) * 1000
+    print(f"{name:<16}: p50 {np.percentile(ms, 50):8.2f} ms, p99 {np.percentile(ms, 99):8.2f} ms, "
+          f"{len(latencies) / elapsed:8.1f} QPS")
+
+
+def bench_search_load(args):
+    file_paths = collect_files(args.paths)
+    queries = load_queries(args, file_paths)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        indexer = fresh_indexer(work_dir, "load")
+        indexer.add_files(file_paths)
+        search_engine = VectorSearch(indexer=indexer)
+
+        async def unbatched():
+            loop = asyncio.get_running_loop()
+            search = lambda query: loop.run_in_executor(None, search_engine.search, query)
+            started = time.perf_counter()
+            latencies = await run_clients(search, queries, args.clients, args.requests)
+            report("без батчинга", latencies, time.perf_counter() - started)
+
+        async def batched():
+            batcher = QueryBatcher(search_engine, window_ms=args.window_ms, max_batch=args.max_batch)
+            batcher.start()
+            started = time.perf_counter()
+            latencies = await run_clients(batcher.search, queries, args.clients, args.requests)
+            report("с батчингом", latencies, time.perf_counter() - started)
+            await batcher.stop()
+
+        print(f"Документов: {len(file_paths)}, клиентов: {args.clients}, запросов на клиента: {args.requests}")
+        asyncio.run(unbatched())
+        asyncio.run(batched())
+
+
+def bench_hybrid(args):
+    file_paths = collect_files(args.paths)
+    queries = load_queries(args, file_paths)
+    print(f"Документов: {len(file_paths)}, запросов: {len(queries)}, k={args.k}")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        indexer = fresh_indexer(work_dir, "hybrid", chunk_tokens=args.chunk_tokens)
+        indexer.add_files(file_paths)
+        modes = [('vector', 0), ('lexical', 0), ('hybrid', 0), ('hybrid', args.prefilter)]
+        for mode, prefilter in modes:
+            search_engine = VectorSearch(indexer=indexer, mode=mode, prefilter=prefilter)
+            stages = {}
+            started = time.perf_counter()
+            for start in range(0, len(queries), args.batch):
+                search_engine.search_many(queries[start:start + args.batch], args.k)
+                for stage, seconds in search_engine.timings.items():
+                    stages[stage] = stages.get(stage, 0.0) + seconds
+            elapsed = time.perf_counter() - started
+
+            name = f"{mode} prefilter={prefilter}" if prefilter else mode
+            per_stage = ", ".join(f"{stage} {seconds * 1000 / len(queries):.3f}" for stage, seconds in stages.items())
+            print(f"{name:<24}: {len(queries) / elapsed:8.1f} QPS, ms/запрос по стадиям: {per_stage}")
+
+
+def bench_shards(args):
+    file_paths = collect_files(args.paths)
+    queries = load_queries(args, file_paths)
+    print(f"Документов: {len(file_paths)}, запросов: {len(queries)}, k={args.k}")
+    encoder = shared_encoder()
+
+    for count in range(1, args.max_shards + 1):
+        with tempfile.TemporaryDirectory() as work_dir:
+            roots = [os.path.join(work_dir, f"root{n}") for n in range(count)]
+            for root in roots:
+                os.makedirs(root)
+            for n, file_path in enumerate(file_paths):
+                link = os.path.join(roots[n % count], f"{n}_{os.path.basename(file_path)}")
+                os.symlink(os.path.abspath(file_path), link)
+
+            started = time.perf_counter()
+            indexer = ShardedIndexer(watch_paths=roots, index_path=os.path.join(work_dir, "shard.faiss"),
+                                     map_path=os.path.join(work_dir, "shard.pkl"), encoder=encoder)
+            ingest = time.perf_counter() - started
+
+            search_engine = ShardedSearch(indexer, mode=args.mode)
+            started = time.perf_counter()
+            for start in range(0, len(queries), args.batch):
+                search_engine.search_many(queries[start:start + args.batch], args.k)
+            elapsed = time.perf_counter() - started
+            search_engine.pool.shutdown()
+
+        print(f"{f'шардов: {count}':<12}: индексация {len(file_paths) / ingest:8.1f} docs/sec, "
+              f"поиск {len(queries) / elapsed:8.1f} QPS")
+
+
+def stress_document(rng: random.Random, words: list) -> str:
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(20, 200)))
+
+
+def bench_stress(args):
+    rng = random.Random(0)
+    words = [f"w{i}" for i in range(args.vocabulary)]
+    queries = [' '.join(rng.sample(words, 3)) for _ in range(64)]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus = os.path.join(work_dir, "corpus")
+        os.makedirs(corpus)
+        file_paths = [os.path.join(corpus, f"doc{n}.txt") for n in range(args.documents)]
+        for file_path in file_paths:
+            with open(file_path, 'w', encoding='utf-8') as f:
+                f.write(stress_document(rng, words))
+
+        indexer = fresh_indexer(work_dir, "stress", index_type=args.index_type, delta_threshold=args.delta_threshold,
+                                compaction_threshold=0.1, ivf_threshold=args.documents // 2)
+        indexer.add_files(file_paths)
+        # The first k documents are never removed, so every query must always return exactly k documents
+        churn = file_paths[args.k:]
+        stop = threading.Event()
+        counts = {'queries': 0, 'writes': 0, 'snapshots': 0}
+        errors = []
+
+        def writer():
+            writer_rng = random.Random(1)
+            try:
+                while not stop.is_set():
+                    batch = writer_rng.sample(churn, writer_rng.randint(1, 16))
+                    removed = [path for path in batch if writer_rng.random() < 0.3 and path in indexer.path_to_id]
+                    indexer.remove_files(removed)
+                    for file_path in batch:
+                        if file_path not in removed:
+                            with open(file_path, 'w', encoding='utf-8') as f:
+                                f.write(stress_document(writer_rng, words))
+                    indexer.add_files([path for path in batch if path not in removed])
+                    counts['writes'] += len(batch)
+                    if writer_rng.random() < 0.05:
+                        indexer.save_index()
+                        counts['snapshots'] += 1
+            except Exception as e:
+                errors.append(f"writer: {e!r}")
+
+        def reader(mode):
+            search_engine = VectorSearch(indexer=indexer, mode=mode)
+            reader_rng = random.Random()
+            try:
+                while not stop.is_set():
+                    batch = reader_rng.sample(queries, 8)
+                    for query, results in zip(batch, search_engine.search_many(batch, args.k)):
+                        paths = [result['path'] for result in results]
+                        scores = [result['score'] for result in results]
+                        if mode == 'vector' and len(results) != args.k:
+                            errors.append(f"{mode}: {len(results)} результатов вместо {args.k} для '{query}'")
+                        if len(set(paths)) != len(paths) or scores != sorted(scores, reverse=True):
+                            errors.append(f"{mode}: повторы или неупорядоченные оценки для '{query}'")
+                    counts['queries'] += len(batch)
+            except Exception as e:
+                errors.append(f"{mode}: {e!r}")
+
+        threads = [threading.Thread(target=writer)]
+        threads += [threading.Thread(target=reader, args=(mode,))
+                    for mode in ['vector', 'hybrid'] for _ in range(args.readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        print(f"Запросов: {counts['queries']}, изменений файлов: {counts['writes']}, "
+              f"снимков: {counts['snapshots']}, индекс: {indexer.stats()}")
+        for error in errors[:20]:
+            print(error)
+        print(f"Несогласованных результатов и ошибок: {len(errors)}")
+        if errors:
+            sys.exit(1)
+
+
+def bench_ingest(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus = os.path.join(work_dir, "corpus")
+        stats = generate.write_corpus(corpus, args)
+        print(f"Корпус: {stats['documents']} документов (копий: {stats['duplicates']}), "
+              f"{stats['characters'] / 2**20:.1f} M символов, запись {stats['seconds']:.2f} s")
+
+        started = time.perf_counter()
+        indexer = VectorIndexer(watch_paths=[corpus], index_path=os.path.join(work_dir, "ingest.faiss"),
+                                map_path=os.path.join(work_dir, "ingest.pkl"), encoder=shared_encoder(),
+                                index_type=args.index_type)
+        crawl = time.perf_counter() - started
+        print(f"Начальная индексация: {crawl:.2f} s ({stats['documents'] / crawl:.1f} docs/sec), "
+              f"индекс: {indexer.stats()}")
+
+        handler = FileChangeHandler(indexer, debounce=args.debounce)
+        observer = Observer()
+        observer.schedule(handler, corpus, recursive=True)
+        observer.start()
+
+        # Очередь наблюдателя - события, которые еще не применены к индексу
+        backlog = []
+        sampling = threading.Event()
+
+        def sampler():
+            while not sampling.is_set():
+                with handler.condition:
+                    backlog.append(len(handler.pending))
+                time.sleep(args.sample_ms / 1000)
+
+        sampler_thread = threading.Thread(target=sampler)
+        sampler_thread.start()
+        churn = generate.Churn([corpus], args)
+        started = time.perf_counter()
+        operations = churn.run(args.bursts, args.interval)
+        churn_seconds = time.perf_counter() - started
+
+        # Индекс догнал диск, когда очередь пуста, пакет применен и набор проиндексированных файлов совпадает
+        drained = False
+        while time.perf_counter() - started < churn_seconds + args.drain_timeout:
+            with handler.applying, handler.condition:
+                if not handler.pending and set(indexer.path_to_id) == set(collect_files([corpus])):
+                    drained = True
+                    break
+            time.sleep(0.05)
+        total = time.perf_counter() - started
+        sampling.set()
+        sampler_thread.join()
+        observer.stop()
+        observer.join()
+        handler.stop()
+
+        print(f"Изменений: {operations} за {churn_seconds:.2f} s ({operations / churn_seconds:.0f} ops/sec): "
+              + ", ".join(f"{operation} {count}" for operation, count in churn.counts.items()))
+        print(f"Очередь событий: в среднем {np.mean(backlog):.1f}, максимум {max(backlog)}")
+        if drained:
+            print(f"Индекс догнал диск через {total - churn_seconds:.2f} s после последней пачки, "
+                  f"{operations / total:.0f} изменений/s от начала churn; индекс: {indexer.stats()}")
+        else:
+            print(f"Индекс не догнал диск за {args.drain_timeout:.0f} s после последней пачки: "
+                  f"в очереди {len(handler.pending)}, проиндексировано {len(indexer.path_to_id)} "
+                  f"из {len(collect_files([corpus]))} файлов")
+            sys.exit(1)
+
+
+def filter_corpus(args, work_dir: str):
+    if args.paths:
+        file_paths = collect_files(args.paths)
+        return file_paths, load_queries(args, file_paths)
+    # Synthetic documents get one second of mtime each, so every selectivity is reachable exactly
+    rng = random.Random(0)
+    words = [f"w{i}" for i in range(args.vocabulary)]
+    corpus = os.path.join(work_dir, "corpus")
+    os.makedirs(corpus)
+    file_paths = []
+    for n in range(args.documents):
+        file_path = os.path.join(corpus, f"doc{n}.txt")
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(stress_document(rng, words))
+        os.utime(file_path, ns=(n * 10**9, n * 10**9))
+        file_paths.append(file_path)
+    return file_paths, [' '.join(rng.sample(words, 3)) for _ in range(200)]
+
+
+def bench_filters(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_paths, queries = filter_corpus(args, work_dir)
+        indexer = fresh_indexer(work_dir, "filters", index_type=args.index_type)
+        indexer.add_files(file_paths)
+        search_engine = VectorSearch(indexer=indexer)
+        mtimes = np.sort([meta[1] for meta in indexer.manifest.values()])
+        print(f"Документов: {len(mtimes)}, запросов: {len(queries)}, k={args.k}, индекс: {args.index_type}, "
+              f"точный перебор до {args.scan_limit} векторов")
+
+        def run(search_filter, top_k, scan_limit):
+            indexer.filter_scan_limit = scan_limit
+            results = []
+            started = time.perf_counter()
+            for start in range(0, len(queries), args.batch):
+                results += search_engine.search_many(queries[start:start + args.batch], top_k, search_filter)
+            return results, len(queries) / (time.perf_counter() - started)
+
+        for selectivity in args.selectivity:
+            # Documents modified at or after the threshold are the fraction that passes the filter
+            threshold = int(mtimes[min(len(mtimes) - 1, int((1 - selectivity) * len(mtimes)))])
+            search_filter = SearchFilter(modified_after=threshold / 1e9)
+            passing = {path for path, meta in indexer.manifest.items()
+                       if meta[1] >= int(search_filter.modified_after * 1e9)}
+            truth, _ = run(search_filter, args.k, len(mtimes) + 1)
+            truth = [{result['path'] for result in results} for results in truth]
+
+            filtered, filtered_qps = run(search_filter, args.k, args.scan_limit)
+            post, post_qps = run(None, args.k * args.overfetch, args.scan_limit)
+            post = [[result for result in results if result['path'] in passing][:args.k] for results in post]
+
+            print(f"доля {len(passing) / len(mtimes):7.4f}:")
+            for name, results, qps in [("фильтр в индексе", filtered, filtered_qps),
+                                       (f"постфильтрация x{args.overfetch}", post, post_qps)]:
+                recall = np.mean([len({result['path'] for result in found} & expected) / len(expected)
+                                  for found, expected in zip(results, truth) if expected])
+                found = np.mean([len(results) for results in results])
+                print(f"    {name:<20}: {qps:8.1f} QPS, recall@{args.k} {recall:.4f}, результатов {found:5.1f}")
+
+
+def bench_encoders(args):
+    file_paths = collect_files(args.paths)
+    if args.limit:
+        file_paths = file_paths[:args.limit]
+    documents = []
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            documents.append(f.read())
+    queries = load_queries(args, file_paths)
+    print(f"Документов: {len(documents)}, запросов: {len(queries)}, k={args.k}")
+
+    reference = None
+    for name in args.encoders:
+        started = time.perf_counter()
+        encoder = shared_encoder(name)
+        loaded = time.perf_counter() - started
+
+        started = time.perf_counter()
+        vectors = encoder.encode(documents, batch_size=args.batch_size)
+        elapsed = time.perf_counter() - started
+        query_vectors = encoder.encode(queries, batch_size=args.batch_size)
+        faiss.normalize_L2(vectors)
+        faiss.normalize_L2(query_vectors)
+        neighbours = np.argsort(-(query_vectors @ vectors.T), axis=1)[:, :args.k]
+        # Полнота считается относительно соседей первого кодировщика в списке
+        if reference is None:
+            reference = neighbours
+        print(f"{encoder.name:<28}: d={encoder.dimension:<4} загрузка {loaded:6.2f} s, "
+              f"{len(documents) / elapsed:8.1f} docs/sec, recall@{args.k} {recall_at_k(neighbours, reference):.4f}")
+
+
+def legacy_normalize(sentence) -> list:
+    tokenizer = nltk.TweetTokenizer()
+    stemmer = nltk.stem.LancasterStemmer()
+    sentence = tokenizer.tokenize(sentence)
+    sentence = [word for word in sentence if nltk.pos_tag([word])[0][1] in VALID_TAGS]
+    return [stemmer.stem(word).lower() for word in sentence]
+
+
+def bench_normalize(args):
+    file_paths = collect_files(args.paths)
+    if args.limit:
+        file_paths = file_paths[:args.limit]
+    documents = []
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            documents.append(f.read())
+    tokens = sum(len(nltk.TweetTokenizer().tokenize(document)) for document in documents)
+    print(f"Документов: {len(documents)}, токенов: {tokens}")
+
+    started = time.perf_counter()
+    expected = [legacy_normalize(document) for document in documents]
+    legacy = time.perf_counter() - started
+
+    started = time.perf_counter()
+    actual = Normalizer().normalize_many(documents)
+    batched = time.perf_counter() - started
+
+    started = time.perf_counter()
+    parallel = Normalizer().normalize_many(documents, processes=args.processes)
+    pooled = time.perf_counter() - started
+
+    print(f"{'по слову (старый)':<24}: {tokens / legacy:12.0f} tokens/sec")
+    print(f"{'normalize_many':<24}: {tokens / batched:12.0f} tokens/sec")
+    print(f"{'normalize_many, процессы':<24}: {tokens / pooled:12.0f} tokens/sec")
+    print(f"Результат совпадает: {expected == actual == parallel}")
+
+
+def synthetic_vectors(n: int, d: int, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 100), d)).astype('float32')
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, d)).astype('float32')
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def corpus_vectors(args, work_dir: str):
+    file_paths = collect_files(args.paths)
+    indexer = fresh_indexer(work_dir, "ann")
+    indexer.add_files(file_paths)
+    ids = np.array(sorted(indexer.id_to_path), dtype='int64')
+    vectors = indexer.reconstruct(ids)
+    queries = indexer.encoder.encode(load_queries(args, file_paths))
+    faiss.normalize_L2(queries)
+    return vectors, queries
+
+
+def timed_search(index, queries, k: int, params=None):
+    started = time.perf_counter()
+    _, ids = index.search(queries, k, params=params) if params else index.search(queries, k)
+    return ids, (time.perf_counter() - started) * 1000 / len(queries)
+
+
+def recall_at_k(found, truth) -> float:
+    return np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+
+
+def bench_ann(args):
+    vectors, queries = load_vectors(args)
+    ids = np.arange(len(vectors), dtype='int64')
+    print(f"Векторов: {len(vectors)}, запросов: {len(queries)}, k={args.k}")
+
+    flat = make_index(vectors.shape[1], 'flat')
+    flat.add_with_ids(vectors, ids)
+    truth, flat_ms = timed_search(flat, queries, args.k)
+    print(f"{'flat':<22}: recall@{args.k} 1.0000, {flat_ms:8.3f} ms/query")
+
+    ivf = make_index(vectors.shape[1], 'ivf', vectors)
+    ivf.add_with_ids(vectors, ids)
+    for nprobe in args.nprobe:
+        found, ms = timed_search(ivf, queries, args.k, faiss.SearchParametersIVF(nprobe=nprobe))
+        print(f"{f'ivf nprobe={nprobe}':<22}: recall@{args.k} {recall_at_k(found, truth):.4f}, {ms:8.3f} ms/query")
+
+    hnsw = make_index(vectors.shape[1], 'hnsw')
+    hnsw.add_with_ids(vectors, ids)
+    for ef in args.ef_search:
+        found, ms = timed_search(hnsw, queries, args.k, faiss.SearchParametersHNSW(efSearch=ef))
+        print(f"{f'hnsw efSearch={ef}':<22}: recall@{args.k} {recall_at_k(found, truth):.4f}, {ms:8.3f} ms/query")
+
+
+def load_vectors(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.synthetic:
+            return synthetic_vectors(args.synthetic, args.dim), synthetic_vectors(args.query_count, args.dim, seed=1)
+        return corpus_vectors(args, work_dir)
+
+
+def bench_compression(args):
+    vectors, queries = load_vectors(args)
+    ids = np.arange(len(vectors), dtype='int64')
+    print(f"Векторов: {len(vectors)}, запросов: {len(queries)}, k={args.k}")
+
+    truth = None
+    for encoding in ['float32', 'fp16', 'sq8', 'pq']:
+        index = make_index(vectors.shape[1], 'flat', vectors, encoding=encoding, pq_m=args.pq_m)
+        index.add_with_ids(vectors, ids)
+        bytes_per_vector = faiss.serialize_index(index).size / len(vectors)
+        params = faiss.SearchParametersIVF(nprobe=1) if encoding == 'pq' else None
+
+        found, ms = timed_search(index, queries, args.k, params)
+        if truth is None:
+            truth = found
+        line = (f"{encoding:<8}: {bytes_per_vector:8.1f} bytes/vector, recall@{args.k} "
+                f"{recall_at_k(found, truth):.4f}, {ms:7.3f} ms/query")
+
+        if encoding != 'float32':
+            candidates, _ = timed_search(index, queries, args.k * args.rerank, params)
+            reranked = []
+            for query, row in zip(queries, candidates):
+                row = row[row >= 0]
+                reranked.append(row[np.argsort(-(vectors[row] @ query))[:args.k]])
+            line += f", с переранжированием x{args.rerank}: recall@{args.k} {recall_at_k(reranked, truth):.4f}"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Бенчмарки индексации и поиска")
+    parser.add_argument("--encoder", default=ENCODER_NAME,
+                        help="модель sentence-transformers, '<модель>:int8' или 'hashing-384' без сети и модели")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    crawl = subparsers.add_parser("crawl", help="add_file по одному против пакетной индексации")
+    crawl.add_argument("paths", nargs="+")
+    crawl.add_argument("--limit", type=int, default=0)
+    crawl.add_argument("--batch-size", type=int, default=32)
+    crawl.add_argument("--workers", type=int, default=None)
+    crawl.set_defaults(func=bench_crawl)
+
+    load = subparsers.add_parser("search-load", help="задержка и QPS поиска при параллельных запросах")
+    load.add_argument("paths", nargs="+")
+    load.add_argument("--queries", help="файл с запросами, по одному в строке")
+    load.add_argument("--clients", type=int, default=32)
+    load.add_argument("--requests", type=int, default=20)
+    load.add_argument("--window-ms", type=float, default=5)
+    load.add_argument("--max-batch", type=int, default=32)
+    load.set_defaults(func=bench_search_load)
+
+    hybrid = subparsers.add_parser("hybrid", help="векторный, лексический (BM25) и гибридный поиск по стадиям")
+    hybrid.add_argument("paths", nargs="+")
+    hybrid.add_argument("--queries", help="файл с запросами, по одному в строке")
+    hybrid.add_argument("-k", type=int, default=10)
+    hybrid.add_argument("--batch", type=int, default=32)
+    hybrid.add_argument("--chunk-tokens", type=int, default=0)
+    hybrid.add_argument("--prefilter", type=int, default=200)
+    hybrid.set_defaults(func=bench_hybrid)
+
+    shards = subparsers.add_parser("shards", help="индексация и QPS при 1..N шардах")
+    shards.add_argument("paths", nargs="+")
+    shards.add_argument("--queries", help="файл с запросами, по одному в строке")
+    shards.add_argument("--max-shards", type=int, default=4)
+    shards.add_argument("-k", type=int, default=10)
+    shards.add_argument("--batch", type=int, default=32)
+    shards.add_argument("--mode", default='vector', choices=['vector', 'lexical', 'hybrid'])
+    shards.set_defaults(func=bench_shards)
+
+    ingest = subparsers.add_parser("ingest", help="скорость индексации потока изменений и очередь наблюдателя")
+    generate.add_corpus_arguments(ingest)
+    generate.add_churn_arguments(ingest)
+    ingest.add_argument("--index-type", default='flat', choices=['flat', 'ivf', 'hnsw'])
+    ingest.add_argument("--debounce", type=float, default=0.5)
+    ingest.add_argument("--sample-ms", type=float, default=50)
+    ingest.add_argument("--drain-timeout", type=float, default=120)
+    ingest.set_defaults(func=bench_ingest, documents=2000, bursts=20)
+
+    filters = subparsers.add_parser("filters", help="поиск с фильтром по mtime при разной доле подходящих документов")
+    filters.add_argument("paths", nargs="*")
+    filters.add_argument("--queries", help="файл с запросами, по одному в строке")
+    filters.add_argument("--documents", type=int, default=2000, help="размер синтетического корпуса без paths")
+    filters.add_argument("--vocabulary", type=int, default=2000)
+    filters.add_argument("--selectivity", type=float, nargs="+", default=[1.0, 0.5, 0.1, 0.01, 0.001])
+    filters.add_argument("-k", type=int, default=10)
+    filters.add_argument("--batch", type=int, default=32)
+    filters.add_argument("--overfetch", type=int, default=10)
+    filters.add_argument("--scan-limit", type=int, default=2048)
+    filters.add_argument("--index-type", default='flat', choices=['flat', 'hnsw'])
+    filters.set_defaults(func=bench_filters)
+
+    encoders_parser = subparsers.add_parser("encoders", help="скорость кодировщиков и совпадение их соседей")
+    encoders_parser.add_argument("paths", nargs="+")
+    encoders_parser.add_argument("--queries", help="файл с запросами, по одному в строке")
+    encoders_parser.add_argument("--encoders", nargs="+",
+                                 default=['all-mpnet-base-v2', 'all-mpnet-base-v2:int8', 'hashing-384'])
+    encoders_parser.add_argument("--limit", type=int, default=1000)
+    encoders_parser.add_argument("--batch-size", type=int, default=32)
+    encoders_parser.add_argument("-k", type=int, default=10)
+    encoders_parser.set_defaults(func=bench_encoders)
+
+    stress = subparsers.add_parser("stress", help="согласованность поиска при одновременной индексации")
+    stress.add_argument("--documents", type=int, default=2000)
+    stress.add_argument("--vocabulary", type=int, default=2000)
+    stress.add_argument("--seconds", type=float, default=30)
+    stress.add_argument("--readers", type=int, default=4)
+    stress.add_argument("-k", type=int, default=10)
+    stress.add_argument("--index-type", default='flat', choices=['flat', 'ivf', 'hnsw'])
+    stress.add_argument("--delta-threshold", type=int, default=500)
+    stress.set_defaults(func=bench_stress)
+
+    norm = subparsers.add_parser("normalize", help="скорость text_processing.normalize")
+    norm.add_argument("paths", nargs="+")
+    norm.add_argument("--limit", type=int, default=0)
+    norm.add_argument("--processes", type=int, default=os.cpu_count())
+    norm.set_defaults(func=bench_normalize)
+
+    ann = subparsers.add_parser("ann", help="полнота и задержка IVF/HNSW относительно точного поиска")
+    ann.add_argument("paths", nargs="*")
+    ann.add_argument("--queries", help="файл с запросами, по одному в строке")
+    ann.add_argument("--synthetic", type=int, default=0, help="число случайных векторов вместо корпуса")
+    ann.add_argument("--dim", type=int, default=768)
+    ann.add_argument("--query-count", type=int, default=200)
+    ann.add_argument("-k", type=int, default=10)
+    ann.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    ann.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256])
+    ann.set_defaults(func=bench_ann)
+
+    compression = subparsers.add_parser("compression", help="размер и полнота fp16/sq8/pq относительно float32")
+    compression.add_argument("paths", nargs="*")
+    compression.add_argument("--queries", help="файл с запросами, по одному в строке")
+    compression.add_argument("--synthetic", type=int, default=0, help="число случайных векторов вместо корпуса")
+    compression.add_argument("--dim", type=int, default=768)
+    compression.add_argument("--query-count", type=int, default=200)
+    compression.add_argument("-k", type=int, default=10)
+    compression.add_argument("--pq-m", type=int, default=64)
+    compression.add_argument("--rerank", type=int, default=4)
+    compression.set_defaults(func=bench_compression)
+
+    args = parser.parse_args()
+    ENCODER_NAME = args.encoder
+    logging.getLogger().setLevel(logging.WARNING)
+    args.func(args)
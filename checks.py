@@ -0,0 +1,538 @@
+import os
+import sys
+import time
+import random
+import signal
+import argparse
+import tempfile
+import logging
+import multiprocessing
+
+import numpy as np
+from watchdog.events import FileCreatedEvent, FileDeletedEvent
+from watchdog.observers import Observer
+
+import benchmark
+from benchmark import shared_encoder, fresh_indexer
+from processors import VectorIndexer, VectorSearch, ShardedIndexer, ShardedSearch, SearchFilter
+from processors import FileChangeHandler
+from processors.crawler import WATCHER_ERRORS, INDEX_ERRORS
+from processors.storage import atomic_write
+from processors.text_processing import normalize
+
+
+# Регрессионные проверки индекса: каждая получает пустой рабочий каталог и возвращает список ошибок
+
+
+def write_corpus(directory: str, texts: dict) -> list:
+    # {относительный путь: текст} -> пути созданных файлов в том же порядке
+    file_paths = []
+    for name, text in texts.items():
+        file_path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        file_paths.append(file_path)
+    return file_paths
+
+
+def wait_for(condition, seconds: float) -> bool:
+    deadline = time.monotonic() + seconds
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def check_filtered(name: str, indexer: VectorIndexer, expected: set, filters: list, k: int) -> list:
+    errors = []
+    for search_filter in filters:
+        for mode in ['vector', 'lexical', 'hybrid']:
+            try:
+                found = {result['path'] for result in
+                         VectorSearch(indexer=indexer, mode=mode).search('alpha', k, search_filter)}
+            except Exception as e:
+                errors.append(f"{name}, {mode}, {search_filter}: {e!r}")
+                continue
+            if not found or not found <= expected:
+                errors.append(f"{name}, {mode}, {search_filter}: найдены {sorted(found)}")
+    return errors
+
+
+def check_compaction_filters(args, work_dir: str) -> list:
+    # Фильтрованный поиск после уплотнения, которое выбросило векторы удалённых файлов, у писателя и у читателя
+    errors = []
+    for index_type in ['flat', 'hnsw']:
+        corpus = os.path.join(work_dir, index_type, "corpus")
+        file_paths = write_corpus(corpus, {os.path.join("sub" if n % 2 else "", f"doc{n}.txt"): f"alpha beta w{n}"
+                                           for n in range(args.documents)})
+        options = dict(watch_paths=[corpus], index_path=os.path.join(work_dir, index_type, "filters.faiss"),
+                       map_path=os.path.join(work_dir, index_type, "filters.pkl"), encoder=shared_encoder(),
+                       index_type=index_type)
+        indexer = VectorIndexer(**options)
+        removed = len(file_paths) // 2
+        indexer.remove_files(file_paths[:removed])
+        indexer.wait_for_compaction(0.01)
+        indexer.compact()
+        if indexer.stats()['dead']:
+            errors.append(f"{index_type}: после уплотнения остались удалённые векторы {indexer.stats()}")
+
+        live = set(file_paths[removed:])
+        filters = [SearchFilter(extensions=['.txt']), SearchFilter(prefix=os.path.join(corpus, "sub", ""))]
+        errors += check_filtered(f"{index_type}, писатель", indexer, live, filters, args.k)
+        # BM25 считает idf по всем живым документам: фильтр не меняет оценку оставшихся
+        scores, ids = indexer.search_lexical(normalize('alpha'), len(file_paths))
+        filtered_scores, filtered_ids = indexer.search_lexical(normalize('alpha'), len(file_paths),
+                                                               indexer.generation.allowed(filters[1]))
+        unfiltered = dict(zip(ids.tolist(), scores.tolist()))
+        if not len(filtered_ids) or any(abs(unfiltered[doc_id] - score) > 1e-5
+                                        for doc_id, score in zip(filtered_ids.tolist(), filtered_scores.tolist())):
+            errors.append(f"{index_type}: оценки BM25 с фильтром {filtered_scores} и без {scores}")
+        indexer.save_index()
+
+        # Файл метаданных новее таблицы документов: читатель не должен видеть ID, которых нет в его индексе
+        extra, = write_corpus(corpus, {"extra.txt": "alpha gamma"})
+        indexer.add_files([extra])
+        atomic_write(indexer.metadata_path, indexer._write_metadata)
+        reader = VectorIndexer(read_only=True, **options)
+        errors += check_filtered(f"{index_type}, читатель", reader, live, filters, args.k)
+        indexer.save_index()
+        errors += check_filtered(f"{index_type}, снова открытый", VectorIndexer(**options), live | {extra},
+                                 filters, args.k)
+    return errors
+
+
+class PoisonedEncoder:
+    # Падает на любом пакете с текстом, где есть слово poison, как кодировщик на битом файле
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.name = encoder.name
+        self.dimension = encoder.dimension
+
+    def encode(self, texts: list, batch_size=32) -> np.ndarray:
+        if any('poison' in text for text in texts):
+            raise ValueError("poisoned text")
+        return self.encoder.encode(texts, batch_size=batch_size)
+
+
+class FailingIndexer(VectorIndexer):
+    # add_files падает заданное число раз, как при ошибке записи журнала
+    failures = 0
+
+    def add_files(self, file_paths: list):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("simulated write failure")
+        super().add_files(file_paths)
+
+
+def check_watcher_errors(args, work_dir: str) -> list:
+    # Один плохой файл не должен терять свой блок, а ошибка применения событий - останавливать наблюдателя
+    errors = []
+    corpus = os.path.join(work_dir, "corpus")
+    good = write_corpus(corpus, {f"good{n}.txt": f"alpha w{n}" for n in range(args.documents)})
+    poisoned, = write_corpus(corpus, {"poisoned.txt": "poison alpha"})
+    index_errors = INDEX_ERRORS.value
+    indexer = FailingIndexer(watch_paths=[corpus], index_path=os.path.join(work_dir, "watcher.faiss"),
+                             map_path=os.path.join(work_dir, "watcher.pkl"),
+                             encoder=PoisonedEncoder(shared_encoder()))
+    missing = [file_path for file_path in good if file_path not in indexer.path_to_id]
+    if missing or poisoned in indexer.path_to_id or INDEX_ERRORS.value != index_errors + 1:
+        errors.append(f"начальная индексация: не проиндексированы {missing}, "
+                      f"плохой файл в индексе: {poisoned in indexer.path_to_id}")
+
+    handler = FileChangeHandler(indexer, debounce=0.05)
+    watcher_errors = WATCHER_ERRORS.value
+    indexer.failures = 1
+    lost, = write_corpus(corpus, {"lost.txt": "alpha lost"})
+    handler.on_created(FileCreatedEvent(lost))
+    if not wait_for(lambda: WATCHER_ERRORS.value > watcher_errors, 5):
+        errors.append("ошибка add_files не учтена в watcher_errors_total")
+
+    later = write_corpus(corpus, {"later.txt": "alpha later", "poison-again.txt": "poison later"})
+    for file_path in later:
+        handler.on_created(FileCreatedEvent(file_path))
+    if not wait_for(lambda: later[0] in indexer.path_to_id, 5):
+        errors.append(f"наблюдатель не применил события после ошибки, поток жив: {handler._worker.is_alive()}")
+    if later[1] in indexer.path_to_id:
+        errors.append("плохой файл попал в индекс через наблюдателя")
+    handler.stop()
+    indexer.close()
+    return errors
+
+
+def crash_writer(work_dir: str, file_paths: list, seed: int, snapshot_every: int, save_every: int):
+    # Пишет в журнал намерение перед каждой операцией и ok после sync; родитель убивает процесс в любой момент
+    logging.getLogger().setLevel(logging.WARNING)
+    rng = random.Random(seed)
+    indexer = fresh_indexer(work_dir, "crash", snapshot_every=snapshot_every)
+    with open(os.path.join(work_dir, "journal"), 'a', encoding='utf-8') as journal:
+        operations = 0
+        while True:
+            indexed = [file_path for file_path in file_paths if file_path in indexer.path_to_id]
+            if indexed and rng.random() < 0.3:
+                operation, file_path = '-', rng.choice(indexed)
+            else:
+                operation, file_path = '+', rng.choice(file_paths)
+            journal.write(f"? {operation}{file_path}\n")
+            journal.flush()
+            if operation == '+':
+                indexer.add_files([file_path])
+            else:
+                indexer.remove_files([file_path])
+            indexer.sync()
+            journal.write("ok\n")
+            journal.flush()
+            operations += 1
+            if operations % save_every == 0:
+                journal.write("save\n")
+                journal.flush()
+                indexer.save_index()
+                journal.write("saved\n")
+                journal.flush()
+
+
+def read_journal(file_path: str) -> tuple:
+    # Документы после всех подтвержденных операций и последняя операция без подтверждения
+    expected, pending, saving = set(), None, False
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f.read().splitlines():
+            if line.startswith('? '):
+                pending = line[2:]
+            elif line == 'ok' and pending is not None:
+                (expected.add if pending[0] == '+' else expected.discard)(pending[1:])
+                pending = None
+            else:
+                saving = line == 'save'
+    return expected, pending, saving
+
+
+def check_crash_recovery(args, work_dir: str) -> list:
+    # Процесс-писатель убивается во время append, sync и save_index; после каждого убийства индекс открывается
+    # заново и должен содержать все подтвержденные операции и не больше одной неподтвержденной
+    rng = random.Random(args.seed)
+    context = multiprocessing.get_context('fork')
+    errors = []
+    kills = {'random': 0, 'save_index': 0, 'torn tail': 0}
+    file_paths = write_corpus(os.path.join(work_dir, "corpus"),
+                              {f"doc{n}.txt": f"alpha u{n} u{n}x" for n in range(args.documents)})
+    journal_path = os.path.join(work_dir, "journal")
+
+    for round_number in range(args.rounds):
+        child = context.Process(target=crash_writer, args=(work_dir, file_paths, args.seed + round_number,
+                                                           args.snapshot_every, args.save_every))
+        child.start()
+        if round_number % 2:
+            # Убийство сразу после начала save_index: без ожидания или через несколько миллисекунд
+            wait_for(lambda: read_journal(journal_path)[2], 30)
+            time.sleep(rng.choice([0, 0.001, 0.003, 0.01]))
+        else:
+            time.sleep(rng.uniform(0.2, 1.0))
+        os.kill(child.pid, signal.SIGKILL)
+        child.join()
+
+        expected, pending, saving = read_journal(journal_path)
+        kills['save_index' if saving else 'random'] += 1
+        if round_number % 3 == 2:
+            # Оборванная последняя запись: заголовок и часть данных, которые не успели дописаться
+            with open(os.path.join(work_dir, "crash.faiss.log"), 'ab') as f:
+                f.write(bytes(rng.randrange(256) for _ in range(rng.randint(1, 64))))
+            kills['torn tail'] += 1
+
+        indexer = fresh_indexer(work_dir, "crash")
+        indexed = set(indexer.path_to_id)
+        allowed = [expected]
+        if pending is not None:
+            allowed.append(expected | {pending[1:]} if pending[0] == '+' else expected - {pending[1:]})
+        if indexed not in allowed:
+            errors.append(f"раунд {round_number}: лишние {sorted(indexed - expected)}, "
+                          f"потеряны {sorted(expected - indexed)}, незавершенная операция {pending}")
+        stats = indexer.stats()
+        if stats['live'] != len(indexed) or stats['total'] - stats['dead'] != len(indexed) \
+                or len(indexer.lexical) != len(indexed):
+            errors.append(f"раунд {round_number}: документов {len(indexed)}, векторы {stats}, "
+                          f"BM25 {len(indexer.lexical)}")
+        search_engine = VectorSearch(indexer=indexer)
+        for file_path in sorted(indexed):
+            word = f"u{file_paths.index(file_path)}"
+            found = [result['path'] for result in search_engine.search(f"{word} {word}x", 1)]
+            if found != [file_path]:
+                errors.append(f"раунд {round_number}: по запросу {word} найдено {found} вместо {file_path}")
+        indexer.close()
+        # Следующий процесс продолжает с восстановленным состоянием, поэтому журнал начинается заново
+        with open(journal_path, 'w', encoding='utf-8') as f:
+            f.writelines(f"? +{file_path}\nok\n" for file_path in sorted(indexed))
+
+    print(f"Раундов: {args.rounds}, убийств во время save_index: {kills['save_index']}, в произвольный момент: "
+          f"{kills['random']}, оборванных записей журнала: {kills['torn tail']}")
+    return errors
+
+
+def open_descriptors() -> int:
+    return len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else 0
+
+
+def check_read_only_refresh(args, work_dir: str) -> list:
+    # Изменения, применённые наблюдателем писателя, видны процессу-читателю без остановки писателя
+    errors = []
+    corpus = os.path.join(work_dir, "corpus")
+    file_paths = write_corpus(corpus, {f"doc{n}.txt": f"alpha w{n}" for n in range(args.documents)})
+    options = dict(watch_paths=[corpus], index_path=os.path.join(work_dir, "refresh.faiss"),
+                   map_path=os.path.join(work_dir, "refresh.pkl"), encoder=shared_encoder())
+    writer = VectorIndexer(snapshot_interval=args.interval, **options)
+    writer.save_index()
+    reader = VectorIndexer(read_only=True, **options)
+    handler = FileChangeHandler(writer, debounce=0.05, flush_interval=0.1)
+
+    added, = write_corpus(corpus, {"added.txt": "alpha gamma"})
+    handler.on_created(FileCreatedEvent(added))
+    os.remove(file_paths[0])
+    handler.on_deleted(FileDeletedEvent(file_paths[0]))
+
+    def visible() -> bool:
+        # snapshot() перечитывает снимок, если писатель сохранил новый
+        reader.snapshot()
+        return added in reader.path_to_id and file_paths[0] not in reader.path_to_id
+
+    started = time.monotonic()
+    if wait_for(visible, args.interval + 5):
+        print(f"Изменения видны читателю через {time.monotonic() - started:.2f} с")
+    else:
+        errors.append(f"читатель не увидел изменений за {args.interval + 5} с, новый файл в индексе: "
+                      f"{added in reader.path_to_id}, удалённый файл в индексе: {file_paths[0] in reader.path_to_id}")
+    found = [hit['path'] for hit in VectorSearch(indexer=reader, mode='hybrid').search('gamma', 1)]
+    if found != [added]:
+        errors.append(f"поиск читателя по gamma нашёл {found}")
+    handler.stop()
+    writer.close()
+    return errors
+
+
+def check_id_churn(args, work_dir: str) -> list:
+    # Файлы много раз переиндексируются с новыми ID: строки метаданных и длины документов BM25 должны оставаться
+    # порядка числа живых документов, а не наибольшего выданного ID, а фильтры - работать у писателя и у читателя
+    errors = []
+    corpus = os.path.join(work_dir, "corpus")
+    names = [os.path.join("sub" if n % 2 else "", f"doc{n}.txt") for n in range(args.documents)]
+    options = dict(watch_paths=[corpus], index_path=os.path.join(work_dir, "churn.faiss"),
+                   map_path=os.path.join(work_dir, "churn.pkl"), encoder=shared_encoder())
+    indexer = VectorIndexer(**options)
+    for round_number in range(args.rounds):
+        file_paths = write_corpus(corpus, {name: f"alpha beta w{n} r{round_number}" for n, name in enumerate(names)})
+        indexer.add_files(file_paths)
+    indexer.save_index()
+    reader = VectorIndexer(read_only=True, **options)
+
+    # Не больше доли compaction_threshold удалённых строк
+    limit = int(args.documents / (1 - indexer.metadata.compaction_threshold)) + 1
+    print(f"Выдано ID: {indexer.next_id}, живых документов: {len(indexer.id_to_path)}, строк метаданных: "
+          f"{indexer.metadata.count}, у читателя: {reader.metadata.count}, строк BM25: {len(indexer.lexical.lengths)}, "
+          f"у читателя: {len(reader.lexical.lengths)}")
+    for name, searched in [('писатель', indexer), ('читатель', reader)]:
+        if searched.metadata.count > limit or len(searched.lexical.lengths) > limit:
+            errors.append(f"{name}: {searched.metadata.count} строк метаданных и {len(searched.lexical.lengths)} "
+                          f"строк BM25 при {args.documents} документах")
+    live = set(file_paths)
+    filters = [SearchFilter(extensions=['.txt']), SearchFilter(prefix=os.path.join(corpus, "sub", ""))]
+    for name, searched in [('писатель', indexer), ('читатель', reader)]:
+        errors += check_filtered(name, searched, live, filters, args.documents)
+        allowed = searched.snapshot().allowed(filters[1])
+        expected = sorted(searched.path_to_id.get(file_path) for file_path in file_paths
+                          if file_path.startswith(filters[1].prefix))
+        if allowed.tolist() != expected:
+            errors.append(f"{name}: фильтр по префиксу пропускает ID {allowed.tolist()} вместо {expected}")
+    indexer.close()
+    return errors
+
+
+def check_shard_reload(args, work_dir: str) -> list:
+    # Перечитывание и перестройка шарда: старый шард закрывается, его файлы (и .meta) удаляются при перестройке,
+    # фильтры и поиск работают по новому шарду
+    errors = []
+    roots = [os.path.join(work_dir, "a"), os.path.join(work_dir, "b")]
+    for root in roots:
+        write_corpus(root, {os.path.join("sub" if n % 2 else "", f"doc{n}.txt"): f"alpha beta w{n}"
+                            for n in range(args.documents)})
+    indexer = ShardedIndexer(watch_paths=roots, index_path=os.path.join(work_dir, "reload.faiss"),
+                             map_path=os.path.join(work_dir, "reload.pkl"), encoder=shared_encoder())
+    observer = Observer()
+    indexer.watch(observer)
+    observer.start()
+    root = roots[0]
+    search_engine = ShardedSearch(indexer=indexer, mode='hybrid')
+    filters = [SearchFilter(extensions=['.txt']), SearchFilter(prefix=os.path.join(root, "sub", ""))]
+
+    # Удалённые без ведома индекса файлы: перестроенный шард не должен помнить их ни в картах, ни в .meta
+    removed = [os.path.join(root, "sub", f"doc{n}.txt") for n in range(1, args.documents, 2)][:args.documents // 4]
+    observer.unschedule_all()
+    for file_path in removed:
+        os.remove(file_path)
+    expected = {os.path.join(dirpath, file) for dirpath, _, files in os.walk(root) for file in files}
+
+    descriptors = None
+    for rebuild in [False, True] * args.rounds:
+        old = indexer.shards[root]
+        shard = indexer.reload_shard(root, rebuild=rebuild)
+        name = 'перестройка' if rebuild else 'перечитывание'
+        if old.changelog._file is not None or old.cache.db is not None:
+            errors.append(f"{name}: старый шард не закрыт")
+        if rebuild and set(shard.path_to_id) != expected:
+            errors.append(f"{name}: в шарде {len(shard.path_to_id)} файлов вместо {len(expected)}")
+        errors += check_filtered(f"{name}", shard, expected, filters, args.documents)
+        for search_filter in filters:
+            found = {hit['path'] for hit in search_engine.search('alpha', args.documents, search_filter)}
+            if not found or (found & set(removed) and rebuild):
+                errors.append(f"{name}, ShardedSearch, {search_filter}: найдены {sorted(found)}")
+        # После первого круга число открытых файлов не должно расти
+        if descriptors is None and rebuild:
+            descriptors = open_descriptors()
+    if open_descriptors() > descriptors:
+        errors.append(f"открытых файлов было {descriptors}, стало {open_descriptors()}")
+    observer.stop()
+    observer.join()
+    indexer.stop()
+    return errors
+
+
+def check_shard_fusion(args, work_dir: str) -> list:
+    # Шард только с посторонними документами: ShardedSearch должен ранжировать как один индекс по тем же файлам,
+    # а не ставить лучшие документы каждого шарда рядом по их собственным рангам и статистикам BM25
+    errors = []
+    roots = [os.path.join(work_dir, "a"), os.path.join(work_dir, "b")]
+    # У каждого документа своя длина, чтобы оценки не совпадали и порядок не зависел от разрешения равенств
+    def filler(length: int) -> str:
+        return " ".join(f"f{length}x{m}" for m in range(length))
+
+    documents = args.documents
+    write_corpus(roots[0], {f"hit{n}.txt": f"alpha beta {filler(n)}" for n in range(documents)})
+    write_corpus(roots[0], {f"vec{n}.txt": f"alphas betas {filler(documents + n)}" for n in range(documents // 2)})
+    write_corpus(roots[1], {f"junk{n}.txt": f"banana recipe cake {'beta ' * (n % 2)}{filler(2 * documents + n)}"
+                            for n in range(documents)})
+    sharded = ShardedIndexer(watch_paths=roots, index_path=os.path.join(work_dir, "sharded.faiss"),
+                             map_path=os.path.join(work_dir, "sharded.pkl"), encoder=shared_encoder())
+    single = VectorIndexer(watch_paths=roots, index_path=os.path.join(work_dir, "single.faiss"),
+                           map_path=os.path.join(work_dir, "single.pkl"), encoder=shared_encoder())
+    def ranked(hits: list) -> list:
+        return [(os.path.basename(hit['path']), round(hit['score'], 4)) for hit in hits]
+
+    for mode in ['vector', 'lexical', 'hybrid']:
+        sharded_search = ShardedSearch(indexer=sharded, mode=mode)
+        single_search = VectorSearch(indexer=single, mode=mode)
+        for query in ['alpha', 'alpha beta', 'beta']:
+            expected = single_search.search(query, args.k)
+            found = sharded_search.search(query, args.k)
+            if [hit['path'] for hit in found] != [hit['path'] for hit in expected] or \
+                    any(abs(a['score'] - b['score']) > 1e-5 for a, b in zip(found, expected)):
+                errors.append(f"{mode}, '{query}': шарды {ranked(found)}, один индекс {ranked(expected)}")
+    sharded.stop()
+    single.close()
+    return errors
+
+
+def check_layout_hysteresis(args, work_dir: str) -> list:
+    # Число документов колеблется около порогов IVF и сжатия: переход обратно к flat/float32 только ниже
+    # доли layout_hysteresis от порога, а не при каждом уплотнении
+    errors = []
+    file_paths = write_corpus(os.path.join(work_dir, "corpus"), {f"doc{n}.txt": f"alpha w{n} w{n % 7} w{n % 11}"
+                                                                 for n in range(args.threshold * 2)})
+    indexer = fresh_indexer(work_dir, "layouts", index_type='ivf', ivf_threshold=args.threshold, encoding='sq8',
+                            compress_threshold=args.threshold, compaction_threshold=1.0)
+
+    def settle(count: int):
+        indexed = set(indexer.path_to_id)
+        indexer.add_files([file_path for file_path in file_paths[:count] if file_path not in indexed])
+        indexer.remove_files([file_path for file_path in file_paths[count:] if file_path in indexed])
+        indexer.wait_for_compaction(0.01)
+        if indexer._needs_rebuild():
+            indexer.compact()
+        return indexer.index_layout
+
+    hysteresis = indexer.layout_hysteresis
+    # (документов, ожидаемая схема): выше порога, чуть ниже, снова выше, ниже доли hysteresis
+    steps = [(args.threshold + 10, ('ivf', 'sq8')), (args.threshold - 5, ('ivf', 'sq8')),
+             (args.threshold + 5, ('ivf', 'sq8')), (int(args.threshold * hysteresis) - 5, ('flat', 'float32')),
+             (args.threshold - 5, ('flat', 'float32')), (args.threshold + 5, ('ivf', 'sq8'))]
+    rebuilds = 0
+    for count, expected in steps:
+        before = indexer.index_layout
+        layout = settle(count)
+        rebuilds += layout != before
+        print(f"{count:6d} документов: {layout}")
+        if layout != expected:
+            errors.append(f"{count} документов: схема {layout}, ожидалась {expected}")
+    print(f"Смен схемы индекса: {rebuilds}")
+    indexer.close()
+    return errors
+
+
+def run_check(args) -> int:
+    with tempfile.TemporaryDirectory() as work_dir:
+        errors = args.func(args, work_dir)
+    for error in errors:
+        print(error)
+    print(f"{args.command}: ошибок {len(errors)}")
+    return len(errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Регрессионные проверки индексации и поиска")
+    parser.add_argument("--encoder", default='hashing-384',
+                        help="модель sentence-transformers, '<модель>:int8' или 'hashing-384' без сети и модели")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("all", help="все проверки с параметрами по умолчанию")
+
+    compaction_filters = subparsers.add_parser("compaction-filters",
+                                               help="фильтры после уплотнения индекса и у процесса-читателя")
+    compaction_filters.add_argument("--documents", type=int, default=20)
+    compaction_filters.add_argument("-k", type=int, default=5)
+    compaction_filters.set_defaults(func=check_compaction_filters)
+
+    watcher_errors = subparsers.add_parser("watcher-errors",
+                                           help="ошибки кодировщика и применения событий не останавливают индексацию")
+    watcher_errors.add_argument("--documents", type=int, default=5)
+    watcher_errors.set_defaults(func=check_watcher_errors)
+
+    crash = subparsers.add_parser("crash-recovery",
+                                  help="убийство процесса-писателя во время записи и восстановление индекса")
+    crash.add_argument("--documents", type=int, default=50)
+    crash.add_argument("--rounds", type=int, default=12)
+    crash.add_argument("--snapshot-every", type=int, default=16, help="записей журнала до снимка при sync")
+    crash.add_argument("--save-every", type=int, default=7, help="операций между явными save_index")
+    crash.add_argument("--seed", type=int, default=0)
+    crash.set_defaults(func=check_crash_recovery)
+
+    refresh = subparsers.add_parser("read-only-refresh", help="читатель видит изменения писателя без его остановки")
+    refresh.add_argument("--documents", type=int, default=10)
+    refresh.add_argument("--interval", type=float, default=1.0, help="snapshot_interval писателя, с")
+    refresh.set_defaults(func=check_read_only_refresh)
+
+    churn = subparsers.add_parser("id-churn", help="размер метаданных при многократной переиндексации файлов")
+    churn.add_argument("--documents", type=int, default=20)
+    churn.add_argument("--rounds", type=int, default=50)
+    churn.set_defaults(func=check_id_churn)
+
+    reload_parser = subparsers.add_parser("shard-reload", help="перечитывание и перестройка шарда без утечек")
+    reload_parser.add_argument("--documents", type=int, default=20)
+    reload_parser.add_argument("--rounds", type=int, default=3)
+    reload_parser.set_defaults(func=check_shard_reload)
+
+    fusion = subparsers.add_parser("shard-fusion", help="ShardedSearch ранжирует как один индекс по тем же файлам")
+    fusion.add_argument("--documents", type=int, default=12)
+    fusion.add_argument("-k", type=int, default=12)
+    fusion.set_defaults(func=check_shard_fusion)
+
+    layouts = subparsers.add_parser("layout-hysteresis", help="переходы flat/IVF и float32/sq8 около порогов")
+    layouts.add_argument("--threshold", type=int, default=300)
+    layouts.set_defaults(func=check_layout_hysteresis)
+
+    args = parser.parse_args()
+    benchmark.ENCODER_NAME = args.encoder
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.command == 'all':
+        commands = [name for name in subparsers.choices if name != 'all']
+        failed = sum(run_check(parser.parse_args(['--encoder', args.encoder, name])) for name in commands)
+    else:
+        failed = run_check(args)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import resource
+import tempfile
+
+import numpy as np
+
+from processors import VectorIndexer, VectorSearch
+from processors.metrics import BatchMetricsCalculator, plot_11_point_curve
+
+# Показатели, которые --baseline сравнивает с прошлым запуском
+COMPARED = [('quality', 'MAP'), ('quality', 'Precision@5'), ('quality', 'Precision@10'), ('quality', 'R-Precision'),
+            ('quality', 'Recall'), ('latency', 'qps'), ('latency', 'p99_ms'), ('memory', 'peak_rss_mb')]
+
+
+def load_judgements(path: str) -> list:
+    # JSON Lines: {"query": "...", "relevant": ["local_fs/doc1.txt", ...]}
+    judgements = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not isinstance(item.get('query'), str) or not isinstance(item.get('relevant'), list):
+                sys.exit(f"{path}:{line_number}: нужны поля 'query' (строка) и 'relevant' (список путей)")
+            judgements.append((item['query'], [os.path.normpath(p) for p in item['relevant']]))
+    return judgements
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def build_index(args, work_dir: str) -> tuple:
+    started = time.perf_counter()
+    indexer = VectorIndexer(watch_paths=args.paths, index_path=os.path.join(work_dir, "eval.faiss"),
+                            map_path=os.path.join(work_dir, "eval.pkl"), model_name=args.encoder,
+                            cache_path=args.cache, index_type=args.index_type, ivf_threshold=args.ivf_threshold,
+                            encoding=args.encoding, compress_threshold=args.compress_threshold, rerank=args.rerank,
+                            chunk_tokens=args.chunk_tokens, chunk_overlap=args.chunk_overlap)
+    # Переход на IVF и сжатые коды выполняет фоновое уплотнение после начальной индексации
+    indexer.wait_for_compaction()
+    return indexer, time.perf_counter() - started
+
+
+def run_queries(search_engine: VectorSearch, queries: list, top_k: int, batch: int) -> tuple:
+    results, batch_ms, stages = [], [], {}
+    started = time.perf_counter()
+    for start in range(0, len(queries), batch):
+        batch_started = time.perf_counter()
+        results += search_engine.search_many(queries[start:start + batch], top_k)
+        batch_ms.append((time.perf_counter() - batch_started) * 1000)
+        for stage, seconds in search_engine.timings.items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+    elapsed = time.perf_counter() - started
+
+    latency = {'qps': len(queries) / elapsed, 'seconds': elapsed, 'batch': batch,
+               'p50_ms': float(np.percentile(batch_ms, 50)), 'p99_ms': float(np.percentile(batch_ms, 99)),
+               # normalize и encode - подготовка запроса, vector/lexical - поиск, collect - подсветка найденных слов
+               'stages_ms_per_query': {stage: seconds * 1000 / len(queries) for stage, seconds in stages.items()}}
+    return results, latency
+
+
+def compare(report: dict, baseline_path: str):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nСравнение с {baseline_path}:")
+    for section, name in COMPARED:
+        old, new = baseline.get(section, {}).get(name), report[section].get(name)
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+7.1f}%" if old else ""
+        print(f"    {name:<14}: {old:10.4f} -> {new:10.4f} {change}")
+
+
+def evaluate(args):
+    judgements = load_judgements(args.judgements)
+    if not judgements:
+        sys.exit("В файле оценок нет запросов.")
+    queries = [query for query, _ in judgements]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        indexer, build_seconds = build_index(args, work_dir)
+        stats = indexer.stats()
+        documents = len(indexer.path_to_id)
+        build_rss = peak_rss_mb()
+
+        search_engine = VectorSearch(indexer=indexer, mode=args.mode, prefilter=args.prefilter)
+        if args.warmup:
+            search_engine.search_many(queries[:args.batch], args.top_k)
+        results, latency = run_queries(search_engine, queries, args.top_k, args.batch)
+
+        # Оценки и результаты сравниваются по нормализованным путям, значит и пути индекса тоже
+        indexed = {os.path.normpath(path) for path in indexer.path_to_id}
+        missing = sum(1 for _, relevant in judgements for path in relevant if path not in indexed)
+        indexer.close()
+
+    # Пути результатов приводятся к тому же виду, что и пути в оценках
+    results = [[{**result, 'path': os.path.normpath(result['path'])} for result in query_results]
+               for query_results in results]
+    metrics = BatchMetricsCalculator(results, [relevant for _, relevant in judgements], k_values=args.k_values)
+    per_query = metrics.per_query()
+
+    report = {
+        'config': {name: getattr(args, name) for name in
+                   ['paths', 'judgements', 'encoder', 'index_type', 'encoding', 'rerank', 'chunk_tokens',
+                    'chunk_overlap', 'mode', 'prefilter', 'top_k', 'batch']},
+        'corpus': {'documents': documents, 'vectors': stats, 'build_seconds': build_seconds,
+                   'docs_per_second': documents / build_seconds if build_seconds else 0.0,
+                   'judged_paths_not_indexed': missing},
+        'quality': metrics.summary(),
+        'latency': latency,
+        'memory': {'peak_rss_mb_after_build': build_rss, 'peak_rss_mb': peak_rss_mb()},
+        'queries': [{'query': query, 'average_precision': float(per_query['Average Precision'][row]),
+                     'found': [result['path'] for result in results[row]]}
+                    for row, query in enumerate(queries)],
+    }
+    report['quality']['queries'] = len(queries)
+
+    quality = report['quality']
+    print(f"Документов: {documents}, запросов: {len(queries)}, индекс: {stats}, "
+          f"построение {build_seconds:.2f} s ({report['corpus']['docs_per_second']:.1f} docs/sec)")
+    if missing:
+        print(f"Оцененных путей нет в индексе: {missing}")
+    print(f"MAP {quality['MAP']:.4f}, " + ", ".join(f"P@{k} {quality[f'Precision@{k}']:.4f}" for k in args.k_values)
+          + f", R-Precision {quality['R-Precision']:.4f}, Recall@{args.top_k} {quality['Recall']:.4f}")
+    print("11 точек: " + " ".join(f"{precision:.3f}" for precision in quality['11-point']))
+    print(f"{latency['qps']:.1f} QPS, пакет p50 {latency['p50_ms']:.2f} ms, p99 {latency['p99_ms']:.2f} ms; "
+          "ms/запрос по стадиям: " + ", ".join(f"{stage} {ms:.3f}"
+                                               for stage, ms in latency['stages_ms_per_query'].items()))
+    print(f"Пиковая память: {report['memory']['peak_rss_mb']:.1f} MB")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Отчет сохранен в файл: {args.output}")
+    if args.baseline:
+        compare(report, args.baseline)
+    if args.plot:
+        plot_11_point_curve(quality['11-point'], args.plot)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Оценка качества и скорости поиска по набору запросов с эталонами")
+    parser.add_argument("judgements", help="JSON Lines: {\"query\": ..., \"relevant\": [пути]} в каждой строке")
+    parser.add_argument("paths", nargs="+", help="папки корпуса; пути в оценках указываются так же")
+    parser.add_argument("--encoder", default='all-mpnet-base-v2')
+    parser.add_argument("--cache", help="кэш эмбеддингов между запусками (по умолчанию - временный)")
+    parser.add_argument("--index-type", default='flat', choices=['flat', 'ivf', 'hnsw'])
+    parser.add_argument("--ivf-threshold", type=int, default=50000, help="число векторов, с которого строится IVF")
+    parser.add_argument("--encoding", default='float32', choices=['float32', 'fp16', 'sq8', 'pq'])
+    parser.add_argument("--compress-threshold", type=int, default=20000)
+    parser.add_argument("--rerank", type=int, default=0)
+    parser.add_argument("--chunk-tokens", type=int, default=0)
+    parser.add_argument("--chunk-overlap", type=int, default=32)
+    parser.add_argument("--mode", default='vector', choices=['vector', 'lexical', 'hybrid'])
+    parser.add_argument("--prefilter", type=int, default=0)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--k-values", type=int, nargs="+", default=[5, 10])
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--warmup", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--output", help="файл для JSON-отчета")
+    parser.add_argument("--baseline", help="JSON-отчет прошлого запуска для сравнения")
+    parser.add_argument("--plot", help="сохранить усредненный 11-точечный график в файл (нужен matplotlib)")
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    evaluate(args)
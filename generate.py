@@ -0,0 +1,247 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Слова словаря собираются из слогов: номер слова в системе счисления по числу слогов
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'be', 'da', 'fi', 'go', 'hu', 'ja', 'ke', 'li',
+             'mo', 'nu', 'pa', 're', 'si', 'to', 'ul', 'ver', 'wa', 'xi', 'yo', 'ze', 'an', 'el', 'in', 'or']
+SENTENCE_WORDS = 12
+# Смещения номеров документов, из которых берется текст созданных и измененных при churn файлов
+CREATED_TEXTS = 10**9
+MODIFIED_TEXTS = 2 * 10**9
+# Независимые потоки случайных чисел: seed, поток и номер документа вместе задают генератор
+TEXT, QUERY, DIRECTORY, DUPLICATE, CHURN = range(5)
+
+
+def make_word(number: int) -> str:
+    number += len(SYLLABLES)
+    syllables = []
+    while number:
+        number, digit = divmod(number, len(SYLLABLES))
+        syllables.append(SYLLABLES[digit])
+    return ''.join(reversed(syllables))
+
+
+class TextGenerator:
+    def __init__(self, seed=0, vocabulary=50000, zipf=1.0, median_words=300, sigma=0.8, max_words=20000):
+        self.seed = seed
+        self.words = np.array([make_word(number) for number in range(vocabulary)], dtype=object)
+        # Частоты слов по закону Ципфа, как в естественном тексте; выборка - поиск по накопленным весам
+        weights = 1.0 / np.arange(1, vocabulary + 1) ** zipf
+        self.cumulative = np.cumsum(weights) / weights.sum()
+        self.median_words = median_words
+        self.sigma = sigma
+        self.max_words = max_words
+
+    def text(self, number: int) -> str:
+        # Текст зависит только от seed и номера, поэтому документы можно писать параллельно в любом порядке
+        rng = np.random.default_rng([self.seed, TEXT, number])
+        length = int(np.clip(rng.lognormal(np.log(self.median_words), self.sigma), 1, self.max_words))
+        tokens = self.words[np.searchsorted(self.cumulative, rng.random(length))]
+        return '.\n'.join(' '.join(tokens[start:start + SENTENCE_WORDS])
+                          for start in range(0, length, SENTENCE_WORDS)) + '.\n'
+
+    def query(self, number: int) -> str:
+        # Два-три слова из средней части словаря: не стоп-слова, но и не слова из одного документа
+        rng = np.random.default_rng([self.seed, QUERY, number])
+        ranks = rng.integers(len(self.words) // 100, len(self.words) // 10, size=rng.integers(2, 4))
+        return ' '.join(self.words[ranks])
+
+
+def make_text_generator(args) -> TextGenerator:
+    return TextGenerator(args.seed, args.vocabulary, args.zipf, args.median_words, args.sigma, args.max_words)
+
+
+def document_directory(seed: int, number: int, fanout: int, depth: int) -> str:
+    rng = np.random.default_rng([seed, DIRECTORY, number])
+    return os.path.join(*[f"d{branch:03d}" for branch in rng.integers(fanout, size=depth)]) if depth else ''
+
+
+def document_source(seed: int, number: int, duplicates: float) -> int:
+    # Дубликат повторяет текст одного из предыдущих документов байт в байт
+    rng = np.random.default_rng([seed, DUPLICATE, number])
+    return int(rng.integers(number)) if number and rng.random() < duplicates else number
+
+
+text_generator = None
+
+
+def init_writer(args):
+    global text_generator
+    text_generator = make_text_generator(args)
+
+
+def write_documents(output: str, numbers: range, args) -> tuple:
+    written = duplicated = 0
+    for number in numbers:
+        source = document_source(args.seed, number, args.duplicates)
+        file_path = os.path.join(output, document_directory(args.seed, number, args.fanout, args.depth),
+                                 f"doc{number:07d}.txt")
+        with open(file_path, 'w', encoding='utf-8') as f:
+            written += f.write(text_generator.text(source))
+        duplicated += source != number
+    return len(numbers), written, duplicated
+
+
+def write_corpus(output: str, args) -> dict:
+    started = time.perf_counter()
+    for number in range(args.fanout ** args.depth):
+        branches = []
+        for _ in range(args.depth):
+            number, branch = divmod(number, args.fanout)
+            branches.append(f"d{branch:03d}")
+        os.makedirs(os.path.join(output, *branches), exist_ok=True)
+
+    # Документы пишутся блоками в нескольких процессах; блоки не пересекаются, и результат от их числа не зависит
+    block = args.block
+    documents = characters = duplicates = 0
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=init_writer, initargs=(args,)) as pool:
+        futures = [pool.submit(write_documents, output, range(start, min(start + block, args.documents)), args)
+                   for start in range(0, args.documents, block)]
+        for future in futures:
+            count, written, duplicated = future.result()
+            documents += count
+            characters += written
+            duplicates += duplicated
+    return {'documents': documents, 'characters': characters, 'duplicates': duplicates,
+            'seconds': time.perf_counter() - started}
+
+
+def write_queries(file_path: str, args):
+    generator = make_text_generator(args)
+    with open(file_path, 'w', encoding='utf-8') as f:
+        for number in range(args.query_count):
+            f.write(generator.query(number) + '\n')
+
+
+class Churn:
+    def __init__(self, paths: list, args):
+        self.paths = paths
+        self.generator = make_text_generator(args)
+        self.rng = np.random.default_rng([args.seed, CHURN])
+        self.operations = ['create', 'modify', 'delete', 'move']
+        self.mix = np.array(args.mix, dtype='float64') / sum(args.mix)
+        self.burst_size = args.burst_size
+        # Отсортированные списки, чтобы при том же seed и корпусе повторялась та же последовательность операций
+        self.files = sorted(os.path.join(root, file) for path in paths
+                            for root, _, files in os.walk(path) for file in files)
+        self.directories = sorted({os.path.dirname(file_path) for file_path in self.files} or set(paths))
+        self.counter = 0
+        self.counts = dict.fromkeys(self.operations, 0)
+
+    def _new_path(self) -> str:
+        directory = self.directories[self.rng.integers(len(self.directories))]
+        # Файлы прошлых запусков churn не перезаписываются
+        while True:
+            self.counter += 1
+            file_path = os.path.join(directory, f"churn{self.counter:07d}.txt")
+            if not os.path.exists(file_path):
+                return file_path
+
+    def _take(self) -> str:
+        # Случайный файл убирается из списка заменой на последний
+        position = int(self.rng.integers(len(self.files)))
+        self.files[position], self.files[-1] = self.files[-1], self.files[position]
+        return self.files.pop()
+
+    def burst(self) -> int:
+        for operation in self.rng.choice(self.operations, size=self.burst_size, p=self.mix):
+            if operation != 'create' and not self.files:
+                operation = 'create'
+            if operation == 'create':
+                file_path = self._new_path()
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(self.generator.text(CREATED_TEXTS + self.counter))
+                self.files.append(file_path)
+            elif operation == 'modify':
+                file_path = self.files[self.rng.integers(len(self.files))]
+                self.counter += 1
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(self.generator.text(MODIFIED_TEXTS + self.counter))
+            elif operation == 'delete':
+                os.remove(self._take())
+            else:
+                file_path = self._new_path()
+                os.replace(self._take(), file_path)
+                self.files.append(file_path)
+            self.counts[operation] += 1
+        return self.burst_size
+
+    def run(self, bursts: int, interval: float, stop=None) -> int:
+        done = 0
+        for _ in range(bursts):
+            if stop is not None and stop.is_set():
+                break
+            done += self.burst()
+            time.sleep(interval)
+        return done
+
+
+def add_text_arguments(parser):
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--zipf", type=float, default=1.0, help="показатель закона Ципфа для частот слов")
+    parser.add_argument("--median-words", type=int, default=300, help="медиана логнормального размера документа")
+    parser.add_argument("--sigma", type=float, default=0.8, help="разброс логнормального размера документа")
+    parser.add_argument("--max-words", type=int, default=20000)
+
+
+def add_corpus_arguments(parser):
+    add_text_arguments(parser)
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--fanout", type=int, default=16, help="подпапок на каждом уровне")
+    parser.add_argument("--depth", type=int, default=2, help="уровней вложенных папок")
+    parser.add_argument("--duplicates", type=float, default=0.05, help="доля документов-копий")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--block", type=int, default=1000, help="документов в задании одного процесса")
+
+
+def add_churn_arguments(parser):
+    parser.add_argument("--bursts", type=int, default=100)
+    parser.add_argument("--burst-size", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.5, help="пауза между пачками, секунд")
+    parser.add_argument("--mix", type=float, nargs=4, default=[0.3, 0.4, 0.15, 0.15],
+                        metavar=('CREATE', 'MODIFY', 'DELETE', 'MOVE'), help="доли операций в пачке")
+
+
+def generate_corpus(args):
+    stats = write_corpus(args.output, args)
+    print(f"Записано документов: {stats['documents']} (копий: {stats['duplicates']}), "
+          f"{stats['characters'] / 2**20:.1f} M символов за {stats['seconds']:.2f} s "
+          f"({stats['documents'] / stats['seconds']:.0f} docs/sec) в папку {args.output}")
+    if args.queries:
+        write_queries(args.queries, args)
+        print(f"Запросы сохранены в файл: {args.queries}")
+
+
+def generate_churn(args):
+    churn = Churn(args.paths, args)
+    started = time.perf_counter()
+    done = churn.run(args.bursts, args.interval)
+    elapsed = time.perf_counter() - started
+    print(f"Операций: {done} за {elapsed:.2f} s ({done / elapsed:.0f} ops/sec): "
+          + ", ".join(f"{operation} {count}" for operation, count in churn.counts.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Синтетический корпус и поток изменений для нагрузочных тестов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    corpus = subparsers.add_parser("corpus", help="записать корпус документов, одинаковый при том же seed")
+    corpus.add_argument("output")
+    add_corpus_arguments(corpus)
+    corpus.add_argument("--queries", help="файл для запросов по словарю корпуса, по одному в строке")
+    corpus.add_argument("--query-count", type=int, default=200)
+    corpus.set_defaults(func=generate_corpus)
+
+    churn = subparsers.add_parser("churn", help="пачки создания, изменения, удаления и переноса файлов")
+    churn.add_argument("paths", nargs="+")
+    add_text_arguments(churn)
+    add_churn_arguments(churn)
+    churn.set_defaults(func=generate_churn)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,71 +1,196 @@
 import os
+import time
+import asyncio
 import logging
 import uvicorn
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse
+from typing import List, Optional
+from pydantic import BaseModel, Field
+from fastapi import FastAPI, Request, Response, Form, HTTPException
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from watchdog.observers import Observer
-from processors import VectorIndexer, VectorSearch, FileChangeHandler 
+from processors import ShardedIndexer, ShardedSearch, QueryBatcher, SearchFilter, REGISTRY
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 PATHS_TO_WATCH = ["local_fs", "local_fs2"]
 INDEX_PATH = "processors/vector_index.faiss"
 MAP_PATH = "processors/path_map.pkl"
+QUERY_BATCH_WINDOW_MS = 5
+QUERY_BATCH_MAX = 32
+# Ограничения JSON API: запросов в одном вызове и глубина постраничной выдачи
+API_MAX_QUERIES = 64
+API_MAX_RESULTS = 1000
+# Длинные файлы индексируются окнами по CHUNK_TOKENS слов с перекрытием CHUNK_OVERLAP
+CHUNK_TOKENS = 256
+CHUNK_OVERLAP = 32
+# Кодировщик: модель sentence-transformers, "<модель>:int8" (квантованная для CPU)
+# или "hashing-384" (детерминированный, без сети и файлов модели)
+ENCODER = os.environ.get("SEARCH_ENCODER", "all-mpnet-base-v2")
+# Гибридный поиск: векторный и лексический (BM25) с объединением рейтингов
+SEARCH_MODE = "hybrid"
+# У каждой папки свой шард индекса (processors/vector_index.<папка>.faiss и т. д.)
+# Процессы-читатели (например, воркеры uvicorn) только отображают в память снимок индекса,
+# который пишет единственный процесс main.py
+READ_ONLY = os.environ.get("SEARCH_READ_ONLY") == "1"
 
-for path in PATHS_TO_WATCH:
-    if not os.path.exists(path):
-        logging.warning(f"Папка '{path}' не найдена. Создаю пустую папку.")
-        os.makedirs(path)
+if READ_ONLY:
+    logging.info("Открытие индекса только для чтения...")
+    indexer = ShardedIndexer(watch_paths=PATHS_TO_WATCH, index_path=INDEX_PATH, map_path=MAP_PATH, read_only=True,
+                             model_name=ENCODER, chunk_tokens=CHUNK_TOKENS, chunk_overlap=CHUNK_OVERLAP)
+    observer = None
+else:
+    for path in PATHS_TO_WATCH:
+        if not os.path.exists(path):
+            logging.warning(f"Папка '{path}' не найдена. Создаю пустую папку.")
+            os.makedirs(path)
 
-logging.info("Запуск индексации (векторной)...")
-indexer = VectorIndexer(watch_paths=PATHS_TO_WATCH, index_path=INDEX_PATH, map_path=MAP_PATH)
-logging.info("Векторный индекс готов.")
+    logging.info("Запуск индексации (векторной)...")
+    indexer = ShardedIndexer(watch_paths=PATHS_TO_WATCH, index_path=INDEX_PATH, map_path=MAP_PATH,
+                             model_name=ENCODER, chunk_tokens=CHUNK_TOKENS, chunk_overlap=CHUNK_OVERLAP)
+    logging.info(f"Векторный индекс готов: {indexer.stats()}")
 
-event_handler = FileChangeHandler(indexer)
-observer = Observer()
+    observer = Observer()
+    indexer.watch(observer)
 
-for path in PATHS_TO_WATCH:
-    observer.schedule(event_handler, path, recursive=True)
-    logging.info(f"Наблюдатель настроен для папки: '{path}'.")
+    observer.start()
+    logging.info(f"Наблюдатель запущен и отслеживает изменения в: {PATHS_TO_WATCH}.")
 
-observer.start()
-logging.info(f"Наблюдатель запущен и отслеживает изменения в: {PATHS_TO_WATCH}.")
+# Размер индекса и очередь наблюдателя читаются в момент запроса /metrics
+REGISTRY.gauge("index_vectors", "Vectors per shard: live, dead (removed, not yet compacted), delta, total",
+               lambda: [({"shard": root, "state": state}, count)
+                        for root, stats in indexer.stats().items() for state, count in stats.items()])
+REGISTRY.gauge("watcher_queue_depth", "File events waiting to be applied, per shard",
+               lambda: [({"shard": root}, len(handler.pending)) for root, handler in indexer.handlers.items()])
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
 
+class FilterFields(BaseModel):
+    prefix: Optional[str] = None
+    extensions: Optional[List[str]] = None
+    modified_after: Optional[float] = None
+    modified_before: Optional[float] = None
+
+class SearchRequest(FilterFields):
+    queries: List[str] = Field(min_length=1, max_length=API_MAX_QUERIES)
+    top_k: int = Field(5, ge=1, le=API_MAX_RESULTS)
+    offset: int = Field(0, ge=0, le=API_MAX_RESULTS)
+
+class SimilarRequest(FilterFields):
+    path: str
+    top_k: int = Field(5, ge=1, le=API_MAX_RESULTS)
+    offset: int = Field(0, ge=0, le=API_MAX_RESULTS)
+
+class ShardRequest(BaseModel):
+    root: str
+    rebuild: bool = False
+
+def server_timing(timings: dict, started: float) -> str:
+    # Заголовок Server-Timing: длительность стадий запроса в миллисекундах
+    timings = {**timings, "total": time.perf_counter() - started}
+    return ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings.items())
+
+def make_filter(fields: FilterFields):
+    if fields.prefix is None and fields.extensions is None and fields.modified_after is None \
+            and fields.modified_before is None:
+        return None
+    return SearchFilter(prefix=fields.prefix, extensions=fields.extensions, modified_after=fields.modified_after,
+                        modified_before=fields.modified_before)
+
 @app.on_event("startup")
 async def startup_event():
     app.state.indexer = indexer
+    app.state.search_engine = ShardedSearch(indexer=indexer, mode=SEARCH_MODE)
+    app.state.batcher = QueryBatcher(app.state.search_engine,
+                                     window_ms=QUERY_BATCH_WINDOW_MS, max_batch=QUERY_BATCH_MAX)
+    app.state.batcher.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await app.state.batcher.stop()
 
 @app.get("/", response_class=HTMLResponse)
 async def show_search_form(request: Request):
     return templates.TemplateResponse("index.html", {"request": request, "results": []})
 
 @app.post("/", response_class=HTMLResponse)
-async def handle_search_query(request: Request, query: str = Form(...)):
+async def handle_search_query(request: Request, query: str = Form(...), prefix: str = Form(""),
+                              extensions: str = Form("")):
     results_list = []
     if query:
-        search_engine = VectorSearch(indexer=app.state.indexer)
-        
-        results_list = search_engine.search(query)
-        
+        # Необязательные фильтры: начало пути и расширения через запятую
+        search_filter = None
+        if prefix or extensions:
+            search_filter = SearchFilter(prefix=prefix or None,
+                                         extensions=[e.strip() for e in extensions.split(",") if e.strip()] or None)
+        results_list = await app.state.batcher.search(query, search_filter=search_filter)
+
     return templates.TemplateResponse("index.html", {
         "request": request, 
         "results": results_list, 
-        "query": query
+        "query": query,
+        "prefix": prefix,
+        "extensions": extensions
     })
 
+@app.post("/api/search")
+async def api_search(request: SearchRequest, http_request: Request, response: Response):
+    # Все запросы кодируются и ищутся одним пакетом; страница - результаты с offset по offset + top_k
+    # С заголовком X-Profile в ответе приходит Server-Timing с разбивкой по стадиям
+    started = time.perf_counter()
+    timings = {}
+    depth = request.offset + request.top_k
+    results = await asyncio.get_running_loop().run_in_executor(
+        None, app.state.search_engine.search_many, request.queries, depth, make_filter(request), timings)
+    if "x-profile" in http_request.headers:
+        response.headers["Server-Timing"] = server_timing(timings, started)
+    return {"offset": request.offset, "top_k": request.top_k,
+            "results": [{"query": query, "hits": hits[request.offset:depth]}
+                        for query, hits in zip(request.queries, results)]}
+
+@app.post("/api/similar")
+async def api_similar(request: SimilarRequest, http_request: Request, response: Response):
+    # Похожие документы: запросом служит сохранённый в индексе вектор документа
+    started = time.perf_counter()
+    timings = {}
+    depth = request.offset + request.top_k
+    hits = await asyncio.get_running_loop().run_in_executor(
+        None, app.state.search_engine.similar, request.path, depth, make_filter(request), timings)
+    if hits is None:
+        raise HTTPException(status_code=404, detail=f"Документ '{request.path}' не найден в индексе")
+    if "x-profile" in http_request.headers:
+        response.headers["Server-Timing"] = server_timing(timings, started)
+    return {"path": request.path, "offset": request.offset, "top_k": request.top_k,
+            "hits": hits[request.offset:depth]}
+
+@app.post("/api/shards/reload")
+async def api_reload_shard(request: ShardRequest):
+    # Перечитать шард с диска или (rebuild) удалить его файлы и проиндексировать папку заново;
+    # поиск идёт по старому шарду, пока новый не готов, остальные шарды не затрагиваются
+    if request.root not in app.state.indexer.shards:
+        raise HTTPException(status_code=404, detail=f"Шарда для папки '{request.root}' нет")
+    if request.rebuild and READ_ONLY:
+        raise HTTPException(status_code=409, detail="Перестроить шард может только процесс, который пишет индекс")
+    shard = await asyncio.get_running_loop().run_in_executor(
+        None, app.state.indexer.reload_shard, request.root, request.rebuild)
+    return {"root": request.root, "rebuilt": request.rebuild, "stats": shard.stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Гистограммы и счётчики в текстовом формате Prometheus; у каждого процесса uvicorn свои
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == '__main__':
     try:
         uvicorn.run(app, host="127.0.0.1", port=8000)
     finally:
         logging.info("Application is shutting down...")
-        observer.stop()
-        observer.join()
+        if observer is not None:
+            observer.stop()
+            observer.join()
 
-        indexer.save_index() 
+            indexer.stop()
         logging.info("Shutdown complete.")
 # import os
 # import logging
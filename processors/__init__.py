@@ -1,2 +1,6 @@
 from .crawler import VectorIndexer, FileChangeHandler  #Crawler
-from .search import VectorSearch
+from .search import VectorSearch, QueryBatcher
+from .shards import ShardedIndexer, ShardedSearch
+from .filters import SearchFilter
+from .encoders import SentenceTransformerEncoder, QuantizedEncoder, HashingEncoder, make_encoder
+from .telemetry import REGISTRY
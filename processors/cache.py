@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+import numpy as np
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, model_name: str, max_entries=100000):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings ("
+                        "model TEXT, digest BLOB, vector BLOB, last_used INTEGER, "
+                        "PRIMARY KEY (model, digest))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_used)")
+        self.entries = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.clock = self.db.execute("SELECT COALESCE(MAX(last_used), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, digests: list, track=True) -> dict:
+        found = {}
+        with self.lock:
+            if self.db is None:
+                # Closed with its indexer; a search still holding an old generation falls back to the index
+                return found
+            for start in range(0, len(digests), 500):
+                chunk = digests[start:start + 500]
+                rows = self.db.execute(
+                    f"SELECT digest, vector FROM embeddings WHERE model = ? AND digest IN ({','.join('?' * len(chunk))})",
+                    [self.model_name, *chunk])
+                for digest, vector in rows:
+                    found[digest] = np.frombuffer(vector, dtype='float32')
+            if not track:
+                return found
+
+            self.clock += 1
+            self.db.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND digest = ?",
+                                [(self.clock, self.model_name, digest) for digest in found])
+            self.db.commit()
+            self.hits += len(found)
+            self.misses += len(digests) - len(found)
+        return found
+
+    def put_many(self, items: dict):
+        if not items:
+            return
+        with self.lock:
+            if self.db is None:
+                return
+            self.clock += 1
+            before = self.db.total_changes
+            self.db.executemany("INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)",
+                                [(self.model_name, digest, np.ascontiguousarray(vector, dtype='float32').tobytes(),
+                                  self.clock) for digest, vector in items.items()])
+            self.entries += self.db.total_changes - before
+
+            overflow = self.entries - self.max_entries
+            if overflow > 0:
+                self.db.execute("DELETE FROM embeddings WHERE rowid IN "
+                                "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (overflow,))
+                self.entries -= overflow
+            self.db.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'entries': self.entries,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
@@ -1,10 +1,21 @@
 import pandas as pd
+import numpy as np
 import os
+import time
 import faiss
 import pickle
-from sentence_transformers import SentenceTransformer
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from watchdog.events import FileSystemEventHandler
+from .storage import ChangeLog, MappedDocumentTable, atomic_write, write_document_table, OP_ADD, OP_REMOVE
+from .manifest import content_digest, scan_tree, diff_manifest
+from .cache import EmbeddingCache
+from .lexical import InvertedIndex, write_inverted_index, read_inverted_index
+from .filters import DocumentMetadata, write_metadata, read_metadata, contains
+from .encoders import make_encoder
+from .text_processing import normalize_many, split_passages
+from .telemetry import REGISTRY, SIZE_BUCKETS
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,19 +28,286 @@ pd.set_option('display.width', 1000)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
+
+SCALAR_QUANTIZERS = {'fp16': faiss.ScalarQuantizer.QT_fp16, 'sq8': faiss.ScalarQuantizer.QT_8bit}
+
+FILE_READ_SECONDS = REGISTRY.histogram('file_read_seconds', 'Time to read one file')
+FILE_READ_BYTES = REGISTRY.counter('file_read_bytes_total', 'Bytes read from indexed files')
+ENCODE_SECONDS = REGISTRY.histogram('encode_seconds', 'Encoder time per batch of passages')
+ENCODE_BATCH_SIZE = REGISTRY.histogram('encode_batch_size', 'Passages per encoder batch', SIZE_BUCKETS)
+CACHE_LOOKUPS = {result: REGISTRY.counter('embedding_cache_lookups_total', 'Passage digests looked up in the '
+                                          'embedding cache', result=result) for result in ['hit', 'miss']}
+INDEX_ADD_SECONDS = REGISTRY.histogram('index_add_seconds', 'Time to add a block of vectors to the index or delta')
+INDEX_SEARCH_SECONDS = {method: REGISTRY.histogram('index_search_seconds', 'Vector search time per batch of queries',
+                                                   method=method) for method in ['index', 'scan', 'candidates']}
+COMPACTION_SECONDS = REGISTRY.histogram('compaction_seconds', 'Time to merge the delta or rebuild the index')
+SNAPSHOT_SECONDS = REGISTRY.histogram('persist_seconds', 'Time to write a snapshot or sync the change log',
+                                      operation='snapshot')
+CHANGELOG_SYNC_SECONDS = REGISTRY.histogram('persist_seconds', 'Time to write a snapshot or sync the change log',
+                                            operation='changelog_sync')
+WATCHER_EVENTS = {operation: REGISTRY.counter('watcher_events_total', 'File events queued by the watcher',
+                                              operation=operation) for operation in ['add', 'remove']}
+WATCHER_APPLY_SECONDS = REGISTRY.histogram('watcher_apply_seconds', 'Time to apply a batch of queued file events')
+WATCHER_BATCH_SIZE = REGISTRY.histogram('watcher_batch_size', 'File events applied per batch', SIZE_BUCKETS)
+WATCHER_ERRORS = REGISTRY.counter('watcher_errors_total', 'Batches of file events that failed to apply or save')
+INDEX_ERRORS = REGISTRY.counter('index_errors_total', 'Files that failed to encode or index')
+EXACT_VECTORS = {source: REGISTRY.counter('exact_vectors_total', 'Full-precision vectors looked up for reranking '
+                                          'and retraining of compressed indexes, by where they came from',
+                                          source=source) for source in ['cache', 'reconstructed']}
+
+
+def make_index(d: int, kind='flat', train_vectors=None, hnsw_m=32, encoding='float32', pq_m=64):
+    metric = faiss.METRIC_INNER_PRODUCT
+    qtype = SCALAR_QUANTIZERS.get(encoding)
+    nlist = 1
+    if kind == 'ivf' or (kind == 'flat' and encoding == 'pq'):
+        # Flat PQ is an IVF with a single list: IndexPQ does not accept ID selectors, IndexIVFPQ does
+        if kind == 'ivf':
+            nlist = max(1, int(4 * np.sqrt(len(train_vectors))))
+        if encoding == 'pq':
+            base = faiss.IndexIVFPQ(faiss.IndexFlatIP(d), d, nlist, pq_m, 8, metric)
+        elif qtype is not None:
+            base = faiss.IndexIVFScalarQuantizer(faiss.IndexFlatIP(d), d, nlist, qtype, metric)
+        else:
+            base = faiss.IndexIVFFlat(faiss.IndexFlatIP(d), d, nlist, metric)
+    elif kind == 'hnsw':
+        if encoding == 'pq':
+            base = faiss.IndexHNSWPQ(d, pq_m, hnsw_m, 8, metric)
+        elif qtype is not None:
+            base = faiss.IndexHNSWSQ(d, qtype, hnsw_m, metric)
+        else:
+            base = faiss.IndexHNSWFlat(d, hnsw_m, metric)
+    elif qtype is not None:
+        base = faiss.IndexScalarQuantizer(d, qtype, metric)
+    else:
+        base = faiss.IndexFlatIP(d)
+
+    if not base.is_trained:
+        sample = train_vectors
+        sample_size = max(64 * nlist, 20000)
+        if len(sample) > sample_size:
+            sample = sample[np.random.default_rng(0).choice(len(sample), sample_size, replace=False)]
+        base.train(sample)
+    if isinstance(base, faiss.IndexIVF):
+        # A direct map lets the ID map reconstruct stored vectors for compaction and re-training
+        base.make_direct_map()
+    return faiss.IndexIDMap2(base)
+
+
+def top_k_rows(scores, ids, k: int):
+    # Best k columns of every row of scores, padded with -inf / -1 when a row has fewer finite scores
+    similarities = np.full((len(scores), k), -np.inf, dtype='float32')
+    indices = np.full((len(scores), k), -1, dtype='int64')
+    found = min(k, scores.shape[1])
+    if not found:
+        return similarities, indices
+    top = np.argpartition(-scores, found - 1, axis=1)[:, :found]
+    order = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, 1), axis=1), 1)
+    similarities[:, :found] = np.take_along_axis(scores, order, 1)
+    indices[:, :found] = np.where(np.isfinite(similarities[:, :found]), ids[order], -1)
+    return similarities, indices
+
+
+def index_layout(index) -> tuple:
+    base = faiss.downcast_index(index.index)
+    if isinstance(base, faiss.IndexHNSW):
+        kind, codes = 'hnsw', faiss.downcast_index(base.storage)
+    elif isinstance(base, faiss.IndexIVF):
+        kind, codes = ('ivf' if base.nlist > 1 else 'flat'), base
+    else:
+        kind, codes = 'flat', base
+
+    if isinstance(codes, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return kind, 'pq'
+    if isinstance(codes, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return kind, 'fp16' if codes.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'sq8'
+    return kind, 'float32'
+
+
+# Markers in MapSnapshot.changes for a removed key, and returned by its lookup for a key that did not change
+_REMOVED = object()
+_UNCHANGED = object()
+
+
+class MapSnapshot:
+    # A read-only view of one of the writer's maps as of a publish: a base copy shared by every generation until
+    # the next fold, plus the entries changed since it was taken, so a publish copies only what changed
+    def __init__(self, base: dict, current: dict, changed: set):
+        self.base = base
+        self.changes = {key: current.get(key, _REMOVED) for key in changed}
+        self.size = len(current)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        # Values filled in at query time (terms of old documents) stay with this generation
+        self.changes[key] = value
+
+    def get(self, key, default=None):
+        value = self.changes.get(key, _UNCHANGED)
+        if value is _UNCHANGED:
+            return self.base.get(key, default)
+        return default if value is _REMOVED else value
+
+
+class Generation:
+    # An immutable view of the vectors and maps: a search uses one generation from start to end while writers
+    # build the next one and publish it with a single assignment
+    def __init__(self, index, delta_ids, delta_vectors, id_to_path, terms, passages, metadata, dead_ids,
+                 selector, layout, seq):
+        self.index = index
+        # Vectors added since the base index was last rebuilt or merged, scored by brute force
+        self.delta_ids = delta_ids
+        self.delta_vectors = delta_vectors
+        self.delta_live = ~np.isin(delta_ids, dead_ids)
+        self.id_to_path = id_to_path
+        self.terms = terms
+        self.passages = passages
+        self.metadata = metadata
+        self.dead_ids = dead_ids
+        self.selector = selector
+        self.layout = layout
+        self.seq = seq
+
+    def allowed(self, search_filter) -> np.ndarray:
+        # Sorted IDs of the live documents that pass the filter; IDs without metadata, e.g. of a delta a read-only
+        # process maps that is newer than the metadata it read, pass no filter
+        allowed = self.metadata.ids[search_filter.mask(self.metadata, self.id_to_path)]
+        if len(self.dead_ids):
+            allowed = allowed[~np.isin(allowed, self.dead_ids)]
+        return allowed
+
+    def search_delta(self, queries, k: int, live=None):
+        live = self.delta_live if live is None else live
+        if not live.any():
+            return top_k_rows(np.empty((len(queries), 0), dtype='float32'), self.delta_ids, k)
+        scores = queries @ self.delta_vectors.T
+        scores[:, ~live] = -np.inf
+        return top_k_rows(scores, self.delta_ids, k)
+
+    def reconstruct(self, ids):
+        vectors = np.empty((len(ids), self.delta_vectors.shape[1]), dtype='float32')
+        rows = np.searchsorted(self.delta_ids, ids)
+        in_delta = rows < len(self.delta_ids)
+        in_delta[in_delta] = self.delta_ids[rows[in_delta]] == ids[in_delta]
+        if in_delta.any():
+            vectors[in_delta] = self.delta_vectors[rows[in_delta]]
+        if not in_delta.all():
+            vectors[~in_delta] = self.index.reconstruct_batch(ids[~in_delta])
+        return vectors
+
+
 class VectorIndexer:
-    def __init__(self, watch_paths: list, index_path="vector_index.faiss", map_path="path_map.pkl"):
+    def __init__(self, watch_paths: list, index_path="vector_index.faiss", map_path="path_map.pkl",
+                 batch_size=32, workers=None, block_size=2048, compaction_threshold=0.2,
+                 snapshot_every=10000, model_name='all-mpnet-base-v2', cache_path=None, cache_size=100000,
+                 normalize_processes=None, index_type='flat', ivf_threshold=50000, nprobe=16, ef_search=64,
+                 hnsw_m=32, encoding='float32', pq_m=64, compress_threshold=20000, rerank=0, read_only=False,
+                 chunk_tokens=0, chunk_overlap=32, delta_threshold=10000, encoder=None, filter_scan_limit=2048,
+                 map_fold_threshold=4096, layout_hysteresis=0.8, snapshot_interval=30.0):
         self.watch_paths = watch_paths
         self.index_path = index_path
         self.map_path = map_path
+        self.batch_size = batch_size
+        self.workers = workers
+        self.block_size = block_size
+        self.compaction_threshold = compaction_threshold
+        self.snapshot_every = snapshot_every
+        # Read-only processes only see saved snapshots, so sync() also saves unsaved changes once the last
+        # snapshot is snapshot_interval seconds old; this bounds how stale the readers get
+        self.snapshot_interval = snapshot_interval
+        self._last_snapshot = time.monotonic()
+        self.normalize_processes = normalize_processes
+        # 'flat' is exact; 'ivf' stays flat until ivf_threshold live vectors, then migrates; 'hnsw' is a graph index
+        self.index_type = index_type
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.hnsw_m = hnsw_m
+        # 'float32', 'fp16', 'sq8' or 'pq'; trained encodings are used once compress_threshold vectors exist
+        self.encoding = encoding
+        self.pq_m = pq_m
+        self.compress_threshold = compress_threshold
+        # Going back to flat or float32 waits until the live count is below layout_hysteresis times the threshold
+        # it crossed, so a corpus that hovers around a threshold does not rebuild the index on every compaction
+        self.layout_hysteresis = layout_hysteresis
+        # With compressed codes, fetch rerank * top_k candidates and re-score them with exact cached vectors
+        self.rerank = rerank
+        # Files longer than chunk_tokens tokens get one vector per overlapping window; 0 keeps one vector per file
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        # New vectors collect in a brute-force delta until there are delta_threshold of them, then a background
+        # merge appends them to a copy of the base index
+        self.delta_threshold = delta_threshold
+        # Filtered searches that leave at most filter_scan_limit vectors score them exactly instead of searching
+        # the index with a selector, which returns too few hits from IVF lists or the HNSW graph when selective
+        self.filter_scan_limit = filter_scan_limit
+        # Generations share copies of id_to_path, terms and passages and carry the IDs changed since; the copies
+        # are refreshed once more than map_fold_threshold IDs have changed
+        self.map_fold_threshold = map_fold_threshold
+        self.delta_path = index_path + '.delta'
+        # Read-only serving processes memory-map the last snapshot; only one writer process indexes and watches
+        self.read_only = read_only
+        self.table_path = map_path + '.docs'
+        self.lexical_path = map_path + '.lex'
+        self.metadata_path = map_path + '.meta'
+        self._table_mtime = None
+        self._table_checked = 0.0
         
-        logging.info("Loading sentence transformer model...")
-        self.model = SentenceTransformer('all-mpnet-base-v2')
-        self.d = self.model.get_sentence_embedding_dimension()
+        # A sentence-transformers model name, '<model>:int8' or 'hashing-<dimension>' (see encoders.make_encoder)
+        self.model_name = model_name
+        if encoder is None:
+            logging.info(f"Loading encoder '{model_name}'...")
+            encoder = make_encoder(model_name)
+        # Shards of one ShardedIndexer share a single loaded encoder
+        self.encoder = encoder
+        self.d = encoder.dimension
+        # Also the only full-precision copy of the vectors of a compressed index: reranking and retraining read
+        # them from here, and vectors evicted beyond cache_size entries are replaced by lossy reconstructions
+        self.cache = EmbeddingCache(cache_path or index_path + '.cache', encoder.name, cache_size)
+        self._warned_reconstructed = False
 
         self.index = None
+        self.index_layout = None
+        self.delta_ids = np.empty(0, dtype='int64')
+        self.delta_vectors = np.empty((0, self.d), dtype='float32')
+        # The generation searches use; None until start-up indexing is done
+        self.generation = None
         self.path_to_id = {}
         self.id_to_path = {}
+        # path -> (size, mtime_ns, content digest) of the version that is currently indexed
+        self.manifest = {}
+        # ID -> normalized terms of the document, used for highlighting without re-reading the file
+        self.terms = {}
+        # ID -> (start, end, digest) of the passage of the file the vector was encoded from
+        self.passages = {}
+        # BM25 postings over the same IDs, maintained by the same add and remove events as the vector index
+        self.lexical = InvertedIndex()
+        # Watch root, directory, extension, size and mtime of every ID, for filtered searches
+        self.metadata = DocumentMetadata(watch_paths)
+        self.next_id = 0
+        self.seq = 0
+        self.changelog = ChangeLog(index_path + '.log')
+        self.dead_ids = set()
+        self._dead_selector = None
+        self._map_bases = None
+        self._changed_ids = set()
+        self._compacting = False
+        self.lock = threading.RLock()
+
+        if read_only:
+            self.load_mapped()
+            return
 
         self.load_index()
         if not self.path_to_id: 
@@ -37,8 +315,17 @@ class VectorIndexer:
             self.initial_crawl()
         else:
             logging.info("Loaded existing index.")
+            self.reconcile()
+            if not os.path.exists(self.metadata_path):
+                # Snapshots taken before document metadata was kept get it once, for read-only processes
+                self.save_index()
+
+        with self.lock:
+            self.generation = self._next_generation()
+        self._maybe_compact()
 
     def initial_crawl(self):
+        file_paths = []
         for path in self.watch_paths:
             logging.info(f'Starting initial sync with directory: {path}')
             if not os.path.exists(path):
@@ -46,57 +333,599 @@ class VectorIndexer:
             
             for root, _, files in os.walk(path):
                 for file in files:
-                    file_path = os.path.join(root, file)
-                    self.add_file(file_path)
-        
+                    file_paths.append(os.path.join(root, file))
+
+        self.add_files(file_paths)
         self.save_index()
         logging.info(f"Vector index is ready for paths: {self.watch_paths}")
 
-    def add_file(self, file_path: str):
-        if file_path in self.path_to_id:
-            logging.info(f"File '{file_path}' exists. Re-indexing.")
-            self.remove_file(file_path)
+    def reconcile(self):
+        started = time.perf_counter()
+        seq = self.seq
+        found = scan_tree(self.watch_paths, self.workers)
+        added, suspect, deleted = diff_manifest(self.manifest, set(self.path_to_id), found, self.watch_paths)
 
+        changed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for file_path, digest in zip(suspect, pool.map(self._file_digest, suspect)):
+                known = self.manifest.get(file_path)
+                if known is not None and digest == known[2]:
+                    # Only the stat changed (touch, copy with new mtime); refresh it without re-encoding
+                    size, mtime_ns = found[file_path]
+                    self._refresh_stat(file_path, (size, mtime_ns, digest))
+                else:
+                    changed.append(file_path)
+
+        self.remove_files(deleted)
+        self.add_files(added + changed)
+
+        logging.info(f"Reconciled with disk in {time.perf_counter() - started:.2f} s: "
+                     f"{len(added)} added, {len(changed)} changed, {len(deleted)} deleted.")
+        if self.seq != seq or suspect:
+            self.save_index()
+
+    def _file_digest(self, file_path: str):
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            if not content.strip():
-                logging.warning(f"File '{file_path}' is empty. Skipping.")
-                return
+            with open(file_path, 'rb') as f:
+                return content_digest(f.read())
+        except OSError:
+            return None
 
-            embedding = self.model.encode([content])
+    def add_file(self, file_path: str):
+        self.add_files([file_path])
 
-            faiss.normalize_L2(embedding.astype('float32'))
-            
-            new_id = self.index.ntotal
-            self.index.add(embedding)
+    def add_files(self, file_paths: list):
+        self._check_writable()
+        file_paths = list(dict.fromkeys(file_paths))
+        total = len(file_paths)
+        done = 0
+        started = time.perf_counter()
+        # Files are read in parallel and indexed block by block so memory stays bounded on large trees
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for start in range(0, total, self.block_size):
+                block = file_paths[start:start + self.block_size]
+                docs, unreadable = [], []
+                for file_path, doc in zip(block, pool.map(self._read_file, block)):
+                    known = self.manifest.get(file_path) if file_path in self.path_to_id else None
+                    if doc is not None and known is not None and known[2] == doc[2][2]:
+                        # Same bytes as the indexed version (touch, metadata-only write); keep the vector
+                        self._refresh_stat(file_path, doc[2])
+                        continue
+                    if doc is not None:
+                        # The indexed version of a modified file is replaced together with the block
+                        docs.append(doc)
+                    elif file_path in self.path_to_id:
+                        unreadable.append(file_path)
 
-            self.path_to_id[file_path] = new_id
-            self.id_to_path[new_id] = file_path
-            
-            logging.info(f"Added/Updated file: {file_path} with ID: {new_id}")
+                self.remove_files(unreadable)
+                self._index_block(docs)
 
+                done += len(block)
+                if total > 1:
+                    elapsed = time.perf_counter() - started
+                    logging.info(f"Indexed {done}/{total} files ({done / elapsed:.1f} docs/sec)")
+
+    def _read_file(self, file_path: str):
+        started = time.perf_counter()
+        try:
+            with open(file_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                data = f.read()
+            FILE_READ_SECONDS.observe(time.perf_counter() - started)
+            FILE_READ_BYTES.inc(len(data))
+            content = data.decode('utf-8')
         except Exception as e:
             logging.error(f"Failed to process file {file_path}: {e}")
+            return None
+
+        if not content.strip():
+            logging.warning(f"File '{file_path}' is empty. Skipping.")
+            return None
+        return file_path, content, (stat.st_size, stat.st_mtime_ns, content_digest(data))
+
+    def _index_block(self, docs: list):
+        try:
+            self._index_documents(docs)
+        except Exception as e:
+            if len(docs) == 1:
+                INDEX_ERRORS.inc()
+                logging.error(f"Failed to index file {docs[0][0]}: {e}")
+                return
+            # Encoding and normalizing, where a bad file fails, run before any state changes, so a retry is safe
+            logging.warning(f"Failed to index a block of {len(docs)} files ({e}); retrying them one by one.")
+            for doc in docs:
+                self._index_block([doc])
+
+    def _index_documents(self, docs: list):
+        if not docs:
+            return
+
+        # (file, start, end, digest, text) of every passage; a file that fits one window is a single passage
+        chunks = []
+        for file_path, content, meta in docs:
+            for start, end in split_passages(content, self.chunk_tokens, self.chunk_overlap):
+                text = content[start:end]
+                digest = meta[2] if len(text) == len(content) else content_digest(text.encode('utf-8'))
+                chunks.append((file_path, start, end, digest, text))
+
+        vectors = self.cache.get_many(list({chunk[3] for chunk in chunks}))
+        # Duplicate passages are encoded once, so an edit to a long file only re-encodes the windows it touched;
+        # sorting by length keeps similar sizes in one batch to limit padding
+        missing = {digest: text for _, _, _, digest, text in chunks if digest not in vectors}
+        CACHE_LOOKUPS['hit'].inc(len(vectors))
+        CACHE_LOOKUPS['miss'].inc(len(missing))
+        pending = sorted(missing.items(), key=lambda item: len(item[1]))
+        encoded = {}
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            started = time.perf_counter()
+            batch_embeddings = self.encoder.encode([content for _, content in batch], batch_size=self.batch_size)
+            faiss.normalize_L2(batch_embeddings)
+            ENCODE_SECONDS.observe(time.perf_counter() - started)
+            ENCODE_BATCH_SIZE.observe(len(batch))
+            encoded.update((digest, vector) for (digest, _), vector in zip(batch, batch_embeddings))
+        self.cache.put_many(encoded)
+        vectors.update(encoded)
+
+        embeddings = np.vstack([vectors[chunk[3]] for chunk in chunks])
+        words = normalize_many([chunk[4] for chunk in chunks], processes=self.normalize_processes)
+        terms = [frozenset(chunk_words) for chunk_words in words]
+        metas = {file_path: meta for file_path, _, meta in docs}
+
+        with self.lock:
+            # Old versions of modified files go in the same publish, so a search sees either version, never none
+            records = [self._remove_document(file_path) for file_path in metas if file_path in self.path_to_id]
+            first_id = self.next_id
+            ids = np.arange(first_id, first_id + len(chunks), dtype='int64')
+            started = time.perf_counter()
+            if self.generation is None:
+                # Nothing is searched before start-up indexing is done, so vectors go straight into the base index
+                self.index.add_with_ids(embeddings, ids)
+            else:
+                # A published index is never modified; the delta arrays are replaced, not appended to
+                self.delta_ids = np.concatenate([self.delta_ids, ids])
+                self.delta_vectors = np.vstack([self.delta_vectors, embeddings])
+            INDEX_ADD_SECONDS.observe(time.perf_counter() - started)
+            self.next_id += len(chunks)
+            file_ids = {}
+            for offset, (file_path, start, end, digest, _) in enumerate(chunks):
+                chunk_id = first_id + offset
+                # Passages of a file get consecutive IDs; path_to_id holds the first one
+                self.path_to_id.setdefault(file_path, chunk_id)
+                file_ids.setdefault(file_path, []).append(chunk_id)
+                self.id_to_path[chunk_id] = file_path
+                self.manifest[file_path] = metas[file_path]
+                self.terms[chunk_id] = terms[offset]
+                self.passages[chunk_id] = (start, end, digest)
+                self._changed_ids.add(chunk_id)
+                self.lexical.add(chunk_id, words[offset])
+                self.seq += 1
+                records.append((self.seq, OP_ADD, chunk_id, file_path, embeddings[offset], metas[file_path],
+                                words[offset], self.passages[chunk_id]))
+            for file_path, chunk_ids in file_ids.items():
+                self.metadata.add(chunk_ids, file_path, *metas[file_path][:2])
+            self.changelog.append(records)
+            self._publish()
+
+        if len(docs) == 1:
+            logging.debug(f"Added/Updated file: {docs[0][0]} with ID: {first_id} ({len(chunks)} passages)")
+        self._maybe_compact()
 
     def remove_file(self, file_path: str):
-        if file_path not in self.path_to_id:
-            logging.warning(f"Attempted to remove non-existent file: {file_path}")
+        self.remove_files([file_path])
+
+    def remove_files(self, file_paths: list):
+        self._check_writable()
+        if not file_paths:
             return
+        with self.lock:
+            records = []
+            for file_path in file_paths:
+                if file_path not in self.path_to_id:
+                    logging.warning(f"Attempted to remove non-existent file: {file_path}")
+                    continue
+                records.append(self._remove_document(file_path))
+            if not records:
+                return
+            self.changelog.append(records)
+            self._publish()
+        self._maybe_compact()
+
+    def remember_terms(self, doc_id: int, document_terms: frozenset):
+        # Called with the lock held by searches that normalized a document indexed before terms were stored
+        self.terms[doc_id] = document_terms
+        self._changed_ids.add(doc_id)
 
+    def _remove_document(self, file_path: str) -> tuple:
+        # Called with the lock held; returns the change log record, which the caller appends
         file_id = self.path_to_id[file_path]
+        # The vectors stay in the index until compaction; searches skip them through the selector
+        self.dead_ids.update(self._drop_document(file_path))
+        self._dead_selector = None
+        self.seq += 1
+        logging.debug(f"Removed file from maps: {file_path} with ID: {file_id}")
+        return self.seq, OP_REMOVE, file_id, file_path, None, None, None, None
+
+    def _document_ids(self, file_path: str) -> list:
+        chunk_id = self.path_to_id[file_path]
+        ids = [chunk_id]
+        while self.id_to_path.get(chunk_id + 1) == file_path:
+            chunk_id += 1
+            ids.append(chunk_id)
+        return ids
+
+    def _refresh_stat(self, file_path: str, meta: tuple):
+        with self.lock:
+            self.manifest[file_path] = meta
+            # Written in place: a published generation sees the new mtime too, which is the one on disk
+            self.metadata.touch(self._document_ids(file_path), *meta[:2])
+
+    def _drop_document(self, file_path: str) -> list:
+        ids = self._document_ids(file_path)
         del self.path_to_id[file_path]
-        del self.id_to_path[file_id]
-        
-        logging.info(f"Removed file from maps: {file_path} with ID: {file_id}")
-    
+        for chunk_id in ids:
+            del self.id_to_path[chunk_id]
+            self.terms.pop(chunk_id, None)
+            self.passages.pop(chunk_id, None)
+            self.lexical.remove(chunk_id)
+        self._changed_ids.update(ids)
+        self.metadata.remove(ids)
+        self.manifest.pop(file_path, None)
+        return ids
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'live': len(self.id_to_path), 'dead': len(self.dead_ids), 'delta': len(self.delta_ids),
+                    'total': self.index.ntotal + len(self.delta_ids)}
+
+    def _publish(self):
+        # Called with the lock held after every change; start-up indexing publishes once at the end
+        if self.generation is not None:
+            self.generation = self._next_generation()
+
+    def _next_generation(self) -> Generation:
+        dead = np.fromiter(self.dead_ids, dtype='int64', count=len(self.dead_ids))
+        if len(dead) and self._dead_selector is None:
+            self._dead_selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(dead))
+        # The writer keeps changing its own maps and a generation never changes, so generations get copies; the
+        # full copy is only taken again when the changes since the last one outgrow map_fold_threshold
+        maps = self.id_to_path, self.terms, self.passages
+        if self._map_bases is None or len(self._changed_ids) > self.map_fold_threshold:
+            self._map_bases = tuple(dict(current) for current in maps)
+            self._changed_ids = set()
+        id_to_path, terms, passages = (MapSnapshot(base, current, self._changed_ids)
+                                       for base, current in zip(self._map_bases, maps))
+        return Generation(self.index, self.delta_ids, self.delta_vectors, id_to_path, terms, passages,
+                          self.metadata.view(), dead, self._dead_selector if len(dead) else None,
+                          self.index_layout, self.seq)
+
+    def snapshot(self) -> Generation:
+        if self.read_only:
+            self._refresh_mapped()
+        return self.generation
+
+    def reconstruct(self, ids):
+        return self._exact_vectors(self.snapshot(), np.asarray(ids, dtype='int64'))
+
+    def document_ids(self, file_path: str, generation=None) -> list:
+        generation = generation or self.snapshot()
+        with self.lock:
+            chunk_id = self.path_to_id.get(file_path)
+        # path_to_id may be ahead of the generation, so the IDs are checked against its own map
+        ids = []
+        while chunk_id is not None and generation.id_to_path.get(chunk_id) == file_path:
+            ids.append(chunk_id)
+            chunk_id += 1
+        return ids
+
+    def document_vector(self, file_path: str, generation=None):
+        # The stored vectors of the file, averaged over its passages; None when it is not indexed
+        generation = generation or self.snapshot()
+        ids = self.document_ids(file_path, generation)
+        if not ids:
+            return None
+        vector = self._exact_vectors(generation, np.array(ids, dtype='int64')).mean(axis=0, keepdims=True)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def search_vectors(self, query_embeddings, top_k: int, generation=None, allowed=None):
+        # allowed holds the sorted IDs of Generation.allowed(); the others are skipped inside the index search
+        started = time.perf_counter()
+        generation = generation or self.snapshot()
+        selector, delta_live = generation.selector, generation.delta_live
+        if allowed is not None:
+            if len(allowed) <= self.filter_scan_limit:
+                result = self._scan(generation, query_embeddings, allowed, top_k)
+                INDEX_SEARCH_SECONDS['scan'].observe(time.perf_counter() - started)
+                return result
+            if allowed[-1] < 64 * len(allowed):
+                # A bitmap up to the largest allowed ID is cheaper to build and probe than a hash set while it is
+                # at most as large as the IDs themselves. It must outlive the search; the selector only keeps a
+                # pointer to it
+                bits = np.zeros(allowed[-1] + 1, dtype=bool)
+                bits[allowed] = True
+                bitmap = np.packbits(bits, bitorder='little')
+                selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+            else:
+                selector = faiss.IDSelectorBatch(allowed)
+            delta_live = generation.delta_live & contains(allowed, generation.delta_ids)
+
+        fetch_k = top_k * self.rerank if self.rerank and generation.layout[1] != 'float32' else top_k
+        similarities, indices = self._search_index(generation.index, selector, query_embeddings, fetch_k)
+        if delta_live.any():
+            delta_similarities, delta_indices = generation.search_delta(query_embeddings, fetch_k, delta_live)
+            similarities = np.hstack([similarities, delta_similarities])
+            indices = np.hstack([indices, delta_indices])
+            order = np.argsort(-similarities, axis=1, kind='stable')[:, :fetch_k]
+            similarities = np.take_along_axis(similarities, order, 1)
+            indices = np.take_along_axis(indices, order, 1)
+        if fetch_k != top_k:
+            similarities, indices = self._rerank(generation, query_embeddings, indices, top_k)
+        INDEX_SEARCH_SECONDS['index'].observe(time.perf_counter() - started)
+        return similarities, indices
+
+    def _scan(self, generation: Generation, query_embeddings, ids, top_k: int):
+        scores = query_embeddings @ self._exact_vectors(generation, ids).T
+        return top_k_rows(scores, ids, top_k)
+
+    def _search_index(self, index, selector, query_embeddings, k: int):
+        base = faiss.downcast_index(index.index)
+        if isinstance(base, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(nprobe=self.nprobe)
+        elif isinstance(base, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(efSearch=self.ef_search)
+        elif selector is not None:
+            params = faiss.SearchParameters()
+        else:
+            params = None
+        if selector is not None:
+            params.sel = selector
+
+        if params is None:
+            return index.search(query_embeddings, k)
+        return index.search(query_embeddings, k, params=params)
+
+    def search_lexical(self, words: list, top_k: int, allowed=None, statistics=None):
+        return self.lexical.search(words, top_k, allowed, statistics)
+
+    def lexical_statistics(self, words: list) -> tuple:
+        return self.lexical.statistics(words)
+
+    def search_candidates(self, query_embeddings, candidates, top_k: int, generation=None):
+        # Scores only the given IDs (one row of candidates per query, padded with -1) with exact vectors
+        started = time.perf_counter()
+        generation = generation or self.snapshot()
+        # The inverted index is shared, so it may already be ahead of or behind this generation
+        live = np.array([int(i) in generation.id_to_path for i in candidates.ravel()], dtype=bool)
+        result = self._rerank(generation, query_embeddings,
+                              np.where(live.reshape(candidates.shape), candidates, -1), top_k)
+        INDEX_SEARCH_SECONDS['candidates'].observe(time.perf_counter() - started)
+        return result
+
+    def _rerank(self, generation: Generation, query_embeddings, indices, top_k: int):
+        candidates = np.unique(indices[indices >= 0])
+        exact = dict(zip(candidates.tolist(), self._exact_vectors(generation, candidates)))
+
+        similarities = np.full((len(indices), top_k), -np.inf, dtype='float32')
+        reranked = np.full((len(indices), top_k), -1, dtype='int64')
+        for row, ids in enumerate(indices):
+            ids = ids[ids >= 0]
+            if not len(ids):
+                continue
+            scores = np.vstack([exact[i] for i in ids.tolist()]) @ query_embeddings[row]
+            order = np.argsort(-scores)[:top_k]
+            similarities[row, :len(order)] = scores[order]
+            reranked[row, :len(order)] = ids[order]
+        return similarities, reranked
+
+    def _exact_vectors(self, generation: Generation, ids):
+        vectors, reconstructed = self._cached_vectors(generation, ids)
+        if reconstructed and not self._warned_reconstructed:
+            # Once per indexer; exact_vectors_total{source="reconstructed"} keeps counting
+            self._warned_reconstructed = True
+            logging.warning(f"{reconstructed} of {len(ids)} vectors for reranking are not in the embedding cache "
+                            f"({self.cache.max_entries} entries); their compressed reconstructions are used. Raise "
+                            f"cache_size above the number of live vectors to rerank with full precision.")
+        return vectors
+
+    def _cached_vectors(self, generation: Generation, ids) -> tuple:
+        # (vectors, how many of them are lossy reconstructions)
+        vectors = generation.reconstruct(ids)
+        if generation.layout[1] == 'float32':
+            return vectors, 0
+
+        # Compressed codes only reconstruct approximately; the embedding cache still holds the encoder output
+        with self.lock:
+            digests = [self._vector_digest(generation, int(i)) for i in ids]
+        cached = self.cache.get_many([digest for digest in digests if digest is not None], track=False)
+        found = 0
+        for row, digest in enumerate(digests):
+            if digest in cached:
+                vectors[row] = cached[digest]
+                found += 1
+        EXACT_VECTORS['cache'].inc(found)
+        EXACT_VECTORS['reconstructed'].inc(len(ids) - found)
+        return vectors, len(ids) - found
+
+    def _vector_digest(self, generation: Generation, doc_id: int):
+        passage = generation.passages.get(doc_id)
+        if passage is not None:
+            return passage[2]
+        return self.manifest.get(generation.id_to_path.get(doc_id), (None, None, None))[2]
+
+    def _target_layout(self, live: int) -> tuple:
+        kind, encoding = self.index_layout or (None, None)
+        ivf_threshold = self.ivf_threshold * (self.layout_hysteresis if kind == 'ivf' else 1)
+        if self.index_type == 'ivf' and live >= ivf_threshold:
+            kind = 'ivf'
+        else:
+            kind = 'hnsw' if self.index_type == 'hnsw' else 'flat'
+        trained = self.encoding in ('sq8', 'pq')
+        compress_threshold = self.compress_threshold * (self.layout_hysteresis if encoding == self.encoding else 1)
+        return kind, self.encoding if not trained or live >= compress_threshold else 'float32'
+
+    def _needs_rebuild(self) -> bool:
+        live = len(self.id_to_path)
+        stored = self.index.ntotal + len(self.delta_ids)
+        if stored and len(self.dead_ids) / stored >= self.compaction_threshold:
+            return True
+        if self._target_layout(live) != self.index_layout:
+            return True
+        if self.index_layout[0] == 'ivf':
+            # Re-train once the corpus has outgrown the coarse quantizer (nlist was chosen as 4 * sqrt(n))
+            trained_for = (faiss.extract_index_ivf(self.index).nlist / 4) ** 2
+            return live > 4 * trained_for
+        return False
+
+    def _maybe_compact(self):
+        with self.lock:
+            if self._compacting or self.generation is None or not self.index.ntotal + len(self.delta_ids):
+                return
+            if len(self.delta_ids) < self.delta_threshold and not self._needs_rebuild():
+                return
+            self._compacting = True
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        started = time.perf_counter()
+        try:
+            with self.lock:
+                generation = self.generation
+                dead_count = len(self.dead_ids)
+                live_ids = np.fromiter(self.id_to_path.keys(), dtype='int64', count=len(self.id_to_path))
+                live_ids.sort()
+                next_id = self.next_id
+                rebuild = self._needs_rebuild()
+                kind, encoding = self._target_layout(len(live_ids)) if rebuild else self.index_layout
+
+            # Both paths only read the published generation, which is never modified, so searches and writes
+            # continue meanwhile
+            if rebuild:
+                vectors, reconstructed = self._cached_vectors(generation, live_ids)
+                if reconstructed:
+                    logging.warning(f"Retraining the {kind}/{encoding} index on {reconstructed} of {len(live_ids)} "
+                                    f"vectors reconstructed from compressed codes: they are not in the embedding "
+                                    f"cache ({self.cache.max_entries} entries). Raise cache_size above the number "
+                                    f"of live vectors to keep their full precision.")
+                index = make_index(self.d, kind, vectors, self.hnsw_m, encoding, self.pq_m)
+                if len(live_ids):
+                    index.add_with_ids(vectors, live_ids)
+            else:
+                # Only the delta has outgrown delta_threshold: append it to a copy of the base index
+                index = faiss.clone_index(generation.index)
+                if len(generation.delta_ids):
+                    index.add_with_ids(generation.delta_vectors, generation.delta_ids)
+
+            with self.lock:
+                # Vectors added meanwhile start the next delta
+                keep = self.delta_ids >= next_id
+                self.delta_ids, self.delta_vectors = self.delta_ids[keep], self.delta_vectors[keep]
+                self.index = index
+                self.index_layout = (kind, encoding)
+                live_ids = np.fromiter(self.id_to_path.keys(), dtype='int64', count=len(self.id_to_path))
+                stored = np.concatenate([faiss.vector_to_array(index.id_map), self.delta_ids])
+                self.dead_ids = set(np.setdiff1d(stored, live_ids).tolist())
+                self._dead_selector = None
+                self._publish()
+            if rebuild:
+                logging.info(f"Rebuilt {kind}/{encoding} index: dropped {dead_count} dead vectors, "
+                             f"{index.ntotal} stored.")
+            else:
+                logging.info(f"Merged {len(generation.delta_ids)} delta vectors into the {kind}/{encoding} index.")
+            COMPACTION_SECONDS.observe(time.perf_counter() - started)
+        finally:
+            self._compacting = False
+
+    def files(self) -> list:
+        # Every file of the index except the embedding cache, which outlives a rebuild
+        return [self.index_path, self.delta_path, self.changelog.path, self.map_path, self.table_path,
+                self.lexical_path, self.metadata_path]
+
+    def wait_for_compaction(self, poll=0.05):
+        # Returns once no background compaction (delta merge, rebuild or layout change) is running
+        while self._compacting:
+            time.sleep(poll)
+
+    def close(self):
+        # A background compaction still reads the cache, so it is allowed to finish first
+        self.wait_for_compaction()
+        with self.lock:
+            self.changelog.close()
+        self.cache.close()
+
+    def _new_index(self):
+        kind, encoding = self._target_layout(0)
+        return make_index(self.d, kind, hnsw_m=self.hnsw_m, encoding=encoding, pq_m=self.pq_m)
+
+    def sync(self):
+        with self.lock:
+            started = time.perf_counter()
+            self.changelog.sync()
+            CHANGELOG_SYNC_SECONDS.observe(time.perf_counter() - started)
+            self.maybe_snapshot()
+
+    def maybe_snapshot(self):
+        # Saves the synced changes once there are snapshot_every of them or the last snapshot is too old
+        with self.lock:
+            records = self.changelog.records
+            if records >= self.snapshot_every or \
+                    (records and time.monotonic() - self._last_snapshot >= self.snapshot_interval):
+                self.save_index()
+
     def save_index(self):
+        self._check_writable()
         logging.info(f"Saving index to {self.index_path}...")
-        faiss.write_index(self.index, self.index_path)
-        
-        with open(self.map_path, 'wb') as f:
-            pickle.dump({'path_to_id': self.path_to_id, 'id_to_path': self.id_to_path}, f)
-        logging.info("Index and map saved successfully.")
+        started = time.perf_counter()
+        with self.lock:
+            # The map file is written after the index and carries the sequence number, so it marks the snapshot
+            # as complete; the document table for read-only processes follows it
+            atomic_write(self.index_path, lambda tmp_path: faiss.write_index(self.index, tmp_path))
+            atomic_write(self.delta_path, self._write_delta)
+            atomic_write(self.lexical_path, self._write_lexical)
+            atomic_write(self.metadata_path, self._write_metadata)
+            atomic_write(self.map_path, self._write_maps)
+            write_document_table(self.table_path, self.id_to_path, self.terms, self.passages, self.seq,
+                                 self.index_layout[0], self.encoder.name)
+            self.changelog.reset()
+            self._last_snapshot = time.monotonic()
+        SNAPSHOT_SECONDS.observe(time.perf_counter() - started)
+        logging.info(f"Index and map saved successfully. Vectors: {self.stats()}, "
+                     f"embedding cache: {self.cache.stats()}")
+
+    def _write_maps(self, path: str):
+        with open(path, 'wb') as f:
+            pickle.dump({'path_to_id': self.path_to_id, 'id_to_path': self.id_to_path,
+                         'manifest': self.manifest, 'terms': self.terms, 'passages': self.passages,
+                         'next_id': self.next_id, 'seq': self.seq, 'encoder': self.encoder.name}, f)
+
+    def _write_delta(self, path: str):
+        with open(path, 'wb') as f:
+            np.savez(f, ids=self.delta_ids, vectors=self.delta_vectors)
+
+    def _read_delta(self, index):
+        if not os.path.exists(self.delta_path):
+            return np.empty(0, dtype='int64'), np.empty((0, self.d), dtype='float32')
+        with np.load(self.delta_path) as delta:
+            ids, vectors = delta['ids'], delta['vectors']
+        # A snapshot interrupted between the index and the delta leaves merged vectors in both
+        keep = ~np.isin(ids, faiss.vector_to_array(index.id_map))
+        return ids[keep], vectors[keep]
+
+    def _write_lexical(self, path: str):
+        write_inverted_index(path, self.lexical, self.seq)
+
+    def _read_lexical(self, mapped=False):
+        if not os.path.exists(self.lexical_path):
+            return None, -1
+        return read_inverted_index(self.lexical_path, mapped)
+
+    def _write_metadata(self, path: str):
+        write_metadata(path, self.metadata, self.seq)
+
+    def _read_metadata(self, mapped=False):
+        if not os.path.exists(self.metadata_path):
+            return None, -1
+        return read_metadata(self.metadata_path, mapped)
 
     def load_index(self):
         if os.path.exists(self.index_path) and os.path.exists(self.map_path):
@@ -106,32 +935,247 @@ class VectorIndexer:
                 maps = pickle.load(f)
                 self.path_to_id = maps['path_to_id']
                 self.id_to_path = maps['id_to_path']
+                self.manifest = maps.get('manifest', {})
+                self.terms = maps.get('terms', {})
+                self.passages = maps.get('passages', {})
+            # Snapshots saved before the encoder was recorded are only checked by dimension
+            self._check_encoder(maps.get('encoder'), self.index.d)
+
+            if isinstance(self.index, faiss.IndexIDMap2):
+                stored_ids = faiss.vector_to_array(self.index.id_map)
+            else:
+                # Indexes written before stable IDs are plain flat indexes where the ID is the row number
+                logging.info("Migrating positional index to an ID-mapped index.")
+                stored_ids = np.arange(self.index.ntotal, dtype='int64')
+                index = self._new_index()
+                if self.index.ntotal:
+                    index.add_with_ids(self.index.reconstruct_n(0, self.index.ntotal), stored_ids)
+                self.index = index
+
+            self.delta_ids, self.delta_vectors = self._read_delta(self.index)
+            stored_ids = np.concatenate([stored_ids, self.delta_ids])
+            self.next_id = maps.get('next_id', int(stored_ids.max()) + 1 if len(stored_ids) else 0)
+            self.seq = maps.get('seq', 0)
+
+            lexical, lexical_seq = self._read_lexical()
+            if lexical is not None and lexical_seq >= self.seq:
+                # It is written just before the maps, so it may already contain records the log replays below
+                self.lexical = lexical
+            else:
+                logging.info("Building the inverted index from stored document terms.")
+                for doc_id, terms in sorted(self.terms.items()):
+                    self.lexical.add(doc_id, sorted(terms))
+
+            metadata, metadata_seq = self._read_metadata()
+            if metadata is not None and metadata_seq >= self.seq and metadata.roots == self.watch_paths:
+                self.metadata = metadata
+            else:
+                logging.info("Building document metadata from the stored manifest.")
+                # In ID order, so that every row is appended
+                for file_path in sorted(self.path_to_id, key=self.path_to_id.get):
+                    size, mtime_ns = self.manifest.get(file_path, (0, 0))[:2]
+                    self.metadata.add(self._document_ids(file_path), file_path, size, mtime_ns)
         else:
             logging.info("No existing index found. Initializing a new one.")
-            self.index = faiss.IndexFlatIP(self.d)
+            self.index = self._new_index()
+
+        self._replay_log()
+        self.index_layout = index_layout(self.index)
+        live_ids = np.fromiter(self.id_to_path.keys(), dtype='int64', count=len(self.id_to_path))
+        stored = np.concatenate([faiss.vector_to_array(self.index.id_map), self.delta_ids])
+        self.dead_ids = set(np.setdiff1d(stored, live_ids).tolist())
+        self.metadata.retain(live_ids)
+
+    def load_mapped(self):
+        mtime = os.stat(self.table_path).st_mtime_ns
+        table = MappedDocumentTable(self.table_path)
+        # Inverted lists of IVF indexes and the code arrays of the other kinds are mapped, not copied
+        flags = faiss.IO_FLAG_MMAP if table.kind == 'ivf' else faiss.IO_FLAG_MMAP_IFC
+        index = faiss.read_index(self.index_path, flags | faiss.IO_FLAG_READ_ONLY)
+        self._check_encoder(table.encoder, index.d)
+        delta_ids, delta_vectors = self._read_delta(index)
+        stored = np.concatenate([faiss.vector_to_array(index.id_map), delta_ids])
+        dead = np.setdiff1d(stored, table.ids)
+        selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(dead)) if len(dead) else None
+        # Postings and metadata columns are mapped like the table, not copied into every reader
+        lexical = self._read_lexical(mapped=True)[0] or InvertedIndex()
+        metadata = self._read_metadata(mapped=True)[0]
+        if metadata is None:
+            logging.warning(f"No document metadata in {self.metadata_path}; filtered searches find nothing.")
+            metadata = DocumentMetadata(self.watch_paths)
+        # The metadata file is written before the table, so it may know IDs this table and index do not have
+        metadata.retain(np.asarray(table.ids, dtype='int64'))
+
+        with self.lock:
+            self.index = index
+            self.index_layout = index_layout(index)
+            self.delta_ids, self.delta_vectors = delta_ids, delta_vectors
+            self.id_to_path = table.paths
+            self.path_to_id = table.path_ids
+            self.terms = table.terms
+            self.passages = table.passages
+            self.lexical = lexical
+            self.metadata = metadata
+            self.seq = table.seq
+            self.dead_ids = set(dead.tolist())
+            self.generation = Generation(index, delta_ids, delta_vectors, table.paths, table.terms, table.passages,
+                                         metadata.view(), dead, selector, self.index_layout, table.seq)
+            self._table_mtime = mtime
+        logging.info(f"Mapped read-only index at sequence {table.seq}: {len(table.ids)} documents.")
+
+    def _refresh_mapped(self, interval=1.0):
+        now = time.monotonic()
+        if now - self._table_checked < interval:
+            return
+        self._table_checked = now
+        try:
+            if os.stat(self.table_path).st_mtime_ns != self._table_mtime:
+                self.load_mapped()
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not refresh read-only index: {e}")
+
+    def _check_encoder(self, name, d: int):
+        # Vectors of different encoders are not comparable, even when their dimensions agree
+        if (name is not None and name != self.encoder.name) or d != self.d:
+            raise ValueError(f"Index {self.index_path} was built with encoder '{name}' (d={d}), not "
+                             f"'{self.encoder.name}' (d={self.d}); remove its files to rebuild it.")
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError("This VectorIndexer was opened read-only.")
+
+    def _replay_log(self):
+        # The index file may be newer than the map file if a snapshot was interrupted, so replay is idempotent
+        stored = set(faiss.vector_to_array(self.index.id_map).tolist()) | set(self.delta_ids.tolist())
+        replayed = 0
+        for seq, op, doc_id, file_path, vector, meta, words, passage in self.changelog.replay(self.seq, self.d):
+            if op == OP_ADD:
+                if doc_id not in stored:
+                    self.index.add_with_ids(vector.reshape(1, -1), np.array([doc_id], dtype='int64'))
+                    stored.add(doc_id)
+                self.path_to_id.setdefault(file_path, doc_id)
+                self.id_to_path[doc_id] = file_path
+                self.manifest[file_path] = meta
+                self.terms[doc_id] = frozenset(words)
+                self.lexical.add(doc_id, words)
+                if passage is not None:
+                    self.passages[doc_id] = passage
+                self.metadata.add([doc_id], file_path, *meta[:2])
+                self.next_id = max(self.next_id, doc_id + 1)
+            elif self.path_to_id.get(file_path) == doc_id:
+                self._drop_document(file_path)
+            self.seq = seq
+            replayed += 1
+        if replayed:
+            logging.info(f"Replayed {replayed} change log records.")
 
 
 class FileChangeHandler(FileSystemEventHandler):
-    def __init__(self, indexer: VectorIndexer):
+    def __init__(self, indexer: VectorIndexer, debounce=0.5, flush_interval=5.0, max_unsaved=1000):
         self.indexer = indexer
+        self.debounce = debounce
+        self.flush_interval = flush_interval
+        self.max_unsaved = max_unsaved
+
+        # path -> (operation, time of the last event); later events for a path replace earlier ones
+        self.pending = {}
+        self.unsaved = 0
+        self.last_save = time.monotonic()
+        self.condition = threading.Condition()
+        # Held while queued events are applied, so the indexer can be replaced between two batches
+        self.applying = threading.Lock()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
 
     def on_created(self, event):
         if not event.is_directory:
-            self.indexer.add_file(event.src_path)
-            self.indexer.save_index()
+            self._enqueue(event.src_path, 'add')
 
     def on_modified(self, event):
         if not event.is_directory:
-            self.indexer.add_file(event.src_path)
-            self.indexer.save_index()
+            self._enqueue(event.src_path, 'add')
 
     def on_deleted(self, event):
         if not event.is_directory:
-            self.indexer.remove_file(event.src_path)
-            self.indexer.save_index()
+            self._enqueue(event.src_path, 'remove')
 
     def on_moved(self, event):
         if not event.is_directory:
-            self.indexer.remove_file(event.src_path)
-            self.indexer.add_file(event.dest_path)
-            self.indexer.save_index()
\ No newline at end of file
+            self._enqueue(event.src_path, 'remove')
+            self._enqueue(event.dest_path, 'add')
+
+    def stop(self):
+        with self.condition:
+            self._stopped = True
+            self.condition.notify()
+        self._worker.join()
+        with self.applying:
+            self._apply(self._take_ready(force=True))
+            self.indexer.save_index()
+            self.unsaved = 0
+
+    def replace_indexer(self, build) -> VectorIndexer:
+        # Events keep queueing while build() opens the new indexer; they are applied to it afterwards
+        with self.applying:
+            self.indexer = build()
+            self.unsaved = 0
+            return self.indexer
+
+    def _enqueue(self, file_path: str, operation: str):
+        WATCHER_EVENTS[operation].inc()
+        with self.condition:
+            self.pending[file_path] = (operation, time.monotonic())
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if self._stopped:
+                    return
+                self.condition.wait(timeout=self.debounce)
+                if self._stopped:
+                    return
+                ready = self._take_ready()
+            with self.applying:
+                # The events of a failed batch are dropped; reconciliation on the next start picks the files up
+                try:
+                    self._apply(ready)
+                    self._maybe_save()
+                except Exception as e:
+                    WATCHER_ERRORS.inc()
+                    logging.error(f"Failed to apply {len(ready)} file events: {e}")
+
+    def _take_ready(self, force=False) -> dict:
+        with self.condition:
+            now = time.monotonic()
+            ready = {path: operation for path, (operation, seen) in self.pending.items()
+                     if force or now - seen >= self.debounce}
+            for path in ready:
+                del self.pending[path]
+        return ready
+
+    def _apply(self, ready: dict):
+        if not ready:
+            return
+        started = time.perf_counter()
+        added = [path for path, operation in ready.items() if operation == 'add']
+        removed = [path for path, operation in ready.items()
+                   if operation == 'remove' and path in self.indexer.path_to_id]
+        self.indexer.remove_files(removed)
+        self.unsaved += len(removed)
+        if added:
+            self.indexer.add_files(added)
+            self.unsaved += len(added)
+        WATCHER_APPLY_SECONDS.observe(time.perf_counter() - started)
+        WATCHER_BATCH_SIZE.observe(len(ready))
+
+    def _maybe_save(self):
+        if not self.unsaved:
+            # Synced changes reach read-only processes with the next snapshot, which also falls due with time alone
+            self.indexer.maybe_snapshot()
+            return
+        if self.unsaved >= self.max_unsaved or time.monotonic() - self.last_save >= self.flush_interval:
+            self.indexer.sync()
+            self.unsaved = 0
+            self.last_save = time.monotonic()
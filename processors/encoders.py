@@ -0,0 +1,58 @@
+import re
+import zlib
+import numpy as np
+
+# Every encoder has a name, which identifies its vectors in the cache and in a saved index, a dimension, and
+# encode(texts, batch_size) returning one float32 row per text
+
+
+class SentenceTransformerEncoder:
+    def __init__(self, model_name='all-mpnet-base-v2', device=None):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device=device)
+        self.name = model_name
+        self.dimension = self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: list, batch_size=32) -> np.ndarray:
+        return np.ascontiguousarray(self.model.encode(texts, batch_size=batch_size), dtype='float32')
+
+
+class QuantizedEncoder(SentenceTransformerEncoder):
+    def __init__(self, model_name='all-mpnet-base-v2'):
+        import torch
+        super().__init__(model_name, device='cpu')
+        # Linear layers get int8 weights and quantize activations on the fly; the vectors differ slightly from
+        # the float model's, so they get their own name
+        torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        self.name = f"{model_name}:int8"
+
+
+class HashingEncoder:
+    # Signed feature hashing of words and word pairs: deterministic across processes and machines and needs no
+    # model files, for tests and benchmarks; it only matches shared words, not meaning
+    _token = re.compile(r'\w+')
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+        self.name = f"hashing-{dimension}"
+
+    def encode(self, texts: list, batch_size=32) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype='float32')
+        for row, text in enumerate(texts):
+            tokens = self._token.findall(text.lower())
+            features = tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]
+            if not features:
+                continue
+            hashes = np.array([zlib.crc32(feature.encode('utf-8')) for feature in features], dtype='int64')
+            signs = np.where(hashes & (1 << 31), -1.0, 1.0).astype('float32')
+            np.add.at(vectors[row], hashes % self.dimension, signs)
+        return vectors
+
+
+def make_encoder(name: str):
+    # 'hashing' or 'hashing-<dimension>', '<sentence-transformers model>:int8', or a sentence-transformers model
+    if name == 'hashing' or name.startswith('hashing-'):
+        return HashingEncoder(int(name[len('hashing-'):]) if name != 'hashing' else 384)
+    if name.endswith(':int8'):
+        return QuantizedEncoder(name[:-len(':int8')])
+    return SentenceTransformerEncoder(name)
@@ -0,0 +1,279 @@
+import os
+import json
+import struct
+import pickle
+import numpy as np
+
+# Per-document columns, one row per document ID; rows are sorted by the ID column
+COLUMNS = {'ids': 'int64', 'root': 'int16', 'directory': 'int32', 'extension': 'int32', 'size': 'int64',
+           'mtime': 'int64'}
+
+
+def _directory_prefix(directory: str) -> str:
+    return os.path.join(directory, '') if directory else ''
+
+
+def contains(allowed: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    # Boolean mask of the ids that are in the sorted array allowed
+    if not len(allowed):
+        return np.zeros(len(ids), dtype=bool)
+    positions = np.minimum(np.searchsorted(allowed, ids), len(allowed) - 1)
+    return allowed[positions] == ids
+
+
+class DocumentMetadata:
+    def __init__(self, roots: list, compaction_threshold=0.2):
+        self.roots = list(roots)
+        # Directories and extensions are interned; the columns store their codes
+        self.directories = []
+        self.directory_codes = {}
+        # Watch root code of every interned directory, -1 when it is outside all roots
+        self.directory_roots = []
+        self.extensions = []
+        self.extension_codes = {}
+        # Number of rows; the arrays have spare capacity behind it. Rows of removed IDs keep directory -1, which
+        # no filter admits, until they are more than compaction_threshold of all rows and are dropped
+        self.count = 0
+        self.dead = 0
+        self.compaction_threshold = compaction_threshold
+        for name, dtype in COLUMNS.items():
+            setattr(self, name, np.empty(0, dtype=dtype))
+
+    def view(self):
+        # Rows are written in place only for mtime/size of a touched file and to clear removed IDs; new rows go
+        # into spare capacity and compaction builds new arrays, so a generation can share the arrays instead of
+        # copying them; the interned lists are append-only
+        view = DocumentMetadata.__new__(DocumentMetadata)
+        view.__dict__.update(self.__dict__)
+        for name in COLUMNS:
+            setattr(view, name, getattr(self, name)[:self.count])
+        return view
+
+    def add(self, doc_ids: list, file_path: str, size: int, mtime_ns: int):
+        doc_ids = np.asarray(doc_ids, dtype='int64')
+        existing = self._rows(doc_ids)
+        # A removed ID that is added again, e.g. by a replayed change log, gets its row back
+        self.dead -= int(np.count_nonzero(self.directory[existing[existing >= 0]] < 0))
+        self._insert(doc_ids[existing < 0])
+        rows = self._rows(doc_ids)
+
+        directory = self._intern_directory(os.path.dirname(file_path))
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension not in self.extension_codes:
+            self.extension_codes[extension] = len(self.extensions)
+            self.extensions.append(extension)
+        self.root[rows] = self.directory_roots[directory]
+        self.directory[rows] = directory
+        self.extension[rows] = self.extension_codes[extension]
+        self.size[rows] = size
+        self.mtime[rows] = mtime_ns
+
+    def _rows(self, doc_ids: np.ndarray) -> np.ndarray:
+        # Row of every ID, -1 for IDs without one
+        ids = self.ids[:self.count]
+        if not len(ids):
+            return np.full(len(doc_ids), -1, dtype='int64')
+        rows = np.minimum(np.searchsorted(ids, doc_ids), len(ids) - 1)
+        return np.where(ids[rows] == doc_ids, rows, -1)
+
+    def _insert(self, doc_ids: np.ndarray):
+        if not len(doc_ids):
+            return
+        doc_ids = np.sort(doc_ids)
+        if self.count and doc_ids[0] <= self.ids[self.count - 1]:
+            # Only a replayed change log adds IDs below the largest one; the rows are sorted again
+            order = np.argsort(np.concatenate([self.ids[:self.count], doc_ids]), kind='stable')
+            for name, dtype in COLUMNS.items():
+                added = doc_ids if name == 'ids' else np.full(len(doc_ids), -1, dtype=dtype)
+                setattr(self, name, np.concatenate([getattr(self, name)[:self.count], added])[order])
+            self.count += len(doc_ids)
+            return
+        if self.count + len(doc_ids) > len(self.ids):
+            capacity = max(self.count + len(doc_ids), 2 * len(self.ids), 1024)
+            for name, dtype in COLUMNS.items():
+                column = np.full(capacity, -1, dtype=dtype)
+                column[:self.count] = getattr(self, name)[:self.count]
+                setattr(self, name, column)
+        self.ids[self.count:self.count + len(doc_ids)] = doc_ids
+        self.count += len(doc_ids)
+
+    def remove(self, doc_ids: list):
+        # A removed ID must not pass any filter: once compaction drops its vector there is nothing to score
+        rows = self._rows(np.asarray(doc_ids, dtype='int64'))
+        self._clear(rows[rows >= 0])
+
+    def retain(self, live_ids: np.ndarray):
+        # Clears the rows of every ID outside live_ids, e.g. when the metadata file is newer than the snapshot
+        # it is loaded with, or was written before removed rows were cleared
+        self._clear(np.flatnonzero(~np.isin(self.ids[:self.count], live_ids)))
+
+    def _clear(self, rows: np.ndarray):
+        rows = rows[self.directory[rows] >= 0]
+        self.directory[rows] = -1
+        self.dead += len(rows)
+        if self.dead and self.dead > self.compaction_threshold * self.count:
+            self._compact()
+
+    def _compact(self):
+        keep = self.directory[:self.count] >= 0
+        for name in COLUMNS:
+            setattr(self, name, getattr(self, name)[:self.count][keep])
+        self.count = int(np.count_nonzero(keep))
+        self.dead = 0
+
+    def touch(self, doc_ids: list, size: int, mtime_ns: int):
+        rows = self._rows(np.asarray(doc_ids, dtype='int64'))
+        rows = rows[rows >= 0]
+        self.size[rows] = size
+        self.mtime[rows] = mtime_ns
+
+    def _intern_directory(self, directory: str) -> int:
+        code = self.directory_codes.get(directory)
+        if code is None:
+            prefix = _directory_prefix(os.path.normpath(directory))
+            root = next((code for code, root in enumerate(self.roots)
+                         if prefix.startswith(_directory_prefix(os.path.normpath(root)))), -1)
+            code = self.directory_codes[directory] = len(self.directories)
+            self.directories.append(directory)
+            self.directory_roots.append(root)
+        return code
+
+
+# magic, log sequence number, number of rows, length of the JSON interned lists; the lists and every column
+# follow, each padded to 8 bytes, so a read-only process maps the columns instead of unpickling them
+METADATA_HEADER = struct.Struct('<8sqqq')
+METADATA_MAGIC = b'VSMETA02'
+# Version 1 had no ID column: row i described ID i, and every ID up to the largest one had a row
+METADATA_MAGIC_V1 = b'VSMETA01'
+
+
+def _padding(size: int) -> bytes:
+    return bytes(-size % 8)
+
+
+def write_metadata(path: str, metadata: DocumentMetadata, seq: int):
+    names = json.dumps({'roots': metadata.roots, 'directories': metadata.directories,
+                        'directory_roots': metadata.directory_roots, 'extensions': metadata.extensions}).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(METADATA_HEADER.pack(METADATA_MAGIC, seq, metadata.count, len(names)))
+        f.write(names + _padding(len(names)))
+        for name in COLUMNS:
+            column = getattr(metadata, name)[:metadata.count].tobytes()
+            f.write(column + _padding(len(column)))
+
+
+def read_metadata(path: str, mapped=False):
+    # (metadata, log sequence number); mapped columns are copy-on-write, so a reader can still clear rows of IDs
+    # its table does not have while the pages it does not touch stay shared with the page cache
+    with open(path, 'rb') as f:
+        magic = f.read(len(METADATA_MAGIC))
+    if magic not in (METADATA_MAGIC, METADATA_MAGIC_V1):
+        # Pickled by versions before the mapped layout, which had no ID column either
+        with open(path, 'rb') as f:
+            stored = pickle.load(f)
+        metadata = DocumentMetadata(stored['metadata'].roots)
+        metadata.__dict__.update(stored['metadata'].__dict__)
+        metadata.ids = np.arange(len(metadata.root), dtype='int64')
+        metadata.dead = int(np.count_nonzero(metadata.directory[:metadata.count] < 0))
+        return metadata, stored['seq']
+    data = np.memmap(path, dtype='uint8', mode='c')
+    _, seq, count, names_length = METADATA_HEADER.unpack(bytes(data[:METADATA_HEADER.size]))
+    position = METADATA_HEADER.size
+    names = json.loads(bytes(data[position:position + names_length]).decode('utf-8'))
+    position += names_length + len(_padding(names_length))
+
+    metadata = DocumentMetadata(names['roots'])
+    metadata.directories = names['directories']
+    metadata.directory_codes = {directory: code for code, directory in enumerate(metadata.directories)}
+    metadata.directory_roots = names['directory_roots']
+    metadata.extensions = names['extensions']
+    metadata.extension_codes = {extension: code for code, extension in enumerate(metadata.extensions)}
+    metadata.count = count
+    metadata.ids = np.arange(count, dtype='int64')
+    for name, dtype in COLUMNS.items():
+        if name == 'ids' and magic == METADATA_MAGIC_V1:
+            continue
+        size = count * np.dtype(dtype).itemsize
+        column = data[position:position + size].view(dtype)
+        setattr(metadata, name, column if mapped else np.array(column))
+        position += size + len(_padding(size))
+    # Rows of IDs that were removed, or of version 1 IDs that never had a document; retain() drops them
+    metadata.dead = int(np.count_nonzero(metadata.directory < 0))
+    return metadata, seq
+
+
+class SearchFilter:
+    def __init__(self, prefix=None, extensions=None, roots=None, min_size=None, max_size=None,
+                 modified_after=None, modified_before=None):
+        # A path prefix as the paths are indexed, e.g. 'local_fs/reports/' or 'local_fs/reports/2024-'
+        self.prefix = prefix
+        self.extensions = None if extensions is None else frozenset(
+            extension.lower() if extension.startswith('.') or not extension else '.' + extension.lower()
+            for extension in extensions)
+        self.roots = None if roots is None else frozenset(os.path.normpath(root) for root in roots)
+        self.min_size = min_size
+        self.max_size = max_size
+        # Unix timestamps in seconds
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+
+    def _key(self) -> tuple:
+        return (self.prefix, self.extensions, self.roots, self.min_size, self.max_size, self.modified_after,
+                self.modified_before)
+
+    def __eq__(self, other):
+        return isinstance(other, SearchFilter) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={value!r}" for name, value in vars(self).items() if value is not None)
+        return f"SearchFilter({fields})"
+
+    def may_match(self, root: str) -> bool:
+        # Whether any document under the watch root can pass; lets a sharded search skip whole shards
+        if self.roots is not None and os.path.normpath(root) not in self.roots:
+            return False
+        if self.prefix is not None:
+            root = _directory_prefix(root)
+            return self.prefix.startswith(root) or root.startswith(self.prefix)
+        return True
+
+    def mask(self, metadata: DocumentMetadata, id_to_path) -> np.ndarray:
+        # Boolean mask over the rows of metadata
+        allowed = metadata.directory >= 0
+        if self.roots is not None:
+            codes = [code for code, root in enumerate(metadata.roots) if os.path.normpath(root) in self.roots]
+            allowed &= np.isin(metadata.root, codes)
+        if self.extensions is not None:
+            codes = [metadata.extension_codes[extension] for extension in self.extensions
+                     if extension in metadata.extension_codes]
+            allowed &= np.isin(metadata.extension, codes)
+        if self.min_size is not None:
+            allowed &= metadata.size >= self.min_size
+        if self.max_size is not None:
+            allowed &= metadata.size <= self.max_size
+        if self.modified_after is not None:
+            allowed &= metadata.mtime >= int(self.modified_after * 1e9)
+        if self.modified_before is not None:
+            allowed &= metadata.mtime < int(self.modified_before * 1e9)
+        if self.prefix is not None:
+            allowed &= self._prefix_mask(metadata, id_to_path)
+        return allowed
+
+    def _prefix_mask(self, metadata: DocumentMetadata, id_to_path) -> np.ndarray:
+        # Prefixes are matched against the few distinct directories; only files directly inside the directory
+        # the prefix ends in need their own path compared
+        whole, partial = [], []
+        for code, directory in enumerate(metadata.directories):
+            directory = _directory_prefix(directory)
+            if directory.startswith(self.prefix):
+                whole.append(code)
+            elif self.prefix.startswith(directory) and os.sep not in self.prefix[len(directory):]:
+                partial.append(code)
+        allowed = np.isin(metadata.directory, whole)
+        for row in np.flatnonzero(np.isin(metadata.directory, partial)).tolist():
+            file_path = id_to_path.get(int(metadata.ids[row]))
+            allowed[row] = file_path is not None and file_path.startswith(self.prefix)
+        return allowed
@@ -0,0 +1,300 @@
+import struct
+import pickle
+import threading
+import logging
+from bisect import bisect_left
+from array import array
+from collections import Counter
+import numpy as np
+from .filters import contains
+
+
+class InvertedIndex:
+    def __init__(self, k1=1.5, b=0.75, compaction_threshold=0.2):
+        self.k1 = k1
+        self.b = b
+        self.compaction_threshold = compaction_threshold
+        # One row per document: its ID and its number of words, 0 once it is removed; the rows of removed
+        # documents are dropped with their postings by the next compaction
+        self.doc_ids = array('q')
+        self.lengths = array('I')
+        # Rows are in ID order unless a replayed change log added an ID below the largest one
+        self.ordered = True
+        # term -> (document rows, term frequencies); postings are appended in row order
+        self.postings = {}
+        self.documents = 0
+        self.total_length = 0
+        # Removed documents whose rows and postings are still stored until the next compaction
+        self.dead = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'doc_ids' not in state:
+            # Pickled before documents had rows: the postings and lengths were indexed by document ID
+            self.doc_ids = array('q', range(len(self.lengths)))
+            self.ordered = True
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.documents
+
+    def _row(self, doc_id: int) -> int:
+        # Row of the document ID, -1 if it has none
+        if self.ordered:
+            row = bisect_left(self.doc_ids, doc_id)
+            return row if row < len(self.doc_ids) and self.doc_ids[row] == doc_id else -1
+        try:
+            return self.doc_ids.index(doc_id)
+        except ValueError:
+            return -1
+
+    def add(self, doc_id: int, words: list):
+        if not words:
+            return
+        with self.lock:
+            if self.doc_ids and doc_id <= self.doc_ids[-1]:
+                row = self._row(doc_id)
+                if row >= 0 and self.lengths[row]:
+                    # Already indexed: the change log is replayed over a snapshot that may be newer than the maps
+                    return
+                if row >= 0:
+                    # Removed and added again by a replayed change log: its old postings go first
+                    self._compact()
+                if self.doc_ids and doc_id < self.doc_ids[-1]:
+                    self.ordered = False
+            row = len(self.doc_ids)
+            self.doc_ids.append(doc_id)
+            self.lengths.append(len(words))
+            self.documents += 1
+            self.total_length += len(words)
+            for term, count in Counter(words).items():
+                rows, counts = self.postings.setdefault(term, (array('q'), array('I')))
+                rows.append(row)
+                counts.append(count)
+
+    def remove(self, doc_id: int):
+        with self.lock:
+            row = self._row(doc_id)
+            if row < 0 or not self.lengths[row]:
+                return
+            self.total_length -= self.lengths[row]
+            self.lengths[row] = 0
+            self.documents -= 1
+            self.dead += 1
+            if self.dead > self.compaction_threshold * (self.documents + self.dead):
+                self._compact()
+
+    def _compact(self):
+        # Drops the rows of removed documents and their postings in one pass, and puts the rows in ID order
+        lengths = np.frombuffer(self.lengths, dtype='uint32')
+        doc_ids = np.frombuffer(self.doc_ids, dtype='int64')
+        live = np.flatnonzero(lengths > 0)
+        order = live[np.argsort(doc_ids[live], kind='stable')]
+        new_rows = np.full(len(lengths), -1, dtype='int64')
+        new_rows[order] = np.arange(len(order))
+        postings = {}
+        for term, (rows, counts) in self.postings.items():
+            rows_view = new_rows[np.frombuffer(rows, dtype='int64')]
+            keep = rows_view >= 0
+            if keep.any():
+                postings[term] = (array('q', rows_view[keep].tobytes()),
+                                  array('I', np.frombuffer(counts, dtype='uint32')[keep].tobytes()))
+        logging.info(f"Compacted inverted index: dropped rows and postings of {self.dead} removed documents.")
+        self.doc_ids = array('q', doc_ids[order].tobytes())
+        self.lengths = array('I', lengths[order].tobytes())
+        del lengths, doc_ids
+        self.postings = postings
+        self.ordered = True
+        self.dead = 0
+
+    def _postings(self, term: str):
+        postings = self.postings.get(term)
+        if postings is None:
+            return None
+        return np.frombuffer(postings[0], dtype='int64'), np.frombuffer(postings[1], dtype='uint32')
+
+    def _lengths(self):
+        return np.frombuffer(self.lengths, dtype='uint32')
+
+    def _doc_ids(self):
+        return np.frombuffer(self.doc_ids, dtype='int64')
+
+    def _match(self, term: str, lengths, doc_ids, allowed):
+        # The views of the posting arrays end with this call, so the writer can append to them afterwards
+        postings = self._postings(term)
+        if postings is None:
+            return None
+        rows, counts = postings
+        live = lengths[rows] > 0
+        # Document frequency counts every live document, so a filter does not change the scores it keeps
+        frequency = int(np.count_nonzero(live))
+        if allowed is not None:
+            live[live] = contains(allowed, doc_ids[rows[live]])
+        if not live.any():
+            return None
+        return rows[live], counts[live].astype('float32'), frequency
+
+    def statistics(self, words: list) -> tuple:
+        # Live documents, their total length and the live document frequency of every word that has postings
+        with self.lock:
+            lengths = self._lengths()
+            frequencies = {}
+            for term in set(words):
+                postings = self._postings(term)
+                if postings is not None:
+                    frequencies[term] = int(np.count_nonzero(lengths[postings[0]] > 0))
+            del lengths
+            return self.documents, self.total_length, frequencies
+
+    def search(self, words: list, top_k: int, allowed=None, statistics=None):
+        # allowed is a sorted array of the IDs that may be returned. statistics replaces the
+        # index's own counts (see statistics()) when several indexes are scored as one collection
+        with self.lock:
+            if not self.documents:
+                return np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+            documents, total_length, frequencies = statistics or (self.documents, self.total_length, None)
+            lengths, doc_ids = self._lengths(), self._doc_ids()
+            average_length = total_length / documents
+            matched_ids, matched_scores = [], []
+            for term in set(words):
+                match = self._match(term, lengths, doc_ids, allowed)
+                if match is None:
+                    continue
+                rows, tf, frequency = match
+                if frequencies is not None:
+                    frequency = frequencies[term]
+                idf = np.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * lengths[rows] / average_length)
+                matched_ids.append(doc_ids[rows])
+                matched_scores.append(idf * tf * (self.k1 + 1) / (tf + norm))
+            del lengths, doc_ids
+
+        if not matched_ids:
+            return np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+        ids, positions = np.unique(np.concatenate(matched_ids), return_inverse=True)
+        scores = np.bincount(positions, weights=np.concatenate(matched_scores)).astype('float32')
+        if len(ids) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+            ids, scores = ids[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        return scores[order], ids[order]
+
+
+# magic, log sequence number, documents, total length, dead documents, terms, postings, document rows, k1, b;
+# followed by the term and posting offsets, posting rows and the document IDs of the rows (int64), term
+# frequencies and document lengths (uint32) and the sorted terms, so a read-only process maps the postings
+# instead of unpickling them
+LEXICAL_HEADER = struct.Struct('<8sqqqqqqqdd')
+LEXICAL_MAGIC = b'VSLEX002'
+# Version 1 had no document IDs: postings held IDs and the lengths were indexed by ID
+LEXICAL_MAGIC_V1 = b'VSLEX001'
+
+
+def write_inverted_index(path: str, index: InvertedIndex, seq: int):
+    with index.lock:
+        terms = sorted(index.postings)
+        term_bytes = [term.encode('utf-8') for term in terms]
+        term_offsets = np.zeros(len(terms) + 1, dtype='int64')
+        term_offsets[1:] = np.cumsum([len(term) for term in term_bytes])
+        posting_offsets = np.zeros(len(terms) + 1, dtype='int64')
+        posting_offsets[1:] = np.cumsum([len(index.postings[term][0]) for term in terms])
+        with open(path, 'wb') as f:
+            f.write(LEXICAL_HEADER.pack(LEXICAL_MAGIC, seq, index.documents, index.total_length, index.dead,
+                                        len(terms), int(posting_offsets[-1]), len(index.lengths), index.k1,
+                                        index.b))
+            f.write(term_offsets.tobytes())
+            f.write(posting_offsets.tobytes())
+            f.write(b''.join(index.postings[term][0] for term in terms))
+            f.write(index.doc_ids.tobytes())
+            f.write(b''.join(index.postings[term][1] for term in terms))
+            f.write(index.lengths.tobytes())
+            f.write(b''.join(term_bytes))
+
+
+class MappedInvertedIndex(InvertedIndex):
+    # The saved index of a read-only process; only search() and statistics() are supported
+    def __init__(self, path: str):
+        self.data = np.memmap(path, dtype='uint8', mode='r')
+        (magic, self.seq, self.documents, self.total_length, self.dead, terms, postings, rows, self.k1,
+         self.b) = LEXICAL_HEADER.unpack(bytes(self.data[:LEXICAL_HEADER.size]))
+        self.compaction_threshold = 0.0
+        self.lock = threading.Lock()
+        position = LEXICAL_HEADER.size
+        self.term_offsets = self.data[position:position + 8 * (terms + 1)].view('int64')
+        position += 8 * (terms + 1)
+        self.posting_offsets = self.data[position:position + 8 * (terms + 1)].view('int64')
+        position += 8 * (terms + 1)
+        self.rows = self.data[position:position + 8 * postings].view('int64')
+        position += 8 * postings
+        if magic == LEXICAL_MAGIC_V1:
+            self.doc_ids = np.arange(rows, dtype='int64')
+        else:
+            self.doc_ids = self.data[position:position + 8 * rows].view('int64')
+            position += 8 * rows
+        self.counts = self.data[position:position + 4 * postings].view('uint32')
+        position += 4 * postings
+        self.lengths = self.data[position:position + 4 * rows].view('uint32')
+        position += 4 * rows
+        self.term_blob = self.data[position:]
+        self.term_count = terms
+        self.ordered = bool(np.all(self.doc_ids[1:] > self.doc_ids[:-1]))
+
+    def _term(self, row: int) -> str:
+        return bytes(self.term_blob[self.term_offsets[row]:self.term_offsets[row + 1]]).decode('utf-8')
+
+    def _postings(self, term: str):
+        # Binary search over the sorted terms, decoding only the ones it compares
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            found = self._term(middle)
+            if found < term:
+                low = middle + 1
+            elif found > term:
+                high = middle
+            else:
+                start, end = self.posting_offsets[middle], self.posting_offsets[middle + 1]
+                return self.rows[start:end], self.counts[start:end]
+        return None
+
+    def _lengths(self):
+        return self.lengths
+
+    def _doc_ids(self):
+        return self.doc_ids
+
+
+def read_inverted_index(path: str, mapped=False):
+    # (index, log sequence number); the writer gets its own arrays, which it appends to
+    with open(path, 'rb') as f:
+        magic = f.read(len(LEXICAL_MAGIC))
+    if magic not in (LEXICAL_MAGIC, LEXICAL_MAGIC_V1):
+        # Pickled by versions before the mapped layout
+        with open(path, 'rb') as f:
+            lexical = pickle.load(f)
+        return lexical['index'], lexical['seq']
+    mapped_index = MappedInvertedIndex(path)
+    if mapped:
+        return mapped_index, mapped_index.seq
+    index = InvertedIndex(mapped_index.k1, mapped_index.b)
+    index.documents = mapped_index.documents
+    index.total_length = mapped_index.total_length
+    index.dead = mapped_index.dead
+    index.doc_ids = array('q', mapped_index.doc_ids.tobytes())
+    index.lengths = array('I', mapped_index.lengths.tobytes())
+    index.ordered = mapped_index.ordered
+    rows, counts, offsets = mapped_index.rows, mapped_index.counts, mapped_index.posting_offsets
+    for row in range(mapped_index.term_count):
+        start, end = offsets[row], offsets[row + 1]
+        index.postings[mapped_index._term(row)] = (array('q', rows[start:end].tobytes()),
+                                                   array('I', counts[start:end].tobytes()))
+    if magic == LEXICAL_MAGIC_V1 and len(index.lengths) > index.documents:
+        # Every ID up to the largest one had a row; the rows of IDs without a document are dropped
+        index._compact()
+    return index, mapped_index.seq
@@ -0,0 +1,49 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+def content_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def is_under(file_path: str, roots: list) -> bool:
+    return any(file_path == root or file_path.startswith(os.path.join(root, '')) for root in roots)
+
+
+def _scan_dir(path: str):
+    files, dirs = {}, []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        pass
+    return files, dirs
+
+
+def scan_tree(roots: list, workers=None) -> dict:
+    found = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = [pool.submit(_scan_dir, root) for root in roots if os.path.isdir(root)]
+        while pending:
+            files, dirs = pending.pop().result()
+            found.update(files)
+            pending.extend(pool.submit(_scan_dir, path) for path in dirs)
+    return found
+
+
+def diff_manifest(manifest: dict, indexed: set, found: dict, roots: list):
+    deleted = [path for path in indexed if path not in found and is_under(path, roots)]
+    added, suspect = [], []
+    for path, (size, mtime_ns) in found.items():
+        if path not in indexed:
+            added.append(path)
+        elif path not in manifest or manifest[path][:2] != (size, mtime_ns):
+            # Stat changed, but the content may not have; the caller compares digests before re-encoding
+            suspect.append(path)
+    return added, suspect, deleted
@@ -1,8 +1,8 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
-from . import VectorIndexer
-from . import VectorSearch
+from . import ShardedIndexer
+from . import ShardedSearch
+from .shards import shard_path
 
 class MetricsCalculator:
     def __init__(self, results: list, ground_truth: list):
@@ -101,22 +101,76 @@ class MetricsCalculator:
         return interpolated_precisions
 
     def plot_precision_recall_curve(self, save_path="precision_recall_curve.png"):
-        recall_levels = np.linspace(0.0, 1.0, 11)
-        interpolated_precisions = self.get_interpolated_11_points()
-        
-        plt.figure(figsize=(10, 6))
-        plt.plot(recall_levels, interpolated_precisions, marker='o', linestyle='--')
-        plt.xlabel("Полнота (Recall)")
-        plt.ylabel("Точность (Precision)")
-        plt.title("11-точечный график Полнота-Точность")
-        plt.grid(True)
-        plt.xticks(recall_levels)
-        plt.yticks(np.linspace(0.0, 1.0, 11))
-        plt.ylim(0, 1.05)
-        plt.xlim(0, 1.0)
-        
-        plt.savefig(save_path)
-        print(f"График сохранен в файл: {save_path}")
+        plot_11_point_curve(self.get_interpolated_11_points(), save_path)
+
+
+class BatchMetricsCalculator:
+    # The metrics of MetricsCalculator for a whole query set at once, computed on a queries x ranks matrix that
+    # marks the relevant results
+    def __init__(self, results: list, ground_truths: list, k_values=(5, 10)):
+        self.k_values = k_values
+        depth = max([len(query_results) for query_results in results] + [1])
+        self.relevant = np.zeros((len(results), depth), dtype=bool)
+        self.found = np.array([len(query_results) for query_results in results], dtype='float64')
+        for row, (query_results, truth) in enumerate(zip(results, ground_truths)):
+            truth = set(truth)
+            self.relevant[row, :len(query_results)] = [res['path'] in truth for res in query_results]
+        self.total_relevant = np.array([len(set(truth)) for truth in ground_truths], dtype='float64')
+
+        self.hits = np.cumsum(self.relevant, axis=1)
+        ranks = np.arange(1, depth + 1)
+        self.precision_at = self.hits / ranks
+        self.recall_at = self.hits / np.maximum(self.total_relevant, 1)[:, None]
+
+    def per_query(self) -> dict:
+        tp = self.hits[:, -1]
+        has_relevant = self.total_relevant > 0
+        precision = np.divide(tp, self.found, out=np.zeros_like(tp, dtype='float64'), where=self.found > 0)
+        recall = np.where(has_relevant, tp / np.maximum(self.total_relevant, 1), 0.0)
+        f_measure = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(precision),
+                              where=precision + recall > 0)
+        metrics = {'Precision': precision, 'Recall': recall, 'F-measure': f_measure}
+
+        for n in self.k_values:
+            metrics[f'Precision@{n}'] = self.relevant[:, :n].sum(axis=1) / n
+        within_r = np.arange(self.relevant.shape[1]) < self.total_relevant[:, None]
+        metrics['R-Precision'] = np.where(has_relevant, (self.relevant & within_r).sum(axis=1)
+                                          / np.maximum(self.total_relevant, 1), 0.0)
+        metrics['Average Precision'] = np.where(
+            has_relevant, (self.precision_at * self.relevant).sum(axis=1) / np.maximum(self.total_relevant, 1), 0.0)
+        return metrics
+
+    def interpolated_11_points(self) -> np.ndarray:
+        # queries x 11: the best precision at a relevant result whose recall reaches each level
+        levels = np.linspace(0.0, 1.0, 11)
+        reached = self.relevant[:, :, None] & (self.recall_at[:, :, None] >= levels)
+        return np.where(reached, self.precision_at[:, :, None], 0.0).max(axis=1)
+
+    def summary(self) -> dict:
+        summary = {name: float(values.mean()) if len(values) else 0.0 for name, values in self.per_query().items()}
+        summary['MAP'] = summary.pop('Average Precision')
+        curve = self.interpolated_11_points()
+        summary['11-point'] = (curve.mean(axis=0) if len(curve) else np.zeros(11)).tolist()
+        return summary
+
+
+def plot_11_point_curve(interpolated_precisions: list, save_path="precision_recall_curve.png"):
+    import matplotlib.pyplot as plt
+    recall_levels = np.linspace(0.0, 1.0, 11)
+
+    plt.figure(figsize=(10, 6))
+    plt.plot(recall_levels, interpolated_precisions, marker='o', linestyle='--')
+    plt.xlabel("Полнота (Recall)")
+    plt.ylabel("Точность (Precision)")
+    plt.title("11-точечный график Полнота-Точность")
+    plt.grid(True)
+    plt.xticks(recall_levels)
+    plt.yticks(np.linspace(0.0, 1.0, 11))
+    plt.ylim(0, 1.05)
+    plt.xlim(0, 1.0)
+    
+    plt.savefig(save_path)
+    print(f"График сохранен в файл: {save_path}")
 
 # evaluate.py
 
@@ -124,29 +178,36 @@ class MetricsCalculator:
 import os
 def run_evaluation():
     # --- Конфигурация ---
-    # Указываем пути к файлам индекса, как и в main.py
+    # Папки, пути индекса и параметры те же, что и в main.py: у каждой папки свой шард
+    PATHS_TO_WATCH = ["local_fs", "local_fs2"]
     INDEX_PATH = "processors/vector_index.faiss"
     MAP_PATH = "processors/path_map.pkl"
-
-    # <<< НОВОЕ: Сначала проверяем, существуют ли файлы индекса
-    if not os.path.exists(INDEX_PATH) or not os.path.exists(MAP_PATH):
-        print(f"Ошибка: файлы индекса не найдены по путям '{INDEX_PATH}' и '{MAP_PATH}'.")
+    ENCODER = os.environ.get("SEARCH_ENCODER", "all-mpnet-base-v2")
+    CHUNK_TOKENS = 256
+    CHUNK_OVERLAP = 32
+    SEARCH_MODE = "hybrid"
+
+    # Сначала проверяем, что main.py уже записал снимки всех шардов
+    missing = [root for root in PATHS_TO_WATCH if not os.path.exists(shard_path(MAP_PATH, root) + '.docs')]
+    if missing:
+        print(f"Ошибка: нет снимков индекса для папок {missing} рядом с '{MAP_PATH}'.")
         print("Сначала запустите основное приложение (main.py), чтобы создать индекс.")
         return
 
     # --- Загрузка индекса ---
     print("Загрузка индекса...")
     try:
-        # Пути для сканирования здесь не важны, т.к. мы только загружаем готовый индекс
-        indexer = VectorIndexer(watch_paths=[], index_path=INDEX_PATH, map_path=MAP_PATH)
-        if indexer.index.ntotal == 0:
+        # Только чтение: снимок отображается в память и не мешает работающему main.py
+        indexer = ShardedIndexer(watch_paths=PATHS_TO_WATCH, index_path=INDEX_PATH, map_path=MAP_PATH, read_only=True,
+                                 model_name=ENCODER, chunk_tokens=CHUNK_TOKENS, chunk_overlap=CHUNK_OVERLAP)
+        if not any(stats['live'] for stats in indexer.stats().values()):
             print("Ошибка: индекс найден, но он пуст. Проиндексируйте файлы в основном приложении.")
             return
     except Exception as e:
         print(f"Произошла ошибка при загрузке индекса: {e}")
         return
         
-    search_engine = VectorSearch(indexer=indexer)
+    search_engine = ShardedSearch(indexer=indexer, mode=SEARCH_MODE)
     
     # ... (остальная часть функции остается без изменений) ...
     query = input("Введите тестовый запрос: ")
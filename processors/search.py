@@ -1,39 +1,299 @@
+import asyncio
+import time
 import faiss
+import numpy as np
 from .crawler import VectorIndexer
-from .text_processing import normalize
+from .text_processing import normalize, normalize_many
+from .telemetry import REGISTRY, SIZE_BUCKETS
+
+SEARCH_BATCH_SIZE = REGISTRY.histogram('search_batch_size', 'Queries per search batch', SIZE_BUCKETS)
+
+
+def record_timings(kind: str, timings: dict):
+    # kind is 'search' or 'similar'; every stage of the call goes into its own histogram
+    REGISTRY.observe_stages(f"{kind}_stage_seconds", f"Time per {kind} call by stage", timings)
+
 
 class VectorSearch:
-    def __init__(self, indexer: VectorIndexer):
-        self.model = indexer.model
-        self.index = indexer.index
-        self.id_to_path = indexer.id_to_path
+    def __init__(self, indexer: VectorIndexer, scoring='max', candidates=4, mode='vector', fusion_k=60,
+                 prefilter=0):
+        self.indexer = indexer
+        self.encoder = indexer.encoder
+        # A document scores as its best passage ('max') or as the total of its retrieved passages ('sum')
+        self.scoring = scoring
+        # Chunked indexes retrieve candidates * top_k passages so that enough distinct documents remain
+        self.candidates = candidates
+        # 'vector', 'lexical' (BM25) or 'hybrid', which runs both and fuses the rankings by reciprocal rank
+        self.mode = mode
+        self.fusion_k = fusion_k
+        # In hybrid mode a positive prefilter scores only that many best lexical passages with vectors
+        # instead of searching the whole vector index
+        self.prefilter = prefilter
+        # Seconds spent in each stage by the last batch
+        self.timings = {}
+
+    def search(self, query: str, top_k=5, search_filter=None) -> list:
+        return self.search_many([query], top_k, search_filter)[0]
+
+    def search_many(self, queries: list, top_k=5, search_filter=None, timings=None) -> list:
+        # A timings dict passed in receives the seconds spent in each stage of this call alone
+        timings = {} if timings is None else timings
+        if not self.indexer.snapshot().id_to_path:
+            return [[] for _ in queries]
+        query_words, query_embeddings = self.prepare(queries, timings)
+        results = self.search_prepared(query_words, query_embeddings, top_k, timings, search_filter)
+        SEARCH_BATCH_SIZE.observe(len(queries))
+        record_timings('search', timings)
+        return results
+
+    def prepare(self, queries: list, timings: dict) -> tuple:
+        # Normalized words and embeddings of the queries, computed once however many indexes are searched
+        started = time.perf_counter()
+        query_words = normalize_many(queries)
+        timings['normalize'] = time.perf_counter() - started
+
+        query_embeddings = None
+        if self.mode != 'lexical':
+            started = time.perf_counter()
+            query_embeddings = self.encoder.encode(queries)
+            faiss.normalize_L2(query_embeddings)
+            timings['encode'] = time.perf_counter() - started
+        return query_words, query_embeddings
+
+    def search_prepared(self, query_words: list, query_embeddings, top_k=5, timings=None,
+                        search_filter=None) -> list:
+        timings = {} if timings is None else timings
+        rankings = self.rank_prepared(query_words, query_embeddings, top_k, timings, search_filter)
+        started = time.perf_counter()
+        results = [self._fuse(query_rankings, top_k) for query_rankings in rankings]
+        timings['collect'] = timings.get('collect', 0.0) + time.perf_counter() - started
+        self.timings = timings
+        return results
+
+    def rank_prepared(self, query_words: list, query_embeddings, top_k=5, timings=None, search_filter=None,
+                      statistics=None) -> list:
+        # Every query gets one ranking of fetch_k documents per retriever (vector first, then lexical), not yet
+        # fused; statistics holds the BM25 collection statistics of every query when several indexes are fused
+        timings = {} if timings is None else timings
+        # The whole batch reads one generation, so every ID it returns resolves in the maps it returns them with
+        generation = self.indexer.snapshot()
+        if not generation.id_to_path:
+            return [[] for _ in query_words]
+        fetch_k = self.fetch_k(top_k)
+
+        allowed = None
+        if search_filter is not None:
+            # The filter restricts the candidates of both retrievers instead of dropping hits afterwards
+            started = time.perf_counter()
+            allowed = generation.allowed(search_filter)
+            timings['filter'] = time.perf_counter() - started
+            if not len(allowed):
+                return [[] for _ in query_words]
+
+        lexical = None
+        if self.mode != 'vector':
+            started = time.perf_counter()
+            lexical_k = max(fetch_k, self.prefilter) if self.mode == 'hybrid' else fetch_k
+            lexical = [self.indexer.search_lexical(words, lexical_k, allowed,
+                                                   statistics[row] if statistics else None)
+                       for row, words in enumerate(query_words)]
+            timings['lexical'] = time.perf_counter() - started
+
+        vector = None
+        if self.mode != 'lexical':
+            started = time.perf_counter()
+            if self.prefilter and lexical is not None:
+                vector = self._prefiltered(generation, query_embeddings, lexical, fetch_k, allowed)
+            else:
+                vector = self.indexer.search_vectors(query_embeddings, fetch_k, generation, allowed)
+            timings['vector'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        maps = generation.id_to_path, generation.terms, generation.passages
+        rankings = []
+        for row, words in enumerate(query_words):
+            query_rankings = []
+            if vector is not None:
+                query_rankings.append(self._collect(words, vector[0][row], vector[1][row], *maps, fetch_k))
+            if lexical is not None:
+                query_rankings.append(self._collect(words, lexical[row][0], lexical[row][1], *maps, fetch_k))
+            rankings.append(query_rankings)
+        timings['collect'] = time.perf_counter() - started
+        return rankings
+
+    def fetch_k(self, top_k: int) -> int:
+        return top_k * self.candidates if self.indexer.chunk_tokens else top_k
+
+    def similar(self, file_path: str, top_k=5, search_filter=None, timings=None):
+        # "More like this": the stored vectors of the file are the query, nothing is read or encoded again
+        timings = {} if timings is None else timings
+        started = time.perf_counter()
+        vector = self.indexer.document_vector(file_path)
+        timings['lookup'] = time.perf_counter() - started
+        if vector is None:
+            return None
+        started = time.perf_counter()
+        results = self.search_by_vector(vector, top_k, search_filter, exclude=file_path)
+        timings['vector'] = time.perf_counter() - started
+        record_timings('similar', timings)
+        return results
 
-    def search(self, query: str, top_k=5) -> list:
-        if self.index.ntotal == 0:
+    def search_by_vector(self, query_embedding, top_k=5, search_filter=None, exclude=None) -> list:
+        generation = self.indexer.snapshot()
+        if not generation.id_to_path:
             return []
+        allowed = None
+        if search_filter is not None:
+            allowed = generation.allowed(search_filter)
+            if not len(allowed):
+                return []
+        fetch_k = self.fetch_k(top_k)
+        # The excluded file matches itself best, so its own passages are fetched on top and dropped
+        excluded = len(self.indexer.document_ids(exclude, generation)) if exclude is not None else 0
+        similarities, indices = self.indexer.search_vectors(query_embedding, fetch_k + excluded, generation, allowed)
+        results = self._collect([], similarities[0], indices[0], generation.id_to_path, generation.terms,
+                                generation.passages, fetch_k + excluded)
+        return [result for result in results if result['path'] != exclude][:top_k]
 
-        query_embedding = self.model.encode([query])
-        faiss.normalize_L2(query_embedding.astype('float32'))
-        
-        similarities, indices = self.index.search(query_embedding, top_k)   
-        normalized_query_words = set(normalize(query))
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx in self.id_to_path: 
-                file_path = self.id_to_path[idx]
-                
-                found_words = []
+    def _prefiltered(self, generation, query_embeddings, lexical: list, fetch_k: int, allowed=None):
+        candidates = np.full((len(lexical), self.prefilter), -1, dtype='int64')
+        for row, (_, ids) in enumerate(lexical):
+            ids = ids[:self.prefilter]
+            candidates[row, :len(ids)] = ids
+        similarities, indices = self.indexer.search_candidates(query_embeddings, candidates, fetch_k, generation)
+
+        # Queries without a single lexical match fall back to searching the whole vector index
+        unmatched = [row for row, (_, ids) in enumerate(lexical) if not len(ids)]
+        if unmatched:
+            similarities[unmatched], indices[unmatched] = self.indexer.search_vectors(
+                query_embeddings[unmatched], fetch_k, generation, allowed)
+        return similarities, indices
+
+    def _fuse(self, rankings: list, top_k: int) -> list:
+        if len(rankings) < 2:
+            # A single retriever keeps its own scores
+            return rankings[0][:top_k] if rankings else []
+        documents = {}
+        for ranking in rankings:
+            for rank, result in enumerate(ranking):
+                document = documents.get(result['path'])
+                if document is None:
+                    document = documents[result['path']] = {'path': result['path'], 'score': 0.0,
+                                                             'found_words': set(), 'passages': {}}
+                document['score'] += 1 / (self.fusion_k + rank + 1)
+                document['found_words'].update(result['found_words'])
+                for passage in result['passages']:
+                    # The first retriever's score is kept for a passage both of them found
+                    document['passages'].setdefault((passage['start'], passage['end']), passage)
+
+        results = sorted(documents.values(), key=lambda document: -document['score'])[:top_k]
+        for result in results:
+            result['found_words'] = list(result['found_words'])
+            result['passages'] = list(result['passages'].values())
+        return results
+
+    def _collect(self, query_words: list, similarities, indices, id_to_path, terms, passages, top_k: int) -> list:
+        normalized_query_words = set(query_words)
+        documents = {}
+        for i, idx in enumerate(indices):
+            file_path = id_to_path.get(idx)
+            if file_path is None:
+                continue
+            score = float(similarities[i])
+            result = documents.get(file_path)
+            if result is None:
+                result = documents[file_path] = {'path': file_path, 'score': score, 'found_words': set(),
+                                                 'passages': []}
+            elif self.scoring == 'sum':
+                result['score'] += score
+            result['found_words'].update(normalized_query_words.intersection(
+                self._document_terms(idx, file_path, terms)))
+            passage = passages.get(idx)
+            if passage is not None:
+                result['passages'].append({'start': passage[0], 'end': passage[1], 'score': score})
+
+        results = sorted(documents.values(), key=lambda result: -result['score'])[:top_k]
+        for result in results:
+            result['found_words'] = list(result['found_words'])
+        return results
+
+    def _document_terms(self, idx, file_path: str, terms) -> frozenset:
+        document_terms = terms.get(idx)
+        if document_terms is None:
+            # Documents indexed before terms were stored with the index are normalized once on first hit
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    document_terms = frozenset(normalize(f.read()))
+            except Exception:
+                return frozenset()
+            with self.indexer.lock:
+                terms[int(idx)] = document_terms
+                if int(idx) in self.indexer.id_to_path:
+                    # Kept by the indexer as well, so the generations it publishes later have it too
+                    self.indexer.remember_terms(int(idx), document_terms)
+        return document_terms
+
+
+class QueryBatcher:
+    def __init__(self, search_engine: VectorSearch, window_ms=5, max_batch=32):
+        self.search_engine = search_engine
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = None
+        self._task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def search(self, query: str, top_k=5, search_filter=None) -> list:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, top_k, search_filter, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
                 try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        normalized_content_words = set(normalize(content))
-                        found_words = list(normalized_query_words.intersection(normalized_content_words))
-                except Exception:
-                    found_words = []
-                results.append({
-                    'path': self.id_to_path[idx],
-                    'score': similarities[0][i],
-                    'found_words': found_words 
-                })
-        
-        return results
\ No newline at end of file
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Queries with the same filter share one search_many call
+            groups = {}
+            for request in batch:
+                groups.setdefault(request[2], []).append(request)
+            for search_filter, group in groups.items():
+                await self._search_group(loop, group, search_filter)
+
+    async def _search_group(self, loop, group: list, search_filter):
+        queries = [query for query, _, _, _ in group]
+        top_k = max(k for _, k, _, _ in group)
+        try:
+            # Encoding and the FAISS scan are CPU-bound, so they run in a worker thread off the event loop
+            results = await loop.run_in_executor(None, self.search_engine.search_many, queries, top_k,
+                                                 search_filter)
+        except Exception as e:
+            for _, _, _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, k, _, future), result in zip(group, results):
+            if not future.done():
+                future.set_result(result[:k])
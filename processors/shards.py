@@ -0,0 +1,189 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from .crawler import VectorIndexer, FileChangeHandler
+from .search import VectorSearch, SEARCH_BATCH_SIZE, record_timings
+from .encoders import make_encoder
+
+
+def shard_path(path: str, root: str) -> str:
+    # processors/vector_index.faiss + local_fs -> processors/vector_index.local_fs.faiss
+    stem, ext = os.path.splitext(path)
+    name = re.sub(r'[^\w.-]+', '_', os.path.normpath(root)).strip('_.') or 'root'
+    return f"{stem}.{name}{ext}"
+
+
+class ShardedIndexer:
+    def __init__(self, watch_paths: list, index_path="vector_index.faiss", map_path="path_map.pkl",
+                 model_name='all-mpnet-base-v2', encoder=None, **indexer_options):
+        self.watch_paths = watch_paths
+        self.index_path = index_path
+        self.map_path = map_path
+        self.model_name = model_name
+        self.indexer_options = indexer_options
+        self.read_only = indexer_options.get('read_only', False)
+        self.handlers = {}
+        self.reload_lock = threading.Lock()
+
+        if encoder is None:
+            logging.info(f"Loading encoder '{model_name}'...")
+            encoder = make_encoder(model_name)
+        self.encoder = encoder
+        # One VectorIndexer per watch root, each with its own files; they are opened and crawled in parallel
+        with ThreadPoolExecutor(max_workers=len(watch_paths) or 1) as pool:
+            self.shards = dict(zip(watch_paths, pool.map(self._open_shard, watch_paths)))
+
+    def _open_shard(self, root: str) -> VectorIndexer:
+        return VectorIndexer(watch_paths=[root], index_path=shard_path(self.index_path, root),
+                             map_path=shard_path(self.map_path, root), model_name=self.model_name,
+                             encoder=self.encoder, **self.indexer_options)
+
+    def watch(self, observer):
+        for root, indexer in self.shards.items():
+            # Every shard has its own handler thread, so ingest into different roots runs concurrently
+            self.handlers[root] = FileChangeHandler(indexer)
+            observer.schedule(self.handlers[root], root, recursive=True)
+            logging.info(f"Watching '{root}' for shard {indexer.index_path}.")
+
+    def stop(self):
+        for handler in self.handlers.values():
+            handler.stop()
+        self.handlers = {}
+
+    def stats(self) -> dict:
+        return {root: indexer.stats() for root, indexer in self.shards.items()}
+
+    def reload_shard(self, root: str, rebuild=False) -> VectorIndexer:
+        # Searches keep using the old shard until the new one is ready; the other shards are not touched
+        started = time.perf_counter()
+        with self.reload_lock:
+            old = self.shards[root]
+
+            def build():
+                if rebuild:
+                    old._check_writable()
+                    for path in old.files():
+                        for stale in [path, path + '.tmp']:
+                            if os.path.exists(stale):
+                                os.remove(stale)
+                elif not old.read_only:
+                    old.save_index()
+                return self._open_shard(root)
+
+            handler = self.handlers.get(root)
+            indexer = handler.replace_indexer(build) if handler is not None else build()
+            self.shards[root] = indexer
+            # Searches that already hold a generation of the old shard finish on it without its cache
+            old.close()
+        action = 'Rebuilt' if rebuild else 'Reloaded'
+        logging.info(f"{action} shard '{root}' in {time.perf_counter() - started:.2f} s: {indexer.stats()}")
+        return indexer
+
+    def rebuild_shard(self, root: str) -> VectorIndexer:
+        # The embedding cache is kept, so unchanged files are not encoded again
+        return self.reload_shard(root, rebuild=True)
+
+
+class ShardedSearch:
+    def __init__(self, indexer: ShardedIndexer, workers=None, **search_options):
+        self.indexer = indexer
+        self.search_options = search_options
+        self.pool = ThreadPoolExecutor(max_workers=workers or len(indexer.shards) or 1)
+        # Seconds spent in each stage by the last batch; 'shards' is the wall time of the parallel fan-out
+        self.timings = {}
+
+    def search(self, query: str, top_k=5, search_filter=None) -> list:
+        return self.search_many([query], top_k, search_filter)[0]
+
+    def _searches(self, search_filter) -> list:
+        # Shards whose root the filter rules out are not searched at all
+        return [VectorSearch(indexer=shard, **self.search_options) for root, shard in self.indexer.shards.items()
+                if search_filter is None or search_filter.may_match(root)]
+
+    def _merge(self, rows: list, top_k: int) -> list:
+        # Only for rankings whose scores compare across shards as they are: cosine, or BM25 computed with the
+        # statistics of all shards
+        hits = [hit for shard_row in rows for hit in shard_row]
+        return sorted(hits, key=lambda hit: -hit['score'])[:top_k]
+
+    def _statistics(self, query_words: list) -> list:
+        # BM25 collection statistics of every query summed over all shards, including those a filter skips,
+        # so that a document scores the same as it would in a single index
+        statistics = []
+        for words in query_words:
+            documents, total_length, frequencies = 0, 0, Counter()
+            for shard in list(self.indexer.shards.values()):
+                shard_documents, shard_length, shard_frequencies = shard.lexical_statistics(words)
+                documents += shard_documents
+                total_length += shard_length
+                frequencies.update(shard_frequencies)
+            statistics.append((documents, total_length, frequencies))
+        return statistics
+
+    def _fuse(self, search: VectorSearch, rows: list, top_k: int) -> list:
+        # rows holds every shard's rankings of one query; each retriever's rankings are merged across shards
+        # first, then fused once, as reciprocal ranks within a single shard do not compare across shards
+        retrievers = max(len(shard_rankings) for shard_rankings in rows)
+        rankings = [self._merge([shard_rankings[retriever] for shard_rankings in rows if shard_rankings],
+                                search.fetch_k(top_k))
+                    for retriever in range(retrievers)]
+        return search._fuse(rankings, top_k)
+
+    def similar(self, file_path: str, top_k=5, search_filter=None, timings=None):
+        timings = {} if timings is None else timings
+        started = time.perf_counter()
+        for shard in self.indexer.shards.values():
+            vector = shard.document_vector(file_path)
+            if vector is not None:
+                break
+        else:
+            return None
+        timings['lookup'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        shard_results = list(self.pool.map(
+            lambda search: search.search_by_vector(vector, top_k, search_filter, exclude=file_path),
+            self._searches(search_filter)))
+        timings['shards'] = time.perf_counter() - started
+        results = self._merge(shard_results, top_k)
+        record_timings('similar', timings)
+        return results
+
+    def search_many(self, queries: list, top_k=5, search_filter=None, timings=None) -> list:
+        timings = {} if timings is None else timings
+        # Queries are normalized and encoded once; every shard searches with the same embeddings
+        searches = self._searches(search_filter)
+        if not searches:
+            return [[] for _ in queries]
+        query_words, query_embeddings = searches[0].prepare(queries, timings)
+
+        statistics = None
+        if searches[0].mode != 'vector':
+            started = time.perf_counter()
+            statistics = self._statistics(query_words)
+            timings['statistics'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        shard_timings = [{} for _ in searches]
+        shard_results = list(self.pool.map(
+            lambda search, stages: search.rank_prepared(query_words, query_embeddings, top_k, stages,
+                                                        search_filter, statistics),
+            searches, shard_timings))
+        timings['shards'] = time.perf_counter() - started
+        # The shards run in parallel, so each stage is reported as the time of the slowest shard
+        for stages in shard_timings:
+            for stage, seconds in stages.items():
+                timings[stage] = max(timings.get(stage, 0.0), seconds)
+
+        started = time.perf_counter()
+        results = [self._fuse(searches[0], [shard_result[row] for shard_result in shard_results], top_k)
+                   for row in range(len(queries))]
+        timings['merge'] = time.perf_counter() - started
+        self.timings = timings
+        SEARCH_BATCH_SIZE.observe(len(queries))
+        record_timings('search', timings)
+        return results
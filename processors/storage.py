@@ -0,0 +1,264 @@
+import os
+import zlib
+import struct
+import logging
+import numpy as np
+from .telemetry import REGISTRY
+
+OP_ADD = 1
+OP_REMOVE = 2
+# An add record that also carries the passage of the file the vector was encoded from
+OP_ADD_PASSAGE = 3
+
+# payload length, crc32 of the payload, sequence number, document ID, operation
+HEADER = struct.Struct('<IIqqB')
+# size, mtime in nanoseconds and content digest of the file behind an add record
+FILE_META = struct.Struct('<qq16s')
+# character offsets of a passage within its file and the digest of the passage text
+PASSAGE = struct.Struct('<qq16s')
+
+PERSIST_BYTES = {kind: REGISTRY.counter('persist_bytes_total', 'Bytes written to snapshot files and the change log',
+                                        kind=kind) for kind in ['snapshot', 'changelog']}
+
+
+def atomic_write(path: str, write):
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    with open(tmp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+        PERSIST_BYTES['snapshot'].inc(os.fstat(f.fileno()).st_size)
+    os.replace(tmp_path, path)
+
+
+class ChangeLog:
+    def __init__(self, path: str):
+        self.path = path
+        self.records = 0
+        self._file = None
+
+    def append(self, records: list):
+        if not records:
+            return
+        chunks = []
+        for seq, op, doc_id, file_path, vector, meta, words, passage in records:
+            path_bytes = file_path.encode('utf-8')
+            payload = struct.pack('<I', len(path_bytes)) + path_bytes
+            if op == OP_ADD:
+                payload += FILE_META.pack(*meta)
+                if passage is not None:
+                    op = OP_ADD_PASSAGE
+                    payload += PASSAGE.pack(*passage)
+                payload += np.ascontiguousarray(vector, dtype='float32').tobytes()
+                # Every occurrence is kept so that term frequencies survive a replay
+                payload += '\n'.join(words).encode('utf-8')
+            chunks.append(HEADER.pack(len(payload), zlib.crc32(payload), seq, doc_id, op))
+            chunks.append(payload)
+
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        PERSIST_BYTES['changelog'].inc(self._file.write(b''.join(chunks)))
+        self.records += len(records)
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def replay(self, after_seq: int, d: int):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, crc, seq, doc_id, op = HEADER.unpack_from(data, offset)
+            payload = data[offset + HEADER.size:offset + HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            offset += HEADER.size + length
+            self.records += 1
+            if seq <= after_seq:
+                continue
+
+            path_len = struct.unpack_from('<I', payload)[0]
+            file_path = payload[4:4 + path_len].decode('utf-8')
+            vector, meta, words, passage = None, None, None, None
+            if op in (OP_ADD, OP_ADD_PASSAGE):
+                meta = FILE_META.unpack_from(payload, 4 + path_len)
+                vector_offset = 4 + path_len + FILE_META.size
+                if op == OP_ADD_PASSAGE:
+                    op = OP_ADD
+                    passage = PASSAGE.unpack_from(payload, vector_offset)
+                    vector_offset += PASSAGE.size
+                vector = np.frombuffer(payload, dtype='float32', count=d, offset=vector_offset)
+                words_bytes = payload[vector_offset + 4 * d:]
+                words = words_bytes.decode('utf-8').split('\n') if words_bytes else []
+            yield seq, op, doc_id, file_path, vector, meta, words, passage
+
+        if offset < len(data):
+            # A torn record at the tail is what a crash in the middle of append() leaves behind
+            logging.warning(f"Discarding {len(data) - offset} bytes of incomplete log records in {self.path}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+
+    def reset(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        with open(self.path, 'wb') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self.records = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+# magic, number of documents, log sequence number of the snapshot, index kind code
+TABLE_HEADER = struct.Struct('<8sqqq')
+# Followed by the length of the encoder name and the name, zero-padded to keep the columns 8-byte aligned
+TABLE_MAGIC = b'VSDOCS03'
+# Tables written before the encoder was recorded
+TABLE_MAGIC_V2 = b'VSDOCS02'
+# Tables written before passages were stored have no passage column either
+TABLE_MAGIC_V1 = b'VSDOCS01'
+INDEX_KINDS = ['flat', 'ivf', 'hnsw']
+# Stored in place of the term list for documents that were indexed before terms were kept
+NO_TERMS = b'\x00'
+NO_PASSAGE = PASSAGE.pack(-1, -1, bytes(16))
+
+
+def write_document_table(path: str, id_to_path: dict, terms: dict, passages: dict, seq: int, kind: str,
+                         encoder: str):
+    ids = np.array(sorted(id_to_path), dtype='int64')
+    paths = [id_to_path[doc_id].encode('utf-8') for doc_id in ids.tolist()]
+    term_lists = ['\n'.join(sorted(terms[doc_id])).encode('utf-8') if doc_id in terms else NO_TERMS
+                  for doc_id in ids.tolist()]
+    passage_rows = [PASSAGE.pack(*passages[doc_id]) if doc_id in passages else NO_PASSAGE
+                    for doc_id in ids.tolist()]
+    path_offsets = np.zeros(len(ids) + 1, dtype='int64')
+    path_offsets[1:] = np.cumsum([len(p) for p in paths])
+    term_offsets = np.zeros(len(ids) + 1, dtype='int64')
+    term_offsets[1:] = np.cumsum([len(t) for t in term_lists])
+    encoder_bytes = encoder.encode('utf-8')
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(TABLE_HEADER.pack(TABLE_MAGIC, len(ids), seq, INDEX_KINDS.index(kind)))
+            f.write(struct.pack('<q', len(encoder_bytes)) + encoder_bytes + bytes(-len(encoder_bytes) % 8))
+            f.write(ids.tobytes())
+            f.write(path_offsets.tobytes())
+            f.write(term_offsets.tobytes())
+            f.write(b''.join(passage_rows))
+            f.write(b''.join(paths))
+            f.write(b''.join(term_lists))
+
+    atomic_write(path, write)
+
+
+class MappedColumn:
+    def __init__(self, table, offsets, blob, parse):
+        self.table = table
+        self.offsets = offsets
+        self.blob = blob
+        self.parse = parse
+        # Values computed at query time in a read-only process (e.g. terms of old documents) live here
+        self.overlay = {}
+
+    def __len__(self):
+        return len(self.table.ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.overlay or self.get(doc_id) is not None
+
+    def __getitem__(self, doc_id):
+        value = self.get(doc_id)
+        if value is None:
+            raise KeyError(doc_id)
+        return value
+
+    def __setitem__(self, doc_id, value):
+        self.overlay[doc_id] = value
+
+    def get(self, doc_id, default=None):
+        if doc_id in self.overlay:
+            return self.overlay[doc_id]
+        row = self.table.find(doc_id)
+        if row < 0:
+            return default
+        value = self.parse(bytes(self.blob[self.offsets[row]:self.offsets[row + 1]]))
+        return default if value is None else value
+
+
+class MappedPathIndex:
+    # path -> first document ID of the file, built from the table on first use; only lookups by path need it
+    def __init__(self, table):
+        self.table = table
+        self._ids = None
+
+    def __contains__(self, file_path):
+        return self.get(file_path) is not None
+
+    def get(self, file_path, default=None):
+        if self._ids is None:
+            ids = {}
+            # Rows are in ID order; walking them backwards leaves the first passage of every file
+            for row in range(len(self.table.ids) - 1, -1, -1):
+                ids[self.table.paths.get(int(self.table.ids[row]))] = int(self.table.ids[row])
+            self._ids = ids
+        return self._ids.get(file_path, default)
+
+
+class MappedDocumentTable:
+    def __init__(self, path: str):
+        self.data = np.memmap(path, dtype='uint8', mode='r')
+        magic, count, self.seq, kind = TABLE_HEADER.unpack(bytes(self.data[:TABLE_HEADER.size]))
+        if magic not in (TABLE_MAGIC, TABLE_MAGIC_V2, TABLE_MAGIC_V1):
+            raise ValueError(f"{path} is not a document table")
+        self.kind = INDEX_KINDS[kind]
+
+        position = TABLE_HEADER.size
+        self.encoder = None
+        if magic == TABLE_MAGIC:
+            length = struct.unpack('<q', bytes(self.data[position:position + 8]))[0]
+            self.encoder = bytes(self.data[position + 8:position + 8 + length]).decode('utf-8')
+            position += 8 + length + (-length % 8)
+        self.ids = self.data[position:position + 8 * count].view('int64')
+        position += 8 * count
+        path_offsets = self.data[position:position + 8 * (count + 1)].view('int64')
+        position += 8 * (count + 1)
+        term_offsets = self.data[position:position + 8 * (count + 1)].view('int64')
+        position += 8 * (count + 1)
+        passage_size = 0 if magic == TABLE_MAGIC_V1 else PASSAGE.size
+        passage_blob = self.data[position:position + passage_size * count]
+        position += passage_size * count
+        path_blob = self.data[position:position + path_offsets[-1]]
+        term_blob = self.data[position + path_offsets[-1]:]
+
+        self.paths = MappedColumn(self, path_offsets, path_blob, lambda raw: raw.decode('utf-8'))
+        self.terms = MappedColumn(self, term_offsets, term_blob, self._parse_terms)
+        self.passages = MappedColumn(self, np.arange(count + 1, dtype='int64') * passage_size, passage_blob,
+                                     self._parse_passage)
+        self.path_ids = MappedPathIndex(self)
+
+    def find(self, doc_id) -> int:
+        row = int(np.searchsorted(self.ids, doc_id))
+        if row < len(self.ids) and self.ids[row] == doc_id:
+            return row
+        return -1
+
+    @staticmethod
+    def _parse_terms(raw: bytes):
+        if raw == NO_TERMS:
+            return None
+        return frozenset(raw.decode('utf-8').split('\n')) if raw else frozenset()
+
+    @staticmethod
+    def _parse_passage(raw: bytes):
+        if not raw or raw == NO_PASSAGE:
+            return None
+        return PASSAGE.unpack(raw)
@@ -0,0 +1,120 @@
+import bisect
+import threading
+
+# Bucket upper bounds; every histogram also has an implicit +Inf bucket
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # Per-bucket counts; they are made cumulative only when rendered
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    values = ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+    return '{' + values + '}'
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self, namespace='vector_search'):
+        self.namespace = namespace
+        # name -> (type, help, {labels: metric}); children are created on first use and never removed
+        self.families = {}
+        # name -> (help, callback); gauges are read when the metrics are rendered, so nothing is kept up to date
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def _child(self, kind: str, name: str, description: str, labels: dict, make):
+        key = tuple(sorted(labels.items()))
+        family = self.families.get(name)
+        if family is not None and key in family[2]:
+            return family[2][key]
+        with self._lock:
+            family = self.families.setdefault(name, (kind, description, {}))
+            if family[0] != kind:
+                raise ValueError(f"Metric '{name}' is already registered as a {family[0]}.")
+            return family[2].setdefault(key, make())
+
+    def counter(self, name: str, description: str, **labels) -> Counter:
+        return self._child('counter', name, description, labels, Counter)
+
+    def histogram(self, name: str, description: str, buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._child('histogram', name, description, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name: str, description: str, callback):
+        # callback() returns a number or a list of (labels dict, number)
+        with self._lock:
+            self.gauges[name] = (description, callback)
+
+    def observe_stages(self, name: str, description: str, timings: dict):
+        for stage, seconds in timings.items():
+            self.histogram(name, description, stage=stage).observe(seconds)
+
+    def render(self) -> str:
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+        with self._lock:
+            families = sorted((name, kind, description, list(children.items()))
+                              for name, (kind, description, children) in self.families.items())
+            gauges = sorted(self.gauges.items())
+        for name, kind, description, children in families:
+            name = f"{self.namespace}_{name}"
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for key, metric in sorted(children, key=lambda child: child[0]):
+                labels = dict(key)
+                if kind == 'counter':
+                    lines.append(f"{name}{_labels(labels)} {_number(metric.value)}")
+                    continue
+                with metric._lock:
+                    counts, total, count = list(metric.counts), metric.sum, metric.count
+                cumulative = 0
+                for bound, bucket_count in zip(list(metric.buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name, (description, callback) in gauges:
+            name = f"{self.namespace}_{name}"
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+            values = callback()
+            for labels, value in values if isinstance(values, list) else [({}, values)]:
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by every indexer and search engine of the process
+REGISTRY = Registry()
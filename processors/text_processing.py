@@ -1,4 +1,8 @@
-from typing import List
+from typing import List, Tuple
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import re
 import nltk
 import logging
 
@@ -7,17 +11,85 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+VALID_TAGS = {'NN', 'NNS', 'NNP', 'NNPS', 'JJ', 'JJR', 'JJS', 'VB', 'VBD', 'VBG', 'VBN', 'VBP', 'VBZ', 'CD'}
+
+_tokenizer = nltk.TweetTokenizer()
+_stemmer = nltk.stem.LancasterStemmer()
+_word = re.compile(r'\S+')
+
+
+class Normalizer:
+    def __init__(self, cache_size=200000):
+        self.cache_size = cache_size
+        # token -> stemmed lowercase form, or None when its tag is filtered out
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def normalize(self, sentence) -> List[str]:
+        return self.normalize_many([sentence])[0]
+
+    def normalize_many(self, sentences: list, processes=None, chunksize=64) -> List[List[str]]:
+        if processes and len(sentences) > chunksize:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                return list(pool.map(normalize, sentences, chunksize=chunksize))
+
+        logging.debug('Start normalize %d sentences', len(sentences))
+        tokenized = [_tokenizer.tokenize(sentence) for sentence in sentences]
+        forms = self._forms({word for tokens in tokenized for word in tokens})
+
+        normalized = []
+        for tokens in tokenized:
+            normalized.append([forms[word] for word in tokens if forms[word] is not None])
+        logging.debug('Normalized %d sentences', len(normalized))
+        return normalized
+
+    def _forms(self, words: set) -> dict:
+        forms = {}
+        with self.lock:
+            for word in words:
+                if word in self.cache:
+                    self.cache.move_to_end(word)
+                    forms[word] = self.cache[word]
+        unknown = [word for word in words if word not in forms]
+
+        if unknown:
+            # Each word is tagged as its own one-word sentence, exactly like the original per-word pos_tag calls,
+            # but with a single tagger instance for the whole batch
+            tagged = nltk.pos_tag_sents([[word] for word in unknown])
+            for word, tags in zip(unknown, tagged):
+                forms[word] = _stemmer.stem(word).lower() if tags[0][1] in VALID_TAGS else None
+
+            with self.lock:
+                for word in unknown:
+                    self.cache[word] = forms[word]
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return forms
+
+
+_normalizer = Normalizer()
+
+
 def normalize(sentence) -> List[str]:
-    valid = ['NN', 'NNS', 'NNP', 'NNPS', 'JJ', 'JJR', 'JJS', 'VB', 'VBD', 'VBG', 'VBN', 'VBP', 'VBZ', 'CD']
+    return _normalizer.normalize(sentence)
+
 
-    logging.debug(f'Start normalize sentence: {sentence}')
-    tokenizer = nltk.TweetTokenizer()
-    stemmer = nltk.stem.LancasterStemmer()
+def normalize_many(sentences: list, processes=None) -> List[List[str]]:
+    return _normalizer.normalize_many(sentences, processes=processes)
 
-    sentence = tokenizer.tokenize(sentence)
-    sentence = [word for word in sentence if nltk.pos_tag([word])[0][1] in valid]
-    sentence = [stemmer.stem(word).lower() for word in sentence]
 
-    logging.debug(f'Normalized tokens: {sentence}')
-    return sentence
+def split_passages(text: str, window: int, overlap=0) -> List[Tuple[int, int]]:
+    # Character spans of windows of `window` whitespace-separated tokens, consecutive windows sharing `overlap`
+    spans = [match.span() for match in _word.finditer(text)]
+    if not window or len(spans) <= window:
+        return [(0, len(text))]
 
+    step = max(1, window - overlap)
+    passages = []
+    start = 0
+    while True:
+        end = min(start + window, len(spans))
+        passages.append((spans[start][0], spans[end - 1][1]))
+        if end == len(spans):
+            return passages
+        start += step